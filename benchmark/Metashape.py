@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# :autoIndent=simple:collapseFolds=0:indentSize=4:mode=python:noTabs=true:tabSize=4:wrap=soft:
+
+"""
+Substituto local do modulo Metashape, usado somente pelo benchmark (benchmark.py)
+
+Emula o suficiente da API para rodar as funcoes do main.py fora do Metashape: chunks, cameras,
+nuvem de tie points com milhoes de pontos, filtros da selecao gradual, depth maps, transformacao de
+coordenadas e as chamadas de exportacao. Nao faz nenhum processamento fotogrametrico.
+
+O custo das chamadas ao Metashape e simulado pelas latencias em Latencias (segundos), que podem ser
+ajustadas pelo benchmark (--latencia nome=segundos).
+"""
+
+
+import numpy
+import struct
+import time
+
+
+Latencias = dict(
+    selectPoints_por_milhao=0.02,   # fltr.selectPoints, por milhao de pontos
+    optimizeCameras=0.05,           # chunk.optimizeCameras
+    remove=0.005,                   # chunk.remove (alteracao do grafo do projeto), por chamada
+    depth_maps_keys_por_mil=0.0005, # chunk.depth_maps.keys(), por mil cameras
+    transform=0.00002,              # CoordinateSystem.transform, por ponto
+    exportPoints=0.0,
+    exportRaster=0.0,
+    save=0.0,
+)
+
+
+def _Esperar(nome, fator=1.0):
+    segundos = Latencias.get(nome, 0.0) * fator
+    if segundos > 0:
+        time.sleep(segundos)
+
+
+class _Enum:
+    def __init__(self, nome, *valores):
+        for valor in valores:
+            setattr(self, valor, "%s.%s" % (nome, valor))
+
+
+FilterMode = _Enum("FilterMode", "AggressiveFiltering", "ModerateFiltering", "MildFiltering", "NoFiltering")
+BlendingMode = _Enum("BlendingMode", "AverageBlending", "MosaicBlending", "MinBlending", "MaxBlending", "DisabledBlending")
+SurfaceType = _Enum("SurfaceType", "Arbitrary", "HeightField")
+DataSource = _Enum("DataSource", "PointCloudData", "DenseCloudData", "DepthMapsData", "ModelData", "ElevationData", "OrthomosaicData")
+Interpolation = _Enum("Interpolation", "DisabledInterpolation", "EnabledInterpolation", "Extrapolated")
+FaceCount = _Enum("FaceCount", "LowFaceCount", "MediumFaceCount", "HighFaceCount")
+PointClass = _Enum("PointClass", "Created", "Unclassified", "Ground", "LowPoint")
+ImageFormat = _Enum("ImageFormat", "ImageFormatTIFF", "ImageFormatJPEG", "ImageFormatPNG")
+RasterTransformType = _Enum("RasterTransformType", "RasterTransformNone")
+PointsFormatLAS = "PointsFormatLAS"
+PointsFormatLAZ = "PointsFormatLAZ"
+
+
+class ImageCompression:
+    TiffCompressionNone = "TiffCompressionNone"
+    TiffCompressionLZW = "TiffCompressionLZW"
+    TiffCompressionJPEG = "TiffCompressionJPEG"
+    TiffCompressionDeflate = "TiffCompressionDeflate"
+
+    def __init__(self):
+        self.tiff_compression = self.TiffCompressionLZW
+        self.jpeg_quality = 90
+        self.tiff_big = False
+        self.tiff_tiled = False
+        self.tiff_overviews = False
+
+
+class OrthoProjection:
+    def __init__(self):
+        self.crs = None
+
+
+class Vector(list):
+    x = property(lambda self: self[0])
+    y = property(lambda self: self[1])
+    z = property(lambda self: self[2])
+
+    def __add__(self, outro):
+        return Vector([a + b for a, b in zip(self, outro)])
+
+    def __sub__(self, outro):
+        return Vector([a - b for a, b in zip(self, outro)])
+
+    def __mul__(self, escalar):
+        return Vector([a * escalar for a in self])
+
+    def __truediv__(self, escalar):
+        return Vector([a / escalar for a in self])
+
+
+class BBox:
+    def __init__(self, min=None, max=None):
+        self.min = min
+        self.max = max
+
+
+class Matrix:
+    # Somente matrizes identidade/escala: o suficiente para o transform do chunk
+    def __init__(self, linhas=None):
+        self.linhas = linhas or [[1.0 if i == j else 0.0 for j in range(4)] for i in range(4)]
+
+    def __getitem__(self, indice):
+        return self.linhas[indice[0]][indice[1]]
+
+    def __mul__(self, outro):
+        if isinstance(outro, Matrix):
+            n = len(self.linhas)
+            return Matrix([[sum(self.linhas[i][k] * outro.linhas[k][j] for k in range(n)) for j in range(n)] for i in range(n)])
+        if isinstance(outro, (list, tuple)):
+            return Vector([sum(a * b for a, b in zip(linha, outro)) for linha in self.linhas])
+        return Matrix([[valor * outro for valor in linha] for linha in self.linhas])
+
+    def mulp(self, vetor):
+        return Vector([sum(a * b for a, b in zip(linha, list(vetor) + [1.0])) for linha in self.linhas[:3]])
+
+    def inv(self):
+        return Matrix([[1.0 / valor if valor and i == j else 0.0 for j, valor in enumerate(linha)] for i, linha in enumerate(self.linhas)])
+
+    def t(self):
+        return Matrix([list(coluna) for coluna in zip(*self.linhas)])
+
+
+class CoordinateSystem:
+    def __init__(self, nome="EPSG::4326"):
+        self.authority = nome
+        self.name = dict([("EPSG::4326", "WGS 84"), ("EPSG::4674", "SIRGAS 2000"), ("EPSG::31983", "SIRGAS 2000 / UTM zone 23S")]).get(nome, nome)
+        self.wkt = '%s["%s"]' % ("GEOGCS" if nome in ("EPSG::4326", "EPSG::4674") else "PROJCS", self.name)
+
+    def __str__(self):
+        return "<CoordinateSystem '%s (%s)'>" % (self.name, self.authority)
+
+    def project(self, vetor):
+        return Vector(vetor)
+
+    def unproject(self, vetor):
+        return Vector(vetor)
+
+    def localframe(self, vetor):
+        return Matrix()
+
+    @staticmethod
+    def transform(vetor, origem, destino):
+        _Esperar("transform")
+        return Vector(vetor)
+
+
+class _Meta(dict):
+    # Como no Metashape, chaves inexistentes retornam None
+    def __getitem__(self, chave):
+        return self.get(chave)
+
+
+class _Photo:
+    def __init__(self, path):
+        self.path = path
+
+
+class _Reference:
+    def __init__(self, location=None):
+        self.location = location
+        self.enabled = location is not None
+
+
+class Camera:
+    def __init__(self, key, label, path, location=None):
+        self.key = key
+        self.label = label
+        self.enabled = True
+        self.photo = _Photo(path)
+        self.reference = _Reference(location)
+        self.meta = _Meta()
+        self.planes = [self]
+        self.transform = Matrix()
+
+
+class Marker:
+    def __init__(self, key, label, location=None):
+        self.key = key
+        self.label = label
+        self.reference = _Reference(location)
+
+
+class _Point:
+    __slots__ = ("_nuvem", "_indice")
+
+    def __init__(self, nuvem, indice):
+        self._nuvem = nuvem
+        self._indice = indice
+
+    @property
+    def selected(self):
+        return bool(self._nuvem._selecionados[self._indice])
+
+    @property
+    def valid(self):
+        return True
+
+
+class _Points:
+    # Sequencia de pontos criada sob demanda, como os objetos devolvidos pelos bindings
+    def __init__(self, nuvem):
+        self._nuvem = nuvem
+
+    def __len__(self):
+        return len(self._nuvem._selecionados)
+
+    def __getitem__(self, indice):
+        if not -len(self) <= indice < len(self):
+            raise IndexError(indice)
+        return _Point(self._nuvem, indice % len(self))
+
+    def __iter__(self):
+        for indice in range(len(self)):
+            yield _Point(self._nuvem, indice)
+
+
+class PointCloud:
+    class Filter:
+        ReconstructionUncertainty = "ReconstructionUncertainty"
+        ProjectionAccuracy = "ProjectionAccuracy"
+        ReprojectionError = "ReprojectionError"
+        ImageCount = "ImageCount"
+
+        def init(self, chunk, criterion):
+            self._nuvem = chunk.point_cloud
+            self._valores = self._nuvem._criterios[criterion]
+            self.values = self._valores.tolist()
+            self.min_value = float(self._valores.min()) if len(self._valores) else 0.0
+            self.max_value = float(self._valores.max()) if len(self._valores) else 0.0
+
+        def selectPoints(self, threshold):
+            _Esperar("selectPoints_por_milhao", len(self._valores) / 1e6)
+            self._nuvem._selecionados = self._valores > threshold
+
+        def resetSelection(self):
+            self._nuvem._selecionados = numpy.zeros(len(self._valores), dtype=bool)
+
+    def __init__(self, pontos=0, semente=0):
+        aleatorio = numpy.random.default_rng(semente)
+        self._criterios = {
+            PointCloud.Filter.ReconstructionUncertainty: aleatorio.lognormal(3.2, 0.6, pontos),
+            PointCloud.Filter.ProjectionAccuracy: aleatorio.lognormal(1.0, 0.4, pontos),
+            PointCloud.Filter.ReprojectionError: aleatorio.lognormal(-1.0, 0.5, pontos),
+        }
+        self._selecionados = numpy.zeros(pontos, dtype=bool)
+        self.points = _Points(self)
+        self.meta = _Meta()
+
+    def removeSelectedPoints(self):
+        manter = ~self._selecionados
+        for criterio in self._criterios:
+            self._criterios[criterio] = self._criterios[criterio][manter]
+        self._selecionados = numpy.zeros(int(manter.sum()), dtype=bool)
+
+    def _Otimizar(self):
+        # Uma otimizacao reduz um pouco o erro de todos os pontos restantes
+        for criterio in self._criterios:
+            self._criterios[criterio] = self._criterios[criterio] * 0.97
+
+
+class DepthMaps:
+    def __init__(self, cameras):
+        self._cameras = list(cameras)
+        self.meta = _Meta()
+
+    def keys(self):
+        _Esperar("depth_maps_keys_por_mil", len(self._cameras) / 1e3)
+        return list(self._cameras)
+
+    def __contains__(self, camera):
+        return camera in self._cameras
+
+
+class DenseCloud:
+    def __init__(self, pontos=0, resolucao=0.05):
+        self.point_count = pontos
+        self.meta = _Meta({'BuildDenseCloud/resolution': str(resolucao), 'BuildDepthMaps/downscale': '2'})
+
+    def classifyGroundPoints(self, **kwargs):
+        self.meta['ClassifyGroundPoints/ram_used'] = '0'
+
+    def removePoints(self, classe):
+        pass
+
+
+class Region:
+    def __init__(self):
+        self.center = Vector([0.0, 0.0, 0.0])
+        self.size = Vector([100.0, 100.0, 50.0])
+        self.rot = Matrix([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+
+
+class ChunkTransform:
+    def __init__(self):
+        self.matrix = Matrix()
+        self.scale = 1.0
+
+
+class Chunk:
+    def __init__(self, key=0, label="Chunk 1"):
+        self.key = key
+        self.label = label
+        self.enabled = True
+        self.cameras = []
+        self.markers = []
+        self.crs = CoordinateSystem("EPSG::4326")
+        self.transform = ChunkTransform()
+        self.region = Region()
+        self.meta = _Meta()
+        self.point_cloud = None
+        self.depth_maps = None
+        self.dense_cloud = None
+        self.model = None
+        self.elevation = None
+        self.orthomosaic = None
+        self.tiepoint_accuracy = 1.0
+        self.document = None
+
+    def remove(self, items):
+        _Esperar("remove")
+        if not isinstance(items, (list, tuple)):
+            items = [items]
+        removidos = set(id(item) for item in items)
+        self.cameras = [camera for camera in self.cameras if id(camera) not in removidos]
+        if self.document is not None:
+            self.document.chunks = [chunk for chunk in self.document.chunks if id(chunk) not in removidos]
+
+    def analyzePhotos(self, cameras=None):
+        aleatorio = numpy.random.default_rng(self.key)
+        for camera in cameras or self.cameras:
+            for band in camera.planes:
+                band.meta['Image/Quality'] = str(aleatorio.uniform(0.4, 1.0))
+
+    def optimizeCameras(self, **kwargs):
+        _Esperar("optimizeCameras")
+        if self.point_cloud is not None:
+            self.point_cloud._Otimizar()
+
+    def updateTransform(self):
+        pass
+
+    def exportPoints(self, path, format=PointsFormatLAS, **kwargs):
+        # LAS 1.4 (formato de pontos 7) com pontos aleatorios numa area de 1000 x 1000 x 50 m, classes 1 e 2.
+        # Em LAZ, somente o cabecalho, o VLR do LASzip e um quarto do tamanho em zeros
+        _Esperar("exportPoints")
+        pontos = self.dense_cloud.point_count if self.dense_cloud is not None else 0
+        vlr = struct.pack("<H16sHH32s", 0, b"laszip encoded", 22204, 0, b"") if format == PointsFormatLAZ else b""
+        cabecalho = bytearray(375)
+        cabecalho[0:4] = b"LASF"
+        cabecalho[24:26] = bytes([1, 4])
+        struct.pack_into("<HIIBHI", cabecalho, 94, 375, 375 + len(vlr), 1 if vlr else 0, 7 | (0x80 if vlr else 0), 36, 0)
+        struct.pack_into("<3d3d", cabecalho, 131, 0.001, 0.001, 0.001, 0.0, 0.0, 0.0)
+        struct.pack_into("<6d", cabecalho, 179, 1000.0, 0.0, 1000.0, 0.0, 50.0, 0.0)
+        struct.pack_into("<Q", cabecalho, 247, pontos)
+        with open(path, "wb") as arquivo:
+            arquivo.write(bytes(cabecalho) + vlr)
+            if vlr:
+                arquivo.write(bytes(36 * pontos // 4))
+                return
+            aleatorio = numpy.random.default_rng(0)
+            for inicio in range(0, pontos, 1000000):
+                quantidade = min(1000000, pontos - inicio)
+                registros = numpy.zeros((quantidade, 36), dtype=numpy.uint8)
+                xyz = aleatorio.integers(0, [1000000, 1000000, 50000], size=(quantidade, 3), endpoint=True).astype("<i4")
+                registros[:, :12] = xyz.view(numpy.uint8).reshape(-1, 12)
+                registros[:, 14] = 0x11 # retorno 1 de 1
+                registros[:, 16] = aleatorio.integers(1, 3, size=quantidade)
+                arquivo.write(registros.tobytes())
+
+    def exportRaster(self, path, image_compression=None, **kwargs):
+        # TIFF de 1024 x 1024 sem pixels de verdade. Com tiff_tiled: tiles de 512 e uma overview, com os IFDs no inicio
+        _Esperar("exportRaster")
+        tiled = image_compression is not None and image_compression.tiff_tiled
+        niveis = [(1024, 0), (512, 1)] if tiled else [(1024, 0)]
+        ifds = b""
+        inicio_dados = 8 + len(niveis) * (2 + 7 * 12 + 4)
+        for indice, (lado, subtipo) in enumerate(niveis):
+            proximo = 8 + (indice + 1) * (2 + 7 * 12 + 4) if indice + 1 < len(niveis) else 0
+            tags = [(254, 4, subtipo), (256, 4, lado), (257, 4, lado)]
+            tags += [(322, 4, 512), (323, 4, 512), (324, 4, inicio_dados), (325, 4, 1)] if tiled else \
+                    [(273, 4, inicio_dados), (278, 4, lado), (279, 4, 1), (259, 3, 7)]
+            ifds += struct.pack("<H", len(tags)) + b"".join(struct.pack("<HHII", tag, tipo, 1, valor) for tag, tipo, valor in tags)
+            ifds += struct.pack("<I", proximo)
+        with open(path, "wb") as arquivo:
+            arquivo.write(b"II*\x00" + struct.pack("<I", 8) + ifds + b"\x00")
+
+
+class Document:
+    def __init__(self, path=""):
+        self.path = path
+        self.chunks = []
+        self.chunk = None
+
+    def addChunk(self):
+        chunk = Chunk(key=len(self.chunks), label="Chunk %d" % (len(self.chunks) + 1))
+        chunk.document = self
+        self.chunks.append(chunk)
+        self.chunk = self.chunk or chunk
+        return chunk
+
+    def remove(self, items):
+        removidos = set(id(item) for item in items)
+        self.chunks = [chunk for chunk in self.chunks if id(chunk) not in removidos]
+
+    def save(self, path=None):
+        _Esperar("save")
+
+
+class Application:
+    def __init__(self):
+        self.document = Document()
+
+
+app = Application()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# :autoIndent=simple:collapseFolds=0:indentSize=4:mode=python:noTabs=true:tabSize=4:wrap=soft:
+
+"""
+Benchmark das funcoes do main.py que rodam em Python (fora do processamento do Metashape)
+
+Roda em qualquer maquina, sem licenca: o modulo Metashape e substituido pelo Metashape.py desta pasta,
+que emula chunks, cameras, tie points e exportacoes com latencias configuraveis.
+
+Uso:
+    python3 benchmark/benchmark.py                                  # roda todos os casos
+    python3 benchmark/benchmark.py --casos selecao_gradual_RU zipdir
+    python3 benchmark/benchmark.py --pontos 5000000 --cameras 10000
+    python3 benchmark/benchmark.py --latencia optimizeCameras=0.5
+    python3 benchmark/benchmark.py --comparar resultados_anteriores.json   # aponta regressoes
+
+Os resultados sao gravados em JSON (--saida) para comparar otimizacoes e detectar regressoes.
+"""
+
+
+from contextlib import redirect_stdout
+from pathlib import Path
+import argparse
+import datetime
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+PastaBenchmark = Path(__file__).resolve().parent
+sys.path.insert(0, str(PastaBenchmark)) # o Metashape.py desta pasta e importado no lugar do verdadeiro
+import Metashape
+
+
+def CarregarWorkflow():
+    # Importa o main.py como modulo (sem executar o bloco __main__)
+    spec = importlib.util.spec_from_file_location("metashape_workflow", str(PastaBenchmark.parent / "main.py"))
+    workflow = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(workflow)
+    return workflow
+
+
+def CriarChunk(doc, cameras=0, pontos=0, pasta=None, desabilitadas=0.0, com_referencia=True):
+    chunk = doc.addChunk()
+    for key in range(cameras):
+        caminho = str(Path(pasta) / ("IMG_%05d.JPG" % key)) if pasta else "IMG_%05d.JPG" % key
+        location = Metashape.Vector([-46.6 + key * 1e-5, -23.5, 800.0]) if com_referencia else None
+        camera = Metashape.Camera(key, "IMG_%05d" % key, caminho, location)
+        camera.enabled = (key % 100) >= desabilitadas * 100
+        chunk.cameras.append(camera)
+        if pasta:
+            with open(caminho, "wb") as arquivo:
+                arquivo.write(b"\xff\xd8" + bytes(64))
+    if pontos:
+        chunk.point_cloud = Metashape.PointCloud(pontos)
+    return chunk
+
+
+################################################################################
+# Casos. Cada um recebe (workflow, args, pasta temporaria) e retorna a funcao cronometrada
+################################################################################
+
+def CasoSelecaoGradual(nome_funcao):
+    def Preparar(workflow, args, pasta):
+        doc = Metashape.Document(str(Path(pasta) / "projeto.psx"))
+        chunk = CriarChunk(doc, pontos=args.pontos)
+        return lambda: getattr(workflow, nome_funcao)(chunk)
+    return Preparar
+
+
+def CasoRemoveDisabledPhotos(workflow, args, pasta):
+    doc = Metashape.Document(str(Path(pasta) / "projeto.psx"))
+    chunk = CriarChunk(doc, cameras=args.cameras, pasta=pasta, desabilitadas=0.2)
+    return lambda: workflow.RemoveDisabledPhotos(chunk)
+
+
+def CasoVerificarDepthMaps(workflow, args, pasta):
+    doc = Metashape.Document(str(Path(pasta) / "projeto.psx"))
+    chunk = CriarChunk(doc, cameras=args.cameras)
+    chunk.depth_maps = Metashape.DepthMaps(chunk.cameras)
+    return lambda: workflow.VerificarSeTodasAsFotosPossuemDepthMap(chunk)
+
+
+def CriarPastaWeb(pasta, arquivos):
+    # Estrutura parecida com a saida do PotreeConverter: paginas, libs e um octree grande
+    www = Path(pasta) / "www"
+    (www / "libs").mkdir(parents=True)
+    (www / "pointclouds" / "nuvem").mkdir(parents=True)
+    texto = b"function potree(){ return 'viewer'; }\n" * 400
+    for indice in range(arquivos):
+        (www / "libs" / ("lib%05d.js" % indice)).write_bytes(texto)
+    (www / "pointclouds" / "nuvem" / "octree.bin").write_bytes(os.urandom(32 * 1024 * 1024))
+    (www / "index.html").write_bytes(b"<html></html>")
+    return str(www)
+
+
+def Zipdir(path, ziph):
+    # Compactacao da aplicacao web antes do EmpacotarPastaWeb (removida do main.py): um arquivo por vez, todos comprimidos
+    # https://stackoverflow.com/questions/1855095/how-to-create-a-zip-archive-of-a-directory-in-python
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            ziph.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), path))
+
+
+def CasoZipdir(workflow, args, pasta):
+    www = CriarPastaWeb(pasta, args.arquivos_web)
+
+    def Executar():
+        with zipfile.ZipFile(str(Path(pasta) / "web.zip"), 'w', zipfile.ZIP_DEFLATED) as zipf:
+            Zipdir(www, zipf)
+    return Executar
+
+
+def CasoEmpacotarPastaWeb(workflow, args, pasta):
+    www = CriarPastaWeb(pasta, args.arquivos_web)
+    return lambda: workflow.EmpacotarPastaWeb(www, str(Path(pasta) / "web.zip"), "zip", workflow.ThreadsCompactacao, apagar=False)
+
+
+def CasoSirgas2000(workflow, args, pasta):
+    doc = Metashape.Document(str(Path(pasta) / "projeto.psx"))
+    chunk = CriarChunk(doc, cameras=args.cameras)
+    for key in range(20):
+        chunk.markers.append(Metashape.Marker(key, "GCP%02d" % key, Metashape.Vector([-46.6, -23.5, 790.0])))
+    return lambda: workflow.Sirgas2000(chunk)
+
+
+def CasoExportarLas(workflow, args, pasta):
+    doc = Metashape.Document(str(Path(pasta) / "projeto.psx"))
+    chunk = CriarChunk(doc)
+    chunk.dense_cloud = Metashape.DenseCloud(args.pontos)
+    return lambda: workflow.ExportarLas(chunk, str(Path(pasta) / "projeto.las"), formato="las")
+
+
+def CasoExportarOrtofoto(formato):
+    # Com formato "cog" o TIFF sai em tiles e passa pelo ConverterParaCog (sem GDAL, mantem o TIFF em tiles)
+    def Preparar(workflow, args, pasta):
+        doc = Metashape.Document(str(Path(pasta) / "projeto.psx"))
+        chunk = CriarChunk(doc)
+        return lambda: workflow.ExportarOrtofoto(chunk, str(Path(pasta) / "projeto.tif"), formato=formato)
+    return Preparar
+
+
+def CasoGerarProdutosNuvem(workflow, args, pasta):
+    # Os produtos padrao (ProdutosNuvem) a partir de um .las exportado pelo Metashape simulado
+    doc = Metashape.Document(str(Path(pasta) / "projeto.psx"))
+    chunk = CriarChunk(doc)
+    chunk.dense_cloud = Metashape.DenseCloud(args.pontos)
+    filenameLas = str(Path(pasta) / "projeto.las")
+    chunk.exportPoints(filenameLas)
+    return lambda: workflow.GerarProdutosNuvem(filenameLas, pasta, "projeto", workflow.ProdutosNuvem,
+                                               workflow.PontosPorBloco, workflow.ThreadsProdutosNuvem)
+
+
+def CasoExportarDoisChunks(workflow, args, pasta):
+    # Reexportacao de um projeto com dois chunks ja exportados: cada chunk tem os seus arquivos, entao nada e refeito
+    doc = Metashape.Document(str(Path(pasta) / "projeto.psx"))
+    chunks = [CriarChunk(doc), CriarChunk(doc)]
+    for pontos, chunk in zip([args.pontos, args.pontos // 2], chunks):
+        chunk.dense_cloud = Metashape.DenseCloud(pontos)
+    kwargs = dict(PastaDeExportacaoCaminhoCompleto=pasta, PotreeExe=str(Path(pasta) / "PotreeConverter"))
+    with redirect_stdout(io.StringIO()):
+        for chunk in chunks:
+            workflow.ExportarArtefatos(doc, chunk, **kwargs)
+    exportados = dict((nome, os.stat(os.path.join(pasta, nome)).st_mtime_ns) for nome in os.listdir(pasta))
+    if len([nome for nome in exportados if nome.endswith(".las")]) != len(chunks):
+        raise RuntimeError("OS CHUNKS EXPORTARAM PARA O MESMO ARQUIVO: %s" % sorted(exportados))
+
+    def Executar():
+        for chunk in chunks:
+            workflow.ExportarArtefatos(doc, chunk, **kwargs)
+        refeitos = [nome for nome, data in exportados.items() if os.stat(os.path.join(pasta, nome)).st_mtime_ns != data]
+        if refeitos:
+            raise RuntimeError("ARTEFATOS REEXPORTADOS SEM MUDANCA NO CHUNK: %s" % sorted(refeitos))
+    return Executar
+
+
+Casos = dict([
+    ("selecao_gradual_RU", CasoSelecaoGradual("ReduceError_RU")),
+    ("selecao_gradual_PA", CasoSelecaoGradual("ReduceError_PA")),
+    ("selecao_gradual_RE", CasoSelecaoGradual("ReduceError_RE")),
+    ("remove_disabled_photos", CasoRemoveDisabledPhotos),
+    ("verificar_depth_maps", CasoVerificarDepthMaps),
+    ("zipdir", CasoZipdir),
+    ("empacotar_pasta_web", CasoEmpacotarPastaWeb),
+    ("sirgas2000", CasoSirgas2000),
+    ("exportar_las", CasoExportarLas),
+    ("exportar_ortofoto", CasoExportarOrtofoto("tif")),
+    ("exportar_ortofoto_cog", CasoExportarOrtofoto("cog")),
+    ("gerar_produtos_nuvem", CasoGerarProdutosNuvem),
+    ("exportar_dois_chunks", CasoExportarDoisChunks),
+])
+
+
+def ExecutarCaso(workflow, nome, args):
+    # Cada repeticao prepara dados novos, ja que as funcoes alteram o chunk e os arquivos
+    tempos = []
+    for repeticao in range(args.repeticoes):
+        pasta = tempfile.mkdtemp(prefix="benchmark_")
+        try:
+            workflow.InventariosChunks.clear()
+            executar = Casos[nome](workflow, args, pasta)
+            saida = io.StringIO()
+            with redirect_stdout(saida):
+                inicio = time.perf_counter()
+                executar()
+                tempos.append(time.perf_counter() - inicio)
+        finally:
+            shutil.rmtree(pasta, ignore_errors=True)
+    return dict(segundos=tempos, minimo=min(tempos), mediana=statistics.median(tempos))
+
+
+def CommitAtual():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=str(PastaBenchmark.parent),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def Comparar(resultados, arquivo, tolerancia):
+    # Compara as medianas com um resultado anterior. Retorna o numero de regressoes
+    with open(arquivo) as entrada:
+        anteriores = json.load(entrada)['resultados']
+    regressoes = 0
+    print("\n%-26s %12s %12s %8s" % ("CASO", "ANTES (s)", "AGORA (s)", "RAZAO"))
+    for nome, resultado in resultados.items():
+        if nome not in anteriores:
+            continue
+        antes = anteriores[nome]['mediana']
+        razao = resultado['mediana'] / antes if antes else float('inf')
+        marca = ""
+        if razao > 1 + tolerancia:
+            marca = "  REGRESSAO"
+            regressoes += 1
+        print("%-26s %12.4f %12.4f %8.2f%s" % (nome, antes, resultado['mediana'], razao, marca))
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark das funcoes do main.py com um Metashape simulado")
+    parser.add_argument("--casos", nargs="*", choices=sorted(Casos), default=list(Casos))
+    parser.add_argument("--pontos", type=int, default=2000000, help="tie points da nuvem esparsa")
+    parser.add_argument("--cameras", type=int, default=5000)
+    parser.add_argument("--arquivos-web", type=int, default=2000, help="arquivos pequenos na pasta da aplicacao web")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--latencia", action="append", default=[], metavar="NOME=SEGUNDOS",
+                        help="latencias do Metashape simulado: %s" % ", ".join(sorted(Metashape.Latencias)))
+    parser.add_argument("--saida", default=str(PastaBenchmark / "resultados.json"))
+    parser.add_argument("--comparar", help="arquivo JSON de um benchmark anterior")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="aumento relativo tolerado antes de acusar regressao")
+    args = parser.parse_args()
+
+    for item in args.latencia:
+        nome, valor = item.split("=")
+        if nome not in Metashape.Latencias:
+            parser.error("LATENCIA DESCONHECIDA: %s" % nome)
+        Metashape.Latencias[nome] = float(valor)
+
+    workflow = CarregarWorkflow()
+    resultados = dict()
+    for nome in args.casos:
+        resultados[nome] = ExecutarCaso(workflow, nome, args)
+        print("%-26s mediana %10.4f s   minimo %10.4f s" % (nome, resultados[nome]['mediana'], resultados[nome]['minimo']))
+
+    relatorio = dict(data=datetime.datetime.now().isoformat(timespec='seconds'),
+                     commit=CommitAtual(),
+                     python=platform.python_version(),
+                     plataforma=platform.platform(),
+                     cpus=os.cpu_count(),
+                     parametros=dict(pontos=args.pontos, cameras=args.cameras, arquivos_web=args.arquivos_web,
+                                     repeticoes=args.repeticoes, latencias=Metashape.Latencias),
+                     resultados=resultados)
+    with open(args.saida, "w") as saida:
+        json.dump(relatorio, saida, indent=2)
+    print("RESULTADOS GRAVADOS EM %s" % args.saida)
+
+    if args.comparar and Comparar(resultados, args.comparar, args.tolerancia) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,20 @@ Este script automatiza o workflow de criacao de nuvem densa e ortofoto
 
 Para executar, abra a janela MENU SUPERIOR > VIEW > CONSOLE > Clicar no 3o botão (Run Script) > Escolher este script > OK
 
+MODO LOTE (sem interface, varios projetos):
+    python3 main.py --lote pasta_com_projetos/ outro_projeto.psx [--paralelo 2] [--memoria 64]
+    Cada projeto avanca pelas fases abaixo ate o primeiro passo manual (ou ate o fim, com LoteIgnorarPassosManuais).
+    O estado da fila fica em ArquivoFilaLote: rodando o mesmo comando de novo, o lote continua de onde parou
+
+DESFAZER A TRIAGEM (devolve as fotos movidas para FotosDescartadas as pastas de origem):
+    python3 main.py --desfazer-triagem pasta_das_fotos/FotosDescartadas/triagem.json
+
 PASSO A PASSO:
     1. Importe as fotos (Workflow > Add Photos)
     2. Desabilite todas as fotos desnecessarias (pouso, decolagem, baixa qualidade)
     3. Execute este script. (~2seg) (Calculo da qualidade das fotos e remocao das desabilitadas)
     4. Execute este script (2a vez). (~10min) (Calculo da nuvem esparsa e alinhamento das fotos)
+    5. Confira a region, ajustada automaticamente a area com boa sobreposicao de fotos (RegiaoAutomatica)
     6. Caso haja GCPs, Importe-os, faca os marks em cada foto, salve o projeto e mande realinhar:
         Reference > 1o botao > Importar txt > Ignorar GCPs que estiverem na beirada da foto
         Otimize as cameras e veja se o erro esta a niveis toleraveis. Salve o projeto
@@ -34,14 +43,29 @@ https://github.com/dobedobedo/Metashape-Workflow/blob/master/Metashape_Workflow.
 
 
 from pathlib import Path
-from subprocess import check_output
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE, STDOUT, Popen
 import Metashape
+import argparse
+import csv
 import datetime
+import functools
+import hashlib
+import html
+import json
+import math
+import numpy
 import os
+import platform
 import shutil
+import struct
 import sys
+import tarfile
+import threading
+import time
 import traceback
-import zipfile
+import zlib
 
 doc = Metashape.app.document
 
@@ -53,10 +77,30 @@ doc = Metashape.app.document
 PastaDeExportacao = "saida" #Nome da pasta irma onde os itens serao exportados
 PastaDeExportacaoCaminhoCompleto = "" #Deixe vazio para ser definido pelo programa
 PotreeExe = "/home/ma/Documents/potree-converter/PotreeConverter" #Caminho pra aplicacao de criacao de paginas web
+TimeoutPotree = 6 * 3600 #Tempo maximo em segundos para o PotreeConverter. 0 = sem limite
+FormatoPacoteWeb = "zip" #"zip", "tar", "pasta" (mantem a pasta da aplicacao web, sem compactar)
+ThreadsCompactacao = os.cpu_count() or 1 #Numero de threads usadas para compactar a aplicacao web
+ExtensoesSemCompressao = [".bin", ".laz", ".jpg", ".jpeg", ".png", ".zip", ".gz", ".br"] #Arquivos ja compactados, armazenados sem recompressao
+FormatoNuvem = "las" #"las", "laz" (comprimido), "copc" (LAZ cloud optimized, lido direto pelos visualizadores web)
+FormatoOrtofoto = "tif" #"tif" (GeoTIFF com JPEG), "cog" (Cloud Optimized GeoTIFF: tiles de 512 px e overviews internas)
+PdalExe = "pdal" #Caminho do PDAL. Converte o LAZ em COPC quando o Metashape nao exporta COPC, e a nuvem juntada dos tiles em LAZ/COPC
+GerarAplicacaoWebPotree = True #True, False. Com FormatoNuvem = "copc" a nuvem pode ser servida direto do arquivo, sem PotreeConverter
+DesejaGerarProdutosNuvem = False #True, False. Gera versoes derivadas do .las numa unica leitura, sem reexportar do Metashape (exige FormatoNuvem = "las")
+#Cada produto: nome (sufixo do arquivo), voxel (m, um ponto por celula; 0 = todos), classes (None = todas, [2] = solo) e tile
+#(m; 0 = arquivo unico, ou pasta <projeto>_<nome> com um .las por tile). Niveis de detalhe (LOD) = produtos com tile e voxels diferentes
+ProdutosNuvem = [dict(nome="10cm", voxel=0.10), dict(nome="50cm", voxel=0.50), dict(nome="solo", classes=[2]),
+                 dict(nome="lod0", voxel=2.0, tile=500), dict(nome="lod1", voxel=0.5, tile=250), dict(nome="lod2", voxel=0.1, tile=100)]
+PontosPorBloco = 1000000 #Pontos lidos do .las de cada vez. A memoria usada e proporcional a PontosPorBloco x (ThreadsProdutosNuvem + 1)
+ThreadsProdutosNuvem = min(8, os.cpu_count() or 1) #Numero de blocos processados ao mesmo tempo
+MemoriaVoxelsMB = 2048 #Memoria maxima do registro de voxels de cada produto com voxel. Acima disso os pontos sao separados em faixas gravadas em disco e filtradas uma a uma
+
+# SISTEMA DE COORDENADAS DO PROJETO
+CrsDestino = "auto" #"auto" = mantem um SIRGAS 2000 existente; os demais vao para SIRGAS 2000 / UTM da zona do centro das cameras (ex: EPSG::31983 = zona 23S). Ou um codigo como "EPSG::31982"
 
 # VARIABLES FOR IMAGE QUALITY FILTER
 QualityFilter = False #True, False
 QualityCriteria = 0.7 #float number range from 0 to 1 (default 0.5)
+CacheQualidade = True #True, False. Guarda a qualidade calculada num arquivo ao lado das fotos e so analisa fotos novas ou alteradas
 
 # VARIABLES FOR PHOTO ALIGNMENT
 # Accuracy = Metashape.Accuracy.HighAccuracy #HighestAccuracy, HighAccuracy, MediumAccuracy, LowAccuracy, LowestAccuracy
@@ -64,11 +108,20 @@ DownscaleAlignment = 1 # Highest=0 High=1 Medium=2 Low=4 Lowest=8
 Key_Limit = 40000 #Numero inteiro, geralmente 40000 pontos
 Tie_Limit = 4000 #Numero inteiro, geralmente 4000 e suficiente
 
+# REGION (AREA PROCESSADA)
+RegiaoAutomatica = True #True, False. Apos o alinhamento ajusta a region a area vista por pelo menos SobreposicaoMinimaRegiao fotos
+SobreposicaoMinimaRegiao = 3 #Fotos cobrindo cada ponto do terreno. Bordas com menos fotos (e tie points vistos em menos fotos) ficam fora
+MargemRegiao = 5 #Margem em metros em volta da area escolhida
+ArquivoAOI = "" #GeoJSON com o poligono da area de interesse, em lon/lat ou nas coordenadas do projeto. Vazio = sem AOI
+
 # VARIAVEIS PARA CONSTRUIR OS DEPTHMAP (QUE SERA, POR CONSEQUENCIA, A RESOLUCAO DO DENSE CLOUD)
 # Quality = Metashape.Quality.HighQuality #UltraQuality, HighQuality, MediumQuality, LowQuality, LowestQuality
 DownscaleDepthMaps = 2 #Ultra=1 High=2 Medium=4 Low=8 Lowest=16 (Ultra = Mesmo GSD da foto)
 FilterMode = Metashape.FilterMode.MildFiltering #AggressiveFiltering, ModerateFiltering, MildFiltering, NoFiltering
-MaxNeighbors = 30 #Default=100. Reduzir este valor caso processamento demore muito
+MaxNeighbors = 30 #Default=100. Reduzir este valor caso processamento demore muito (ou usar o PlanejadorAutomatico)
+CalibrarDepthMaps = False #True, False. Sem perfil para esta maquina, mede max_workgroup_size/workitem_size_cameras num subconjunto das cameras antes dos depthmaps
+CamerasCalibracao = 20 #Numero de cameras vizinhas usadas na calibracao
+ArquivoPerfilDepthMaps = os.path.join(os.path.expanduser("~"), ".metashape_depthmaps.json") #Limites mais rapidos por maquina. Sem perfil, usa os defaults do Metashape
 
 # VARIABLES FOR DENSE CLOUD GROUND POINT CLASSIFICATION.
 DesejaClassificarGroundPoint = False #True, False
@@ -88,20 +141,210 @@ SurfaceSource = Metashape.DataSource.DepthMapsData #PointCloudData, DenseCloudDa
 
 # VARIAVEIS PARA DEM
 DownscaleDem = 2  # 1 = mesma resolucao da nuvem de pontos (proces. demora MUITO) Geralmente 2 ou 4 é suficiente
-DesejaCriarNovoDEMSomenteComGroundPoints = False #False, True
+DesejaCriarNovoDEMSomenteComGroundPoints = False #False, True. O DEM de solo e exportado para <projeto>_dtm.tif (ver NomeDosArtefatos)
+ManterDEMSoloNoProjeto = False #False, True. True mantem o DEM de solo tambem no projeto, alem do arquivo exportado
+
+# VARIAVEIS PARA PROCESSAMENTO EM TILES (AREAS MUITO GRANDES, QUE NAO CABEM NA MEMORIA)
+ProcessamentoEmTiles = False #True, False. Divide a region em tiles, processa cada um separadamente e junta os resultados
+TamanhoTile = 500 #Tamanho do lado de cada tile, em metros
+SobreposicaoTile = 20 #Sobreposicao entre tiles vizinhos, em metros. Evita bordas sem dados na juncao
+MaxTilesEmParalelo = 1 #EXPERIMENTAL (exige ParalelismoExperimental). Numero de tiles processados ao mesmo tempo. As chamadas ao Metashape continuam uma de cada vez
+ManterChunksDosTiles = False #True, False. False apaga do projeto os chunks temporarios dos tiles apos a exportacao
+
+# VARIAVEIS PARA A TRIAGEM DAS FOTOS DESABILITADAS
+ThreadsTriagem = 8 #Numero de fotos movidas ao mesmo tempo para a pasta FotosDescartadas
+
+# VARIAVEIS PARA PROCESSAMENTO DOS CHUNKS
+ParalelismoExperimental = False #True, False. EXPERIMENTAL: libera MaxChunksEmParalelo > 1, MaxTilesEmParalelo > 1 e EtapasEmParalelo. Nao ha garantia de que a API do Metashape aceite chamadas simultaneas no mesmo projeto
+MaxChunksEmParalelo = 1 #EXPERIMENTAL (exige ParalelismoExperimental). Numero de chunks processados ao mesmo tempo. 1 = um apos o outro
+                        #As chamadas ao Metashape e os salvamentos continuam um de cada vez; sobrepoe-se o restante (PotreeConverter, compactacao, produtos da nuvem)
+EtapasEmParalelo = False #EXPERIMENTAL (exige ParalelismoExperimental). True, False. Sobrepoe etapas independentes que usam chunks diferentes (ex: DEM de solo x ortofoto)
+
+# VARIAVEIS PARA SALVAR O PROJETO
+PoliticaDeSalvamento = "etapa" #"etapa" (apos cada etapa), "longas" (apos etapas longas), "periodico" (checkpoints), "fim" (somente no final)
+MinutosEtapaLonga = 10 #Politica "longas": salva apos etapas que duraram mais que isso
+MinutosEntreSalvamentos = 30 #Politica "periodico": salva ao fim da primeira etapa apos este intervalo desde o ultimo salvamento
+
+# VARIAVEIS PARA O PLANEJADOR DE PARAMETROS
+PlanejadorAutomatico = False #True, False. Estima tempo e memoria de cada etapa e reduz os parametros de alinhamento, depthmaps e DEM ate caber nos limites abaixo
+OrcamentoHoras = 0 #Tempo maximo desejado para cada execucao do script (alinhamento ou workflow), em horas. 0 = sem limite
+LimiteMemoriaGB = 0 #Memoria maxima por etapa. 0 = 80% da RAM disponivel, dividida entre os MaxChunksEmParalelo (com ParalelismoExperimental)
+ArquivoModeloPlanejador = os.path.join(os.path.expanduser("~"), ".metashape_planejador.json") #Correcoes do modelo aprendidas a cada execucao, por maquina
+
+# VARIAVEIS PARA O MODO LOTE (LINHA DE COMANDO, VER O INICIO DESTE ARQUIVO)
+LoteMaxProjetos = 2 #Numero de projetos processados ao mesmo tempo, cada um num processo separado
+LoteMemoriaPorProjetoGB = 0 #Memoria reservada para cada projeto. 0 = memoria do lote dividida por LoteMaxProjetos
+LoteIgnorarPassosManuais = False #True, False. True segue direto do alinhamento para o workflow, sem ajuste manual da region e dos GCPs
+ArquivoFilaLote = "fila_lote.json" #Estado da fila de projetos, na pasta onde o lote e executado
+ComandoWorkerLote = [sys.executable] #Ex: ["/opt/metashape-pro/metashape.sh", "-platform", "offscreen", "-r"] para rodar os projetos no Metashape sem interface
 ################################################################################
 
 
 
 # INICIO DAS FUNCOES
 
+# Relatorio de desempenho: uma linha por etapa executada (tempo, CPU, memoria, tamanho das entradas e meta do Metashape)
+RelatorioDesempenho = []
+
+
+# Etapas medidas em andamento (id do registro -> (thread, registro)). Uma etapa que rodou ao mesmo tempo que outra,
+# em outra thread, tem o tempo de CPU do processo inteiro, e nao so o seu (cpu_exclusivo = False)
+EtapasEmAndamento = dict()
+TravaEtapasEmAndamento = threading.Lock()
+IntervaloAmostragemMemoria = 0.5 # segundos entre as amostras da memoria de cada etapa
+
+
+def MemoriaAtualMB():
+    # Memoria (RSS) atual do processo. None quando nao ha como medir nesta plataforma
+    try:
+        with open("/proc/self/statm") as arquivo:
+            return round(int(arquivo.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0, 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().rss / 1024.0 / 1024.0, 1)
+    except ImportError:
+        return None
+
+
+def AmostrarMemoria():
+    # Amostra a RSS do processo numa thread, a cada IntervaloAmostragemMemoria. Retorna a funcao que encerra a
+    # amostragem e devolve o maior valor amostrado (MB), ou None quando nao ha como medir
+    pico = [MemoriaAtualMB()]
+    if pico[0] is None:
+        return lambda: None
+    parar = threading.Event()
+
+    def Amostrar():
+        while not parar.wait(IntervaloAmostragemMemoria):
+            pico[0] = max(pico[0], MemoriaAtualMB() or 0)
+
+    amostrador = threading.Thread(target=Amostrar, daemon=True)
+    amostrador.start()
+
+    def Encerrar():
+        parar.set()
+        amostrador.join()
+        pico[0] = max(pico[0], MemoriaAtualMB() or 0)
+        return pico[0]
+    return Encerrar
+
+
+def PicoDeMemoriaMB():
+    # Pico de memoria (RSS) do processo desde o seu inicio (cumulativo, nao e o pico de uma etapa). None quando nao ha como medir
+    try:
+        import resource
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico / 1024.0 if sys.platform != 'darwin' else pico / 1024.0 / 1024.0
+    except ImportError:
+        pass
+    try:
+        import psutil
+        memoria = psutil.Process().memory_info()
+        return getattr(memoria, 'peak_wset', memoria.rss) / 1024.0 / 1024.0
+    except ImportError:
+        return None
+
+
+def MetaDoProduto(chunk, produto):
+    objeto = getattr(chunk, produto, None) if produto else None
+    if objeto is None or getattr(objeto, 'meta', None) is None:
+        return {}
+    return dict((chave, valor) for chave, valor in objeto.meta.items())
+
+
+def MedirEtapa(produto=None):
+    # Decorator que registra em RelatorioDesempenho cada chamada da etapa. O primeiro argumento da funcao e o
+    # chunk (ou o documento). produto e o item do chunk (point_cloud, dense_cloud, ...) cujo meta e registrado
+    def Decorator(funcao):
+        @functools.wraps(funcao)
+        def Medida(*args, **kwargs):
+            chunk = args[0] if args and hasattr(args[0], 'cameras') else None
+            registro = dict(etapa=funcao.__name__, chunk=chunk.label if chunk is not None else getattr(ContextoChunk, 'label', None),
+                            inicio=Agora())
+            with TravaEtapasEmAndamento:
+                # etapas de outras threads rodando agora: o tempo de CPU de nenhuma delas e exclusivo
+                simultaneas = [outro for thread, outro in EtapasEmAndamento.values() if thread != threading.get_ident()]
+                for outro in simultaneas:
+                    outro['cpu_exclusivo'] = False
+                registro['cpu_exclusivo'] = not simultaneas
+                EtapasEmAndamento[id(registro)] = (threading.get_ident(), registro)
+            registro['rss_inicio_mb'] = MemoriaAtualMB()
+            EncerrarAmostragem = AmostrarMemoria()
+            inicio, cpu = time.time(), time.process_time()
+            try:
+                resultado = funcao(*args, **kwargs)
+                registro['status'] = 'ok'
+                return resultado
+            except Exception:
+                registro['status'] = 'erro'
+                raise
+            finally:
+                registro['tempo_s'] = round(time.time() - inicio, 3)
+                registro['cpu_s'] = round(time.process_time() - cpu, 3) # do processo: inclui as threads do proprio Metashape
+                registro['pico_rss_mb'] = EncerrarAmostragem() # pico amostrado durante a etapa
+                registro['rss_fim_mb'] = MemoriaAtualMB()
+                registro['pico_processo_mb'] = PicoDeMemoriaMB()
+                with TravaEtapasEmAndamento:
+                    del EtapasEmAndamento[id(registro)]
+                if chunk is not None:
+                    registro['cameras'] = len(chunk.cameras)
+                    registro['tie_points'] = len(chunk.point_cloud.points) if chunk.point_cloud is not None else 0
+                    registro['pontos_densos'] = chunk.dense_cloud.point_count if chunk.dense_cloud is not None else 0
+                    registro['meta'] = MetaDoProduto(chunk, produto)
+                RelatorioDesempenho.append(registro)
+        return Medida
+    return Decorator
+
+
+def SerializarNoDocumento(funcao):
+    # Decorator das funcoes que alteram o projeto pela API do Metashape. Nada garante que o Metashape aceite chamadas
+    # simultaneas em chunks do mesmo Document: com chunks ou etapas em paralelo elas rodam uma de cada vez (TravaDocumento)
+    @functools.wraps(funcao)
+    def Serializada(*args, **kwargs):
+        with TravaDocumento:
+            return funcao(*args, **kwargs)
+    return Serializada
+
+
+def GravarRelatorioDesempenho(pasta, nome):
+    # Grava o relatorio da execucao em JSON e CSV. Retorna o caminho do JSON
+    if not RelatorioDesempenho:
+        return None
+    base = str(Path(pasta) / ("%s_desempenho_%s" % (nome, datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))))
+    with open(base + ".json", "w") as arquivo:
+        json.dump(RelatorioDesempenho, arquivo, indent=2, default=str)
+    colunas = ['etapa', 'chunk', 'inicio', 'status', 'tempo_s', 'cpu_s', 'cpu_exclusivo', 'rss_inicio_mb', 'rss_fim_mb', 'pico_rss_mb',
+               'pico_processo_mb', 'cameras', 'tie_points', 'pontos_densos']
+    with open(base + ".csv", "w", newline='') as arquivo:
+        escritor = csv.DictWriter(arquivo, fieldnames=colunas, extrasaction='ignore')
+        escritor.writeheader()
+        escritor.writerows(RelatorioDesempenho)
+    return base + ".json"
+
+
+@SerializarNoDocumento
+@MedirEtapa('point_cloud')
 def AlignPhoto(chunk, DownscaleAlignment, Key_Limit, Tie_Limit, QualityFilter, QualityCriteria):
     if QualityFilter:
-        if chunk.cameras[0].meta['Image/Quality'] is None:
-            chunk.analyzePhotos() # chunk.estimateImageQuality()
-        for band in [band for camera in chunk.cameras for band in camera.planes]:
-            if float(band.meta['Image/Quality']) < QualityCriteria:
-                band.enabled = False
+        inventario = InventarioDoChunk(chunk)
+        if CacheQualidade:
+            qualidade = QualidadeDasFotos(chunk)
+        else:
+            if len(inventario['qualidade']) < len(inventario['cameras']):
+                chunk.analyzePhotos() # chunk.estimateImageQuality()
+                InvalidarInventario(chunk)
+                inventario = InventarioDoChunk(chunk)
+            qualidade = inventario['qualidade']
+        descartadas = 0
+        for key, notas in qualidade.items():
+            for band, nota in zip(inventario['cameras'][key].planes, notas):
+                if nota < QualityCriteria:
+                    band.enabled = False
+                    descartadas += 1
+        InvalidarInventario(chunk)
+        RelatarFiltroDeQualidade(qualidade, descartadas, QualityCriteria)
     chunk.matchPhotos(downscale=DownscaleAlignment,
                       generic_preselection=True,
                       reference_preselection=True,
@@ -115,22 +358,208 @@ def AlignPhoto(chunk, DownscaleAlignment, Key_Limit, Tie_Limit, QualityFilter, Q
                           adaptive_fitting=False, tiepoint_covariance=False)
 
 
-def ConstruirDepthMaps(chunk, DownscaleDepthMaps, FilterMode, MaxNeighbors):
-    print("DEBUG: DownscaleDepthMaps:%d, MaxNeighbors:%d, " % (DownscaleDepthMaps, MaxNeighbors))
-    # TODO incluir limites de performance. max_workgroup_size workitem_size_cameras
-    chunk.buildDepthMaps(downscale=DownscaleDepthMaps, filter_mode=FilterMode, reuse_depth=True, max_neighbors=MaxNeighbors)
+# Cache da qualidade das fotos, gravado em cada pasta de fotos. Para cada foto guarda tamanho, data de
+# modificacao (ns) e a nota de cada banda: {"IMG_0001.JPG": [tamanho, mtime_ns, [nota, ...]], ...}
+ArquivoCacheQualidade = ".qualidade_fotos.json"
+
+
+def LerCacheQualidade(pasta):
+    caminho = Path(pasta) / ArquivoCacheQualidade
+    if not caminho.exists():
+        return {}
+    try:
+        with open(str(caminho)) as arquivo:
+            return json.load(arquivo)
+    except ValueError:
+        return {} # cache corrompido: as fotos sao analisadas de novo
+
+
+def GravarCacheQualidade(pasta, cache):
+    caminho = str(Path(pasta) / ArquivoCacheQualidade)
+    try:
+        with open(caminho + ".tmp", "w") as arquivo:
+            json.dump(cache, arquivo, separators=(',', ':'))
+        os.replace(caminho + ".tmp", caminho)
+    except OSError:
+        print("NAO FOI POSSIVEL GRAVAR O CACHE DE QUALIDADE EM %s" % pasta)
+
 
+def QualidadeDasFotos(chunk, threads=16):
+    # Nota de qualidade de cada camera (key -> nota de cada banda). Usa o cache ao lado das fotos e roda o
+    # analyzePhotos somente nas fotos novas ou alteradas. As notas do cache sao aplicadas ao meta das bandas
+    inventario = InventarioDoChunk(chunk)
 
+    def Assinatura(camera):
+        try:
+            status = os.stat(camera.photo.path)
+            return status.st_size, status.st_mtime_ns
+        except OSError:
+            return None
+
+    # o stat das fotos (muitas vezes num NAS) roda em paralelo
+    cameras = list(inventario['cameras'].values())
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        assinaturas = dict(zip([camera.key for camera in cameras], executor.map(Assinatura, cameras)))
+
+    caches = dict()
+    alterados = set()
+    qualidade = dict()
+    faltando = []
+    for camera in cameras:
+        pasta, nome = os.path.split(camera.photo.path)
+        if pasta not in caches:
+            caches[pasta] = LerCacheQualidade(pasta)
+        cache = caches[pasta]
+        assinatura = assinaturas[camera.key]
+        entrada = cache.get(nome)
+        if assinatura is not None and entrada is not None and tuple(entrada[:2]) == assinatura and len(entrada[2]) == len(camera.planes):
+            qualidade[camera.key] = entrada[2]
+            if camera.key not in inventario['qualidade']:
+                for band, nota in zip(camera.planes, entrada[2]):
+                    band.meta['Image/Quality'] = str(nota)
+        elif camera.key in inventario['qualidade']:
+            # ja avaliada no projeto, mas fora do cache
+            qualidade[camera.key] = inventario['qualidade'][camera.key]
+            if assinatura is not None:
+                cache[nome] = list(assinatura) + [qualidade[camera.key]]
+                alterados.add(pasta)
+        else:
+            faltando.append(camera)
+    printNovaAtividade("QUALIDADE DAS FOTOS: %d NO CACHE, %d A ANALISAR" % (len(qualidade), len(faltando)))
+    if faltando:
+        chunk.analyzePhotos(cameras=faltando)
+        for camera in faltando:
+            notas = [band.meta['Image/Quality'] for band in camera.planes]
+            if None in notas:
+                continue
+            qualidade[camera.key] = [float(nota) for nota in notas]
+            pasta, nome = os.path.split(camera.photo.path)
+            if assinaturas[camera.key] is not None:
+                caches[pasta][nome] = list(assinaturas[camera.key]) + [qualidade[camera.key]]
+                alterados.add(pasta)
+    for pasta in alterados:
+        GravarCacheQualidade(pasta, caches[pasta])
+    InvalidarInventario(chunk)
+    return qualidade
+
+
+def RelatarFiltroDeQualidade(qualidade, descartadas, criterio):
+    notas = numpy.array([nota for notas in qualidade.values() for nota in notas])
+    msg = "FILTRO DE QUALIDADE (MINIMO %.2f): %d DE %d BANDAS DESABILITADAS" % (criterio, descartadas, len(notas))
+    if len(notas):
+        contagem, limites = numpy.histogram(notas, bins=10, range=(0.0, 1.0))
+        msg += "\nHISTOGRAMA DAS NOTAS:"
+        for n, inicio, fim in zip(contagem, limites[:-1], limites[1:]):
+            msg += "\n%.1f - %.1f %6d %s" % (inicio, fim, n, "#" * int(round(50.0 * n / max(contagem.max(), 1))))
+    printNovaAtividade(msg)
+
+
+@SerializarNoDocumento
+@MedirEtapa('depth_maps')
+def ConstruirDepthMaps(chunk, DownscaleDepthMaps, FilterMode, MaxNeighbors, cameras=None):
+    # cameras: keys das cameras processadas. None = todas
+    limites = LimitesDepthMaps(DownscaleDepthMaps)
+    print("DEBUG: DownscaleDepthMaps:%d, MaxNeighbors:%d, Limites:%s" % (DownscaleDepthMaps, MaxNeighbors, limites or "default"))
+    opcoes = dict(limites, cameras=cameras) if cameras is not None else limites
+    chunk.buildDepthMaps(downscale=DownscaleDepthMaps, filter_mode=FilterMode, reuse_depth=True, max_neighbors=MaxNeighbors, **opcoes)
+    InvalidarInventario(chunk)
+
+
+# Combinacoes (max_workgroup_size, workitem_size_cameras) testadas na calibracao. O default do Metashape e (100, 20)
+CombinacoesCalibracao = [(100, 20), (50, 10), (50, 20), (100, 10), (100, 40), (200, 20), (200, 40), (400, 40)]
+TravaCalibracao = threading.Lock()
+
+
+def LerPerfilDepthMaps():
+    # {maquina: {downscale: {"max_workgroup_size": n, "workitem_size_cameras": n, "tempos": {...}}}}
+    if not Path(ArquivoPerfilDepthMaps).exists():
+        return {}
+    try:
+        with open(ArquivoPerfilDepthMaps) as arquivo:
+            return json.load(arquivo)
+    except ValueError:
+        return {}
+
+
+def LimitesDepthMaps(DownscaleDepthMaps):
+    # Limites calibrados para esta maquina e downscale, prontos para o buildDepthMaps. {} = defaults do Metashape
+    perfil = LerPerfilDepthMaps().get(platform.node(), {}).get(str(DownscaleDepthMaps))
+    if not perfil:
+        return {}
+    return dict(max_workgroup_size=perfil['max_workgroup_size'], workitem_size_cameras=perfil['workitem_size_cameras'])
+
+
+def CamerasVizinhas(chunk, quantidade):
+    # Camera alinhada mais proxima do centro do bloco e as suas vizinhas: um subconjunto com sobreposicao real entre as fotos
+    cameras = [camera for camera in chunk.cameras if camera.enabled and camera.transform is not None]
+    if len(cameras) <= quantidade:
+        return cameras
+    centros = numpy.array([list(camera.center) for camera in cameras])
+    central = centros[numpy.argmin(numpy.linalg.norm(centros - numpy.median(centros, axis=0), axis=1))]
+    return [cameras[i] for i in numpy.argsort(numpy.linalg.norm(centros - central, axis=1))[:quantidade]]
+
+
+@SerializarNoDocumento
+@MedirEtapa()
+def CalibrarLimitesDepthMaps(doc, chunk, DownscaleDepthMaps, FilterMode, MaxNeighbors):
+    # Mede cada combinacao de CombinacoesCalibracao num chunk temporario (copia do alinhamento, sem depth maps)
+    # e grava a mais rapida no perfil da maquina. Uma calibracao por vez, para que uma nao atrapalhe a medida da outra
+    with TravaCalibracao:
+        if LimitesDepthMaps(DownscaleDepthMaps):
+            return # outro chunk calibrou enquanto este esperava
+        with TravaDocumento:
+            calibracao = chunk.copy(items=[])
+            calibracao.label = chunk.label + "_calibracao"
+        try:
+            cameras = [camera.key for camera in CamerasVizinhas(calibracao, CamerasCalibracao)] # keys, como em ConstruirDepthMaps
+            printNovaAtividade("CALIBRANDO OS LIMITES DOS DEPTHMAPS EM %d CAMERAS (%d COMBINACOES)" % (len(cameras), len(CombinacoesCalibracao)))
+            tempos = dict()
+            # a primeira rodada so aquece o cache de disco das fotos e nao entra na comparacao
+            for indice, (workgroup, workitem) in enumerate(CombinacoesCalibracao[:1] + CombinacoesCalibracao):
+                inicio = time.time()
+                calibracao.buildDepthMaps(downscale=DownscaleDepthMaps, filter_mode=FilterMode, cameras=cameras, reuse_depth=False,
+                                          max_neighbors=MaxNeighbors, max_workgroup_size=workgroup, workitem_size_cameras=workitem)
+                if indice > 0:
+                    tempos["%d/%d" % (workgroup, workitem)] = time.time() - inicio
+                    print("%sWORKGROUP %4d  WORKITEM %3d  %8.1f s" % (PrefixoChunk(), workgroup, workitem, tempos["%d/%d" % (workgroup, workitem)]))
+        finally:
+            with TravaDocumento:
+                doc.remove([calibracao])
+        workgroup, workitem = [int(valor) for valor in min(tempos, key=tempos.get).split("/")]
+        with TravaDocumento:
+            perfil = LerPerfilDepthMaps()
+            perfil.setdefault(platform.node(), {})[str(DownscaleDepthMaps)] = dict(
+                max_workgroup_size=workgroup, workitem_size_cameras=workitem, cameras=len(cameras), data=Agora(),
+                tempos=dict((chave, round(valor, 2)) for chave, valor in tempos.items()))
+            with open(ArquivoPerfilDepthMaps + ".tmp", "w") as arquivo:
+                json.dump(perfil, arquivo, indent=2)
+            os.replace(ArquivoPerfilDepthMaps + ".tmp", ArquivoPerfilDepthMaps)
+        padrao = tempos.get("%d/%d" % CombinacoesCalibracao[0])
+        printNovaAtividade("LIMITES DOS DEPTHMAPS: WORKGROUP %d  WORKITEM %d (%.1f s x %.1f s COM O DEFAULT)\nPERFIL GRAVADO EM %s"
+                           % (workgroup, workitem, tempos["%d/%d" % (workgroup, workitem)], padrao, ArquivoPerfilDepthMaps))
+
+
+def PrepararDepthMaps(doc, chunk, DownscaleDepthMaps, FilterMode, MaxNeighbors):
+    if CalibrarDepthMaps and not LimitesDepthMaps(DownscaleDepthMaps):
+        CalibrarLimitesDepthMaps(doc, chunk, DownscaleDepthMaps, FilterMode, MaxNeighbors)
+
+
+@SerializarNoDocumento
+@MedirEtapa('dense_cloud')
 def ConstruirNuvemDensa(chunk, MaxNeighbors):
     VerificarSeTodasAsFotosPossuemDepthMap(chunk)
     chunk.buildDenseCloud(point_colors=True, max_neighbors=MaxNeighbors)
 
 
+@SerializarNoDocumento
+@MedirEtapa('dense_cloud')
 def ClassificarPontosDeSolo(chunk, Max_Angle, Max_Distance, Cell_Size):
     # DEM_resolution, Image_resolution = GetResolution(chunk)
     chunk.dense_cloud.classifyGroundPoints(max_angle=Max_Angle, max_distance=Max_Distance, cell_size=Cell_Size)
 
 
+@SerializarNoDocumento
+@MedirEtapa('model')
 def BuildModel(chunk):
     try:
         chunk.buildModel(surface=Surface,
@@ -146,6 +575,8 @@ def BuildModel(chunk):
                          vertex_colors=True)
 
 
+@SerializarNoDocumento
+@MedirEtapa('elevation')
 def CalcularDSM(chunk, resolucao):
     # parte da funcao GetResolution
     try:
@@ -159,20 +590,96 @@ def CalcularDSM(chunk, resolucao):
                        resolution = resolucao)
 
 
+@SerializarNoDocumento
+@MedirEtapa()
 def CalcularDEM(chunk, resolucao):
+    # As classes dos pontos estao na nuvem densa, por isso ela e a fonte do DEM de solo
     try:
-        chunk.buildDem(source_data=Metashape.DataSource.DepthMapsData,
+        chunk.buildDem(source_data=Metashape.DataSource.DenseCloudData,
                        interpolation=Metashape.Interpolation.EnabledInterpolation,
                        projection = chunk.crs,
                        classes=[Metashape.PointClass.Ground],
                        resolution = resolucao)
     except:
-        chunk.buildDem(source_data=Metashape.DataSource.DepthMapsData,
+        chunk.buildDem(source_data=Metashape.DataSource.DenseCloudData,
                        interpolation=Metashape.Interpolation.EnabledInterpolation,
                        classes=[Metashape.PointClass.Ground],
                        resolution = resolucao)
 
 
+@SerializarNoDocumento
+@MedirEtapa()
+def ExportarDEM(chunk, destino):
+    my_projection = Metashape.OrthoProjection()
+    my_projection.crs = chunk.crs
+    chunk.exportRaster(path=destino, source_data=Metashape.DataSource.ElevationData,
+                       image_format=Metashape.ImageFormat.ImageFormatTIFF, projection=my_projection,
+                       nodata_value=-32767, save_world=False, save_scheme=False)
+
+
+def TamanhoNoProjeto(doc, chunk, item):
+    # Espaco ocupado por um item do chunk (pasta 'depth_maps', 'dense_cloud', ...) na pasta .files do projeto (bytes)
+    total = 0
+    pasta = Path(os.path.splitext(doc.path)[0] + ".files") / str(chunk.key)
+    for root, dirs, files in os.walk(str(pasta)):
+        if item in Path(root).parts:
+            total += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+    return total
+
+
+@SerializarNoDocumento
+def CalcularDTM(doc, chunk, resolucao, destino, manter_no_projeto=False):
+    # DEM somente com os ground points, exportado direto para GeoTIFF. Substitui a copia do chunk inteiro
+    # (com os depth maps) que era feita so para ter um segundo DEM no projeto
+    inicio = time.time()
+    copiado = 0 # bytes da copia temporaria (somente no Metashape 1.6)
+    if hasattr(chunk, 'elevations'):
+        # Metashape 1.7+: o chunk guarda varios DEMs, que compartilham cameras, nuvem densa e depth maps
+        dsm = chunk.elevation
+        quantidade = len(chunk.elevations)
+        chunk.elevation = None # sem DEM padrao, o buildDem cria um DEM novo em vez de substituir o DSM
+        try:
+            CalcularDEM(chunk, resolucao)
+            dtm = chunk.elevation
+            ExportarDEM(chunk, destino)
+            if len(chunk.elevations) <= quantidade:
+                # o DEM de solo substituiu um DEM existente: nada e removido, para nao apagar o unico DEM do chunk
+                printNovaAtividade("ATENCAO: O DEM DE SOLO NAO FOI CRIADO COMO UM DEM NOVO\nNENHUM DEM FOI REMOVIDO DO PROJETO")
+            elif manter_no_projeto:
+                dtm.label = "DTM (ground points)"
+            else:
+                chunk.remove([dtm])
+        finally:
+            # mesmo com erro, o DSM volta a ser o DEM usado pela ortofoto (e o que e salvo no projeto)
+            if dsm is not None and any(dem.key == dsm.key for dem in chunk.elevations):
+                chunk.elevation = dsm
+    else:
+        # Metashape 1.6: um DEM por chunk. A copia temporaria leva somente a nuvem densa, sem os depth maps
+        with TravaDocumento:
+            new_chunk = chunk.copy(items=[Metashape.DataSource.DenseCloudData])
+            new_chunk.label = chunk.label + '_DEM'
+        concluido = False
+        try:
+            CalcularDEM(new_chunk, resolucao)
+            ExportarDEM(new_chunk, destino)
+            concluido = True
+        finally:
+            # com erro a copia sempre sai do projeto, para nao ser salva pela PoliticaDeSalvamento
+            if not (concluido and manter_no_projeto):
+                with TravaDocumento:
+                    doc.remove([new_chunk])
+            doc.chunk = chunk # Change the active chunk back
+        copiado = TamanhoNoProjeto(doc, chunk, 'dense_cloud')
+    salvamentos = [registro['tempo_s'] for registro in RelatorioDesempenho if registro['etapa'] == 'SalvarDocumento']
+    depth_maps = TamanhoNoProjeto(doc, chunk, 'depth_maps')
+    printNovaAtividade("DEM DE SOLO EXPORTADO EM \n%s\nTEMPO: %s\nESPACO EM DISCO: %.2f GB DE DEPTH MAPS NAO COPIADOS, %.2f GB DE NUVEM DENSA COPIADOS, ECONOMIA LIQUIDA DE %.2f GB"
+                       "\nTEMPO ECONOMIZADO (UM SALVAMENTO A MENOS): ~%.0f s" \
+            % (destino, datetime.timedelta(seconds=int(time.time() - inicio)), depth_maps / 1e9, copiado / 1e9, (depth_maps - copiado) / 1e9,
+               sum(salvamentos) / len(salvamentos) if salvamentos else 0))
+
+
+@SerializarNoDocumento
+@MedirEtapa('orthomosaic')
 def BuildMosaic(chunk, BlendingMode):
     try:
         chunk.buildOrthomosaic(surface_data=Metashape.DataSource.ElevationData,
@@ -188,248 +695,1628 @@ def BuildMosaic(chunk, BlendingMode):
                                fill_holes=True)
 
 
-def DefinirPastaDeExportacao():
+def DefinirPastaDeExportacao(doc):
     global PastaDeExportacaoCaminhoCompleto
     global PastaDeExportacao
-    if PastaDeExportacaoCaminhoCompleto == "":
-        project_path = Path(Metashape.app.document.path)
-        if (project_path.parent / PastaDeExportacao).exists():
-            PastaDeExportacaoCaminhoCompleto = str(project_path.parent / PastaDeExportacao) #parent
-        elif (project_path.parent.parent / PastaDeExportacao).exists():
-            PastaDeExportacaoCaminhoCompleto = str(project_path.parent.parent / PastaDeExportacao) #grandparent
-        else:
-            #PastaDeExportacao nao existe, entao cria uma
-            PastaDeExportacaoCaminhoCompleto = str(project_path.parent.parent / PastaDeExportacao)
-            Path(PastaDeExportacaoCaminhoCompleto).mkdir()
+    with TravaDocumento: # a pasta e compartilhada entre os chunks processados em paralelo
+        if PastaDeExportacaoCaminhoCompleto == "":
+            project_path = Path(doc.path)
+            if (project_path.parent / PastaDeExportacao).exists():
+                PastaDeExportacaoCaminhoCompleto = str(project_path.parent / PastaDeExportacao) #parent
+            elif (project_path.parent.parent / PastaDeExportacao).exists():
+                PastaDeExportacaoCaminhoCompleto = str(project_path.parent.parent / PastaDeExportacao) #grandparent
+            else:
+                #PastaDeExportacao nao existe, entao cria uma
+                PastaDeExportacaoCaminhoCompleto = str(project_path.parent.parent / PastaDeExportacao)
+                Path(PastaDeExportacaoCaminhoCompleto).mkdir()
     if not Path(PastaDeExportacaoCaminhoCompleto).exists():
         raise RuntimeError('PASTA %s NAO EXISTE. EDITE ESTE SCRIPT E DEIXE ASSIM: PastaDeExportacaoCaminhoCompleto = ""' % PastaDeExportacaoCaminhoCompleto)
     printNovaAtividade("PASTA DE EXPORTACAO FOI DEFINIDA EM: %s" % PastaDeExportacaoCaminhoCompleto)
 
 def printNovaAtividade(msg):
-    msg = "\n################################################################################\n" + msg + "\n################################################################################"
+    msg = "\n################################################################################\n" + PrefixoChunk() + msg + "\n################################################################################"
     print(msg)
 
 
+# Estado compartilhado entre os chunks processados em paralelo. Salvar o documento, criar a pasta de exportacao e
+# todas as chamadas que alteram o projeto (SerializarNoDocumento) sao serializados.
+TravaDocumento = threading.RLock()
+ContextoChunk = threading.local()
 
 
-def StandardWorkflow(doc, chunk, **kwargs):
-    if chunk.depth_maps is None:
-        mensagemDepthMaps = "CALCULANDO DEPTHMAPS... (Downscale:%d  Filter:%s  MaxNeighbors:%s)" % (kwargs['DownscaleDepthMaps'], kwargs['FilterMode'], kwargs['MaxNeighbors'])
-        printNovaAtividade(mensagemDepthMaps)
-        # printNovaAtividade("CALCULANDO DEPTHMAPS...")
-        ConstruirDepthMaps(chunk, kwargs['DownscaleDepthMaps'], kwargs['FilterMode'], kwargs['MaxNeighbors'])
-        doc.save()
+def PrefixoChunk():
+    # Identifica nas mensagens o chunk processado pela thread atual
+    label = getattr(ContextoChunk, 'label', None)
+    return "[%s] " % label if label is not None else ""
 
-    if chunk.dense_cloud is None:
-        mensagemDenseCloud = "CALCULANDO DENSECLOUD... (MaxNeighbors:%s)" % (kwargs['MaxNeighbors'])
-        printNovaAtividade(mensagemDenseCloud)
-        # printNovaAtividade("CALCULANDO NUVEM DENSA DE PONTOS...")
-        ConstruirNuvemDensa(chunk, kwargs['MaxNeighbors'])
-        doc.save()
 
-    if DesejaClassificarGroundPoint and chunk.dense_cloud.meta['ClassifyGroundPoints/ram_used'] is None:
-        mensagemGroundPoint = "CALCULANDO GROUNDPOINTS... (Angle:%d  Cell:%d  MaxDist:%.2f)" \
-                % (kwargs['Max_Angle'], kwargs['Cell_Size'], kwargs['Max_Distance'])
-        printNovaAtividade(mensagemGroundPoint)
-        # printNovaAtividade("CLASSIFICANDO GROUND POINTS..." + )
-        ClassificarPontosDeSolo(chunk, kwargs['Max_Angle'], kwargs['Cell_Size'], kwargs['Max_Distance'])
+# Etapas executadas mas ainda nao salvas no projeto: (chunk, nome da etapa). So viram 'concluida' no manifesto apos salvar
+EtapasNaoSalvas = []
+UltimoSalvamento = [time.time()]
+
+
+def BytesGravados(doc, desde, chunks):
+    # Soma dos arquivos modificados a partir de desde (timestamp): o .psx, os arquivos da raiz da pasta .files e as
+    # pastas somente dos chunks cujas etapas foram salvas. Percorrer a pasta .files inteira custaria, em projetos
+    # grandes num NAS, centenas de milhares de stat a cada salvamento
+    pasta = os.path.splitext(doc.path)[0] + ".files"
+    arquivos = [doc.path]
+    try:
+        arquivos += [entrada.path for entrada in os.scandir(pasta) if entrada.is_file()]
+    except OSError:
+        pass
+    for key in sorted(set(str(chunk.key) for chunk in chunks)):
+        arquivos += [os.path.join(root, file) for root, dirs, files in os.walk(os.path.join(pasta, key)) for file in files]
+    total = 0
+    for arquivo in arquivos:
+        try:
+            status = os.stat(arquivo)
+        except OSError:
+            continue
+        if status.st_mtime >= desde - 1:
+            total += status.st_size
+    return total
+
+
+@MedirEtapa()
+def SalvarDocumento(doc):
+    with TravaDocumento:
+        inicio = time.time()
+        doc.save()
+        UltimoSalvamento[0] = time.time()
+        salvas = list(EtapasNaoSalvas)
+        del EtapasNaoSalvas[:]
+    print("%sPROJETO SALVO EM %.1f s (%.1f MB GRAVADOS)" % (PrefixoChunk(), UltimoSalvamento[0] - inicio, BytesGravados(doc, inicio, [chunk for chunk, nome in salvas]) / 1e6))
+    for chunk, nome in salvas:
+        RegistrarEtapa(doc, chunk, nome, status='concluida')
+
+
+def SalvarAposEtapa(doc, duracao):
+    # Aplica a PoliticaDeSalvamento ao fim de uma etapa que durou duracao segundos
+    if PoliticaDeSalvamento == "etapa" \
+            or (PoliticaDeSalvamento == "longas" and duracao >= MinutosEtapaLonga * 60) \
+            or (PoliticaDeSalvamento == "periodico" and time.time() - UltimoSalvamento[0] >= MinutosEntreSalvamentos * 60):
+        SalvarDocumento(doc)
+
+
+def SalvarPendentes(doc):
+    if EtapasNaoSalvas:
+        SalvarDocumento(doc)
+
+
+def CaminhoManifesto(doc):
+    # Manifesto das etapas, salvo ao lado do projeto (.psx)
+    return os.path.splitext(doc.path)[0] + "_etapas.json"
+
+
+def LerManifesto(doc, chunk):
+    caminho = CaminhoManifesto(doc)
+    with TravaDocumento:
+        if not Path(caminho).exists():
+            return {}
+        with open(caminho) as arquivo:
+            return json.load(arquivo).get(str(chunk.key), {})
+
+
+def RegistrarEtapa(doc, chunk, nome, **campos):
+    # Atualiza o registro da etapa no manifesto. A escrita e atomica para nao corromper o arquivo num crash
+    caminho = CaminhoManifesto(doc)
+    with TravaDocumento:
+        manifesto = {}
+        if Path(caminho).exists():
+            with open(caminho) as arquivo:
+                manifesto = json.load(arquivo)
+        registro = manifesto.setdefault(str(chunk.key), {}).setdefault(nome, {})
+        registro.update(campos)
+        registro['chunk'] = chunk.label
+        with open(caminho + ".tmp", "w") as arquivo:
+            json.dump(manifesto, arquivo, indent=2)
+        os.replace(caminho + ".tmp", caminho)
+
+
+def Agora():
+    return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S') # isoformat(timespec=...) nao existe no Python 3.5 do Metashape 1.6
+
+
+def EtapasDoWorkflow(doc, chunk, **kwargs):
+    # Grafo de etapas do StandardWorkflow. Cada etapa possui:
+    #   depende:    etapas que precisam terminar antes desta
+    #   habilitada: False quando desligada pelas variaveis do usuario (conta como satisfeita para as dependentes)
+    #   concluida:  verifica se o produto da etapa esta no chunk
+    #   legado:     verificacao usada quando o manifesto nao tem registro da etapa (projetos antigos)
+    #   recurso:    etapas com recursos diferentes podem ser sobrepostas (EtapasEmParalelo)
+    def ChunkDEM():
+        for outro in doc.chunks:
+            if outro.label == chunk.label + '_DEM' and outro.elevation is not None:
+                return outro
+        return None
+
+    def Solo():
+        ClassificarPontosDeSolo(chunk, Max_Angle=kwargs['Max_Angle'], Max_Distance=kwargs['Max_Distance'], Cell_Size=kwargs['Cell_Size'])
         printNovaAtividade("REMOVENDO PONTOS ABAIXO DO SOLO (LOW POINTS)...")
         RemoveLowPoint(chunk)
-        doc.save()
 
-    if DesejaCalcularSurface and chunk.model is None:
-        printNovaAtividade("CALCULANDO MESH...")
-        BuildModel(chunk)
-        doc.save()
+    DownscaleDemChunk = kwargs.get('DownscaleDem', DownscaleDem)
+
+    def DepthMaps():
+        PrepararDepthMaps(doc, chunk, kwargs['DownscaleDepthMaps'], kwargs['FilterMode'], kwargs['MaxNeighbors'])
+        ConstruirDepthMaps(chunk, kwargs['DownscaleDepthMaps'], kwargs['FilterMode'], kwargs['MaxNeighbors'])
 
-    if chunk.elevation is None:
-        printNovaAtividade("CALCULANDO DSM (INCLUI CONSTRUCOES, ARVORES, ETC)")
-        resolutionDSM = float(chunk.dense_cloud.meta['BuildDenseCloud/resolution']) * chunk.transform.scale * DownscaleDem
+    def DSM():
+        resolutionDSM = ResolucaoDEM(chunk, DownscaleDemChunk)
         print("DEBUG:     RESOLUCAO: %.8f" % (resolutionDSM))
         CalcularDSM(chunk, resolutionDSM)
-        doc.save()
 
-    if DesejaCriarNovoDEMSomenteComGroundPoints:
-        printNovaAtividade("CALCULANDO DEM (SOMENTE GROUND POINTS)")
-        # Because each chunk can only contain one elevation data Therefore, we need to duplicate
-        resolutionDEM = float(chunk.dense_cloud.meta['BuildDenseCloud/resolution']) * chunk.transform.scale * DownscaleDem
-        new_chunk = chunk.copy(items=[Metashape.DataSource.DepthMapsData])
-        new_chunk.label = chunk.label + '_DEM'
-        doc.save()
-        CalcularDEM(new_chunk, resolutionDEM)
-        doc.save()
-        doc.chunk = chunk # Change the active chunk back
+    filenameDTM = str(Path(kwargs['PastaDeExportacaoCaminhoCompleto']) / (NomeDosArtefatos(doc, chunk) + '_dtm.tif'))
+
+    def DEMSolo():
+        CalcularDTM(doc, chunk, ResolucaoDEM(chunk, DownscaleDemChunk), filenameDTM, ManterDEMSoloNoProjeto)
+
+    return [
+        dict(nome="depthmaps", depende=[], habilitada=True,
+             concluida=lambda: chunk.depth_maps is not None,
+             mensagem="CALCULANDO DEPTHMAPS... (Downscale:%d  Filter:%s  MaxNeighbors:%s)" % (kwargs['DownscaleDepthMaps'], kwargs['FilterMode'], kwargs['MaxNeighbors']),
+             parametros=dict(downscale=kwargs['DownscaleDepthMaps'], filter_mode=str(kwargs['FilterMode']), max_neighbors=kwargs['MaxNeighbors']),
+             executar=DepthMaps),
+        dict(nome="densa", depende=["depthmaps"], habilitada=True,
+             concluida=lambda: chunk.dense_cloud is not None,
+             mensagem="CALCULANDO DENSECLOUD... (MaxNeighbors:%s)" % (kwargs['MaxNeighbors']),
+             parametros=dict(max_neighbors=kwargs['MaxNeighbors']),
+             executar=lambda: ConstruirNuvemDensa(chunk, kwargs['MaxNeighbors'])),
+        dict(nome="solo", depende=["densa"], habilitada=DesejaClassificarGroundPoint,
+             concluida=lambda: chunk.dense_cloud is not None,
+             legado=lambda: chunk.dense_cloud.meta['ClassifyGroundPoints/ram_used'] is not None,
+             mensagem="CALCULANDO GROUNDPOINTS... (Angle:%d  Cell:%d  MaxDist:%.2f)" % (kwargs['Max_Angle'], kwargs['Cell_Size'], kwargs['Max_Distance']),
+             parametros=dict(max_angle=kwargs['Max_Angle'], cell_size=kwargs['Cell_Size'], max_distance=kwargs['Max_Distance']),
+             executar=Solo),
+        dict(nome="mesh", depende=["densa"], habilitada=DesejaCalcularSurface,
+             concluida=lambda: chunk.model is not None,
+             mensagem="CALCULANDO MESH...",
+             parametros=dict(surface=str(Surface), source_data=str(SurfaceSource)),
+             executar=lambda: BuildModel(chunk)),
+        dict(nome="dsm", depende=["densa"], habilitada=True,
+             concluida=lambda: chunk.elevation is not None,
+             mensagem="CALCULANDO DSM (INCLUI CONSTRUCOES, ARVORES, ETC)",
+             parametros=dict(downscale_dem=DownscaleDemChunk),
+             executar=DSM),
+        # no Metashape 1.7+ o DEM de solo e calculado no proprio chunk, entao nao pode sobrepor a ortofoto
+        dict(nome="dem_solo", depende=["solo", "dsm"], habilitada=DesejaCriarNovoDEMSomenteComGroundPoints,
+             concluida=lambda: Path(filenameDTM).exists(), legado=lambda: ChunkDEM() is not None,
+             recurso="chunk" if hasattr(chunk, 'elevations') else "chunk_dem",
+             mensagem="CALCULANDO DEM (SOMENTE GROUND POINTS)",
+             parametros=dict(downscale_dem=DownscaleDemChunk, arquivo=filenameDTM, manter_no_projeto=ManterDEMSoloNoProjeto),
+             executar=DEMSolo),
+        dict(nome="ortofoto", depende=["dsm", "mesh"], habilitada=True,
+             concluida=lambda: chunk.orthomosaic is not None,
+             mensagem="CONSTRUINDO A ORTOFOTO...",
+             parametros=dict(blending_mode=str(kwargs['BlendingMode']), color_correction=Color_correction, color_balance=Color_balance),
+             executar=lambda: BuildMosaic(chunk, kwargs['BlendingMode'])),
+        dict(nome="exportacao", depende=["densa", "ortofoto", "dem_solo"], habilitada=True,
+             concluida=lambda: False, salvar=False, # cada arquivo exportado tem a sua propria verificacao
+             parametros=dict(pasta=kwargs['PastaDeExportacaoCaminhoCompleto']),
+             executar=lambda: ExportarArtefatos(doc, chunk, **kwargs)),
+    ]
+
+
+def EtapaConcluida(etapa, registro):
+    status = registro.get('status')
+    if status is None:
+        # Projeto processado antes do manifesto existir: vale o que ja esta no chunk
+        return etapa.get('legado', etapa['concluida'])()
+    return status == 'concluida' and etapa['concluida']()
+
+
+def ExecutarEtapa(doc, chunk, etapa, registro, refazer):
+    # Retorna 'desabilitada', 'pulada' ou 'executada'
+    if not etapa['habilitada']:
+        return 'desabilitada'
+    if not refazer and EtapaConcluida(etapa, registro):
+        return 'pulada'
+    if registro.get('status') in ('executando', 'nao_salva', 'falhou'):
+        printNovaAtividade("RETOMANDO A ETAPA %s (ULTIMO STATUS: %s)" % (etapa['nome'].upper(), registro['status'].upper()))
+    if etapa.get('mensagem'):
+        printNovaAtividade(etapa['mensagem'])
+    RegistrarEtapa(doc, chunk, etapa['nome'], status='executando', parametros=etapa['parametros'], inicio=Agora(), fim=None, erro=None)
+    inicio = time.time()
+    try:
+        etapa['executar']()
+    except Exception as erro:
+        RegistrarEtapa(doc, chunk, etapa['nome'], status='falhou', fim=Agora(), erro=str(erro))
+        raise
+    if not etapa.get('salvar', True):
+        RegistrarEtapa(doc, chunk, etapa['nome'], status='concluida', fim=Agora())
+        return 'executada'
+    # Vira 'concluida' somente quando o projeto for salvo: um crash antes disso refaz a etapa na proxima execucao
+    RegistrarEtapa(doc, chunk, etapa['nome'], status='nao_salva', fim=Agora())
+    with TravaDocumento:
+        EtapasNaoSalvas.append((chunk, etapa['nome']))
+    SalvarAposEtapa(doc, time.time() - inicio)
+    return 'executada'
+
+
+def ExecutarEtapas(doc, chunk, etapas, paralelo=False):
+    # Executa as etapas na ordem do grafo de dependencias, retomando a partir do manifesto.
+    # Uma etapa cuja dependencia foi refeita nesta execucao tambem e refeita.
+    manifesto = LerManifesto(doc, chunk)
+    situacao = dict()
+    pendentes = list(etapas)
+    label = getattr(ContextoChunk, 'label', None)
+    while pendentes:
+        prontas = [etapa for etapa in pendentes if all(dep in situacao for dep in etapa['depende'])]
+        if not prontas:
+            raise RuntimeError('DEPENDENCIA CIRCULAR ENTRE AS ETAPAS: %s' % [etapa['nome'] for etapa in pendentes])
+        lote = []
+        recursos = set()
+        for etapa in prontas:
+            recurso = etapa.get('recurso', 'chunk')
+            if recurso not in recursos:
+                lote.append(etapa)
+                recursos.add(recurso)
+            if not paralelo:
+                break
+
+        def Executar(etapa):
+            ContextoChunk.label = label # as threads do executor nao herdam o chunk desta thread
+            refazer = any(situacao[dep] == 'executada' for dep in etapa['depende'])
+            return ExecutarEtapa(doc, chunk, etapa, manifesto.get(etapa['nome'], {}), refazer)
+
+        if len(lote) == 1:
+            resultados = [Executar(lote[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(lote)) as executor:
+                resultados = list(executor.map(Executar, lote))
+        for etapa, resultado in zip(lote, resultados):
+            situacao[etapa['nome']] = resultado
+            pendentes.remove(etapa)
+    return situacao
 
-    if chunk.orthomosaic is None:
-        printNovaAtividade("CONSTRUINDO A ORTOFOTO...")
-        BuildMosaic(chunk, kwargs['BlendingMode'])
-        doc.save()
 
+def StandardWorkflow(doc, chunk, **kwargs):
+    if ProcessamentoEmTiles:
+        return WorkflowEmTiles(doc, chunk, **kwargs)
+    if EtapasEmParalelo and not ParalelismoExperimental:
+        printNovaAtividade("EtapasEmParalelo EXIGE ParalelismoExperimental = True (EXPERIMENTAL)\nAS ETAPAS SERAO EXECUTADAS UMA APOS A OUTRA")
+    try:
+        ExecutarEtapas(doc, chunk, EtapasDoWorkflow(doc, chunk, **kwargs), EtapasEmParalelo and ParalelismoExperimental)
+    finally:
+        SalvarPendentes(doc) # mesmo com erro, salva o que a PoliticaDeSalvamento deixou pendente
+
+
+def ExecutarFerramentaExterna(comando, timeout=None):
+    # Executa um programa externo mostrando a saida linha a linha.
+    # Levanta RuntimeError se o tempo limite (segundos) for excedido ou se o codigo de saida nao for zero.
+    # Numa tarefa de ExportarArtefatos, o processo fica em ContextoChunk.processos para poder ser encerrado se a exportacao falhar
+    processo = Popen(comando, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+    processos = getattr(ContextoChunk, 'processos', None)
+    if processos is not None:
+        processos.append(processo)
+        if ContextoChunk.cancelamento.is_set():
+            processo.kill() # cancelada enquanto o processo era iniciado
+    estourou = threading.Event()
+
+    def Interromper():
+        estourou.set()
+        processo.kill()
+
+    relogio = threading.Timer(timeout, Interromper) if timeout else None
+    if relogio:
+        relogio.start()
+    try:
+        for linha in processo.stdout:
+            print(PrefixoChunk() + linha.rstrip())
+        codigo = processo.wait()
+    finally:
+        if relogio:
+            relogio.cancel()
+    if estourou.is_set():
+        raise RuntimeError('%s EXCEDEU O TEMPO LIMITE DE %d SEGUNDOS' % (comando[0], timeout))
+    if codigo != 0:
+        raise RuntimeError('%s TERMINOU COM O CODIGO %d' % (comando[0], codigo))
+
+
+def ImpressaoDoArtefato(chunk, produto, etapas, opcoes):
+    # Impressao digital das entradas de um artefato exportado: parametros e fim das etapas anteriores (manifesto),
+    # chave e meta do produto no chunk (mudam quando ele e recalculado), sistema de coordenadas e opcoes de exportacao
+    objeto = getattr(chunk, produto, None)
+    dados = dict(etapas=etapas or {}, produto=produto, chave=getattr(objeto, 'key', None), meta=MetaDoProduto(chunk, produto),
+                 crs=chunk.crs.wkt if chunk.crs is not None else None, opcoes=opcoes)
+    return hashlib.sha1(json.dumps(dados, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def ArtefatoAtualizado(arquivo, impressao):
+    # O(1): o artefato existe e a impressao gravada ao lado dele e a mesma
+    try:
+        with open(arquivo + ".impressao") as registro:
+            return registro.read().strip() == impressao and os.path.exists(arquivo)
+    except OSError:
+        return False
+
+
+def CaminhoTemporario(arquivo):
+    # Caminho onde o artefato e gerado antes de substituir o anterior. Sobras de uma execucao interrompida sao apagadas
+    base, extensao = os.path.splitext(arquivo)
+    temporario = base + ".tmp" + extensao
+    if os.path.isdir(temporario):
+        shutil.rmtree(temporario)
+    return temporario
+
+
+def GravarArtefato(arquivo, impressao, gerar):
+    # gerar(caminho) grava o artefato num caminho temporario, que so depois substitui o anterior (os.replace).
+    # Uma exportacao interrompida nunca deixa um artefato pela metade com o nome final
+    temporario = CaminhoTemporario(arquivo)
+    gerar(temporario)
+    PublicarArtefato(temporario, arquivo, impressao)
+
+
+def NomeDosArtefatos(doc, chunk):
+    # Nome base dos arquivos exportados de um chunk: o nome do projeto e, fora do primeiro chunk (key 0), a key do chunk.
+    # A impressao de um artefato e de um chunk so: cada chunk grava os seus arquivos e nao sobrescreve os de outro
+    NomeProjeto = os.path.splitext(os.path.basename(doc.path))[0]
+    return NomeProjeto if chunk.key == 0 else "%s_chunk%d" % (NomeProjeto, chunk.key)
+
+
+def PublicarArtefato(temporario, arquivo, impressao):
+    if os.path.isdir(arquivo):
+        shutil.rmtree(arquivo) # pasta: o os.replace nao substitui uma pasta com conteudo
+    os.replace(temporario, arquivo)
+    with open(arquivo + ".impressao", "w") as registro:
+        registro.write(impressao)
+
+
+# Extensao dos arquivos de cada FormatoNuvem
+ExtensoesNuvem = dict(las=".las", laz=".laz", copc=".copc.laz")
+
+
+def FormatoDePontos(nome):
+    # Metashape 1.x: PointsFormatLAS/LAZ. Metashape 2.x: PointCloudFormatLAS/LAZ/COPC. None se a versao nao exporta o formato
+    return getattr(Metashape, 'PointsFormat' + nome, None) or getattr(Metashape, 'PointCloudFormat' + nome, None)
+
+
+def ValidarNuvem(caminho, formato, segundos):
+    # Confere o layout do arquivo (LAZ comprimido; COPC com o VLR "copc" logo apos o cabecalho) e relata tamanho e vazao
+    las = LerCabecalhoLas(caminho)
+    with open(caminho, 'rb') as arquivo:
+        cabecalho = arquivo.read(las['tamanho_cabecalho'])
+        vlrs = []
+        for indice in range(struct.unpack_from('<I', cabecalho, 100)[0]):
+            vlr = arquivo.read(54)
+            vlrs.append((vlr[2:18].rstrip(b'\0').decode('ascii', 'replace'), struct.unpack_from('<H', vlr, 18)[0]))
+            arquivo.seek(struct.unpack_from('<H', vlr, 20)[0], 1)
+    comprimido = bool(cabecalho[104] & 0x80) # o LASzip marca o formato dos pontos com o bit 7
+    if formato in ("laz", "copc") and not (comprimido and ("laszip encoded", 22204) in vlrs):
+        raise RuntimeError('O ARQUIVO %s NAO ESTA COMPRIMIDO EM LAZ' % caminho)
+    if formato == "copc" and (las['versao'] < (1, 4) or not vlrs or vlrs[0] != ("copc", 1)):
+        raise RuntimeError('O ARQUIVO %s NAO E UM COPC (FALTA O VLR "copc" NO INICIO)' % caminho)
+    tamanho = os.path.getsize(caminho)
+    sem_compressao = las['offset_pontos'] + las['pontos'] * las['tamanho_registro']
+    printNovaAtividade("NUVEM DE PONTOS %s VALIDADA: LAS %d.%d, %d PONTOS\nTAMANHO: %.1f MB (%.0f%% DO LAS SEM COMPRESSAO)\nVAZAO: %.1f MB/s, %.0f PONTOS/s"
+                       % (formato.upper(), las['versao'][0], las['versao'][1], las['pontos'], tamanho / 1e6,
+                          100.0 * tamanho / max(sem_compressao, 1), tamanho / 1e6 / max(segundos, 1e-6), las['pontos'] / max(segundos, 1e-6)))
+
+
+def LerIfdsTiff(caminho):
+    # IFDs de um TIFF ou BigTIFF: [(offset do IFD, {tag: [valores]})], somente com as tags numericas usadas na validacao
+    TamanhosTipo = {3: 'H', 4: 'I', 16: 'Q'} # SHORT, LONG, LONG8
+    ifds = []
+    with open(caminho, 'rb') as arquivo:
+        cabecalho = arquivo.read(16)
+        ordem = '<' if cabecalho[:2] == b'II' else '>'
+        big = struct.unpack_from(ordem + 'H', cabecalho, 2)[0] == 43
+        contador, ponteiro, entrada = ('Q', 'Q', 20) if big else ('H', 'I', 12)
+        offset = struct.unpack_from(ordem + ponteiro, cabecalho, 8 if big else 4)[0]
+        while offset and len(ifds) < 100:
+            arquivo.seek(offset)
+            quantidade = struct.unpack(ordem + contador, arquivo.read(struct.calcsize(contador)))[0]
+            dados = arquivo.read(quantidade * entrada)
+            proximo = struct.unpack(ordem + ponteiro, arquivo.read(struct.calcsize(ponteiro)))[0]
+            tags = dict()
+            for indice in range(quantidade):
+                tag, tipo = struct.unpack_from(ordem + 'HH', dados, indice * entrada)
+                if tipo not in TamanhosTipo:
+                    continue
+                total = struct.unpack_from(ordem + ponteiro, dados, indice * entrada + 4)[0]
+                valor = dados[indice * entrada + entrada - struct.calcsize(ponteiro):(indice + 1) * entrada]
+                formato = ordem + '%d%s' % (total, TamanhosTipo[tipo])
+                if struct.calcsize(formato) > len(valor):
+                    arquivo.seek(struct.unpack(ordem + ponteiro, valor)[0])
+                    valor = arquivo.read(struct.calcsize(formato))
+                tags[tag] = list(struct.unpack_from(formato, valor))
+            ifds.append((offset, tags))
+            offset = proximo
+    return ifds
+
+
+def ValidarOrtofoto(caminho, formato, segundos):
+    # COG: todas as imagens em tiles, com overviews internas, e todos os IFDs antes dos dados (um leitor remoto
+    # encontra qualquer nivel com uma unica leitura do inicio do arquivo). Relata tamanho e vazao
+    ifds = LerIfdsTiff(caminho)
+    largura, altura = ifds[0][1][256][0], ifds[0][1][257][0]
+    overviews = sum(1 for offset, tags in ifds if tags.get(254, [0])[0] & 1)
+    msg = "ORTOFOTO %s: %d x %d PIXELS, %d OVERVIEWS" % (formato.upper(), largura, altura, overviews)
+    if formato == "cog":
+        if not all(322 in tags for offset, tags in ifds):
+            raise RuntimeError('A ORTOFOTO %s NAO ESTA EM TILES' % caminho)
+        if max(largura, altura) > 512 and not overviews:
+            raise RuntimeError('A ORTOFOTO %s NAO TEM OVERVIEWS INTERNAS' % caminho)
+        dados = min(min(tags[324]) for offset, tags in ifds if tags.get(324))
+        if max(offset for offset, tags in ifds) > dados:
+            msg += "\nATENCAO: TILES E OVERVIEWS OK, MAS OS IFDS NAO ESTAO TODOS NO INICIO DO ARQUIVO (LAYOUT COG). INSTALE O GDAL"
+        else:
+            msg += ", LAYOUT COG VALIDO"
+    tamanho = os.path.getsize(caminho)
+    printNovaAtividade(msg + "\nTAMANHO: %.1f MB\nVAZAO: %.1f MB/s, %.1f MPIXELS/s"
+                       % (tamanho / 1e6, tamanho / 1e6 / max(segundos, 1e-6), largura * altura / 1e6 / max(segundos, 1e-6)))
+
+
+def ConverterParaCog(caminho):
+    # Reescreve o TIFF exportado pelo Metashape com o driver COG do GDAL (3.1+). Sem ele o TIFF em tiles e mantido
+    try:
+        from osgeo import gdal
+    except ImportError:
+        return False
+    if gdal.GetDriverByName("COG") is None:
+        return False
+    cog = caminho + ".cog.tif"
+    gdal.Translate(cog, caminho, format="COG", creationOptions=["COMPRESS=JPEG", "QUALITY=80", "BLOCKSIZE=512", "BIGTIFF=IF_SAFER"])
+    os.replace(cog, caminho)
+    return True
+
+
+@SerializarNoDocumento
+@MedirEtapa('dense_cloud')
+def ExportarLas(chunk, filenameLas, etapas=None, formato=None):
+    formato = formato or FormatoNuvem
+    impressao = ImpressaoDoArtefato(chunk, 'dense_cloud', etapas, dict(formato=formato, binary=True, save_colors=True))
+    if ArtefatoAtualizado(filenameLas, impressao):
+        printNovaAtividade("A NUVEM DE PONTOS JA ESTA ATUALIZADA EM \n%s" % filenameLas)
+        return False
+    printNovaAtividade("EXPORTANDO NUVEM DE PONTOS (%s) EM \n%s" % (formato.upper(), filenameLas))
+
+    def Gerar(caminho):
+        inicio = time.time()
+        if formato == "copc" and FormatoDePontos("COPC") is None:
+            # esta versao do Metashape nao exporta COPC: exporta LAZ e o PDAL reorganiza os pontos em COPC
+            if shutil.which(PdalExe) is None:
+                raise RuntimeError('O PDAL (%s) NAO FOI ENCONTRADO. ELE E NECESSARIO PARA GERAR O COPC' % PdalExe)
+            laz = os.path.splitext(caminho)[0] + ".pdal.laz"
+            chunk.exportPoints(path=laz, binary=True, save_colors=True, format=FormatoDePontos("LAZ"), crs=chunk.crs)
+            try:
+                ExecutarFerramentaExterna([PdalExe, "translate", laz, caminho, "--writer", "writers.copc"])
+            finally:
+                os.remove(laz)
+        else:
+            chunk.exportPoints(path=caminho, binary=True, save_colors=True, format=FormatoDePontos(formato.upper()), crs=chunk.crs)
+        ValidarNuvem(caminho, formato, time.time() - inicio)
+
+    GravarArtefato(filenameLas, impressao, Gerar)
+    return True
+
+
+@SerializarNoDocumento
+@MedirEtapa('orthomosaic')
+def ExportarOrtofoto(chunk, filenameTif, etapas=None, formato=None):
+    formato = formato or FormatoOrtofoto
+    impressao = ImpressaoDoArtefato(chunk, 'orthomosaic', etapas, dict(formato=formato, compressao="jpeg", jpeg_quality=80, overviews=True))
+    if ArtefatoAtualizado(filenameTif, impressao):
+        printNovaAtividade("A ORTOFOTO JA ESTA ATUALIZADA EM \n%s" % filenameTif)
+        return False
+    printNovaAtividade("EXPORTANDO ORTOFOTO (%s) EM \n%s" % (formato.upper(), filenameTif))
+    my_projection = Metashape.OrthoProjection()
+    my_projection.crs=chunk.crs
+    my_compression = Metashape.ImageCompression()
+    my_compression.tiff_compression = Metashape.ImageCompression.TiffCompressionJPEG
+    my_compression.jpeg_quality = 80
+    my_compression.tiff_overviews = True
+    if formato == "cog":
+        my_compression.tiff_tiled = True
+        my_compression.tiff_big = True
+
+    def Gerar(caminho):
+        inicio = time.time()
+        chunk.exportRaster(path=caminho, image_format=Metashape.ImageFormat.ImageFormatTIFF, raster_transform=Metashape.RasterTransformType.RasterTransformNone, projection=my_projection, save_alpha=False, image_compression=my_compression, white_background=False, save_scheme=False, save_world=False, description="https://seusite.com.br")
+        if formato == "cog":
+            ConverterParaCog(caminho)
+        ValidarOrtofoto(caminho, formato, time.time() - inicio)
+
+    GravarArtefato(filenameTif, impressao, Gerar)
+    return True
+
+
+@MedirEtapa()
+def GerarAplicacaoWeb(filenameLas, PastaDeExportacaoCaminhoCompleto, NomeProjeto, PotreeExe, FormatoWeb):
+    # Converte o .las em aplicacao web e empacota. Retorna as instrucoes de deploy, ou None se nada foi gerado
+    if FormatoWeb == "pasta":
+        ZipFileName = NomeProjeto + "_web"
+        WwwFolder = str(Path(PastaDeExportacaoCaminhoCompleto) / ZipFileName)
+    else:
+        ZipFileName = NomeProjeto + "_web." + FormatoWeb
+        WwwFolder = str(Path(PastaDeExportacaoCaminhoCompleto) / "www")
+    filenameZip = str(Path(PastaDeExportacaoCaminhoCompleto) / ZipFileName)
+    filenameTxt = os.path.splitext(filenameZip)[0] + '_instrucoes_deploy.txt'
+    # a aplicacao web depende somente do .las: tamanho e data dele (novos a cada exportacao) e as opcoes
+    las = os.stat(filenameLas) if os.path.exists(filenameLas) else None
+    impressao = hashlib.sha1(json.dumps([las and [las.st_size, las.st_mtime_ns], FormatoWeb, PotreeExe]).encode()).hexdigest()
+    if ArtefatoAtualizado(filenameZip, impressao):
+        printNovaAtividade("A APLICACAO WEB JA ESTA ATUALIZADA EM \n%s" % filenameZip)
+        return None
+    if not Path(PotreeExe).exists():
+        printNovaAtividade("A APLICACAO WEB NAO FOI GERADA.\nO EXECUTAVEL %s, NAO FOI ENCONTRADO" % PotreeExe)
+        return None
+    printNovaAtividade("GERANDO PAGINA WEB EM\n%s" % filenameZip)
+    Instrucoes = "\n\nInstrucoes para deploy da aplicacao web:\n\n"
+    Instrucoes += "cd /var/www/html/otherapps/pointcloud\n"
+
+    def Gerar(destino):
+        # converte o arquivo .las em aplicacao web
+        ExecutarFerramentaExterna([PotreeExe, filenameLas, "-o", destino if FormatoWeb == "pasta" else WwwFolder, "--generate-page", "index"], TimeoutPotree)
+        if FormatoWeb != "pasta":
+            # o pacote e gravado direto no destino e cada arquivo e apagado da pasta assim que entra nele
+            tamanho, segundos = EmpacotarPastaWeb(WwwFolder, destino, FormatoWeb, ThreadsCompactacao)
+            printNovaAtividade("APLICACAO WEB EMPACOTADA: %.1f MB EM %.1f s (%.1f MB/s)" \
+                    % (tamanho / 1e6, segundos, tamanho / 1e6 / max(segundos, 1e-6)))
+
+    GravarArtefato(filenameZip, impressao, Gerar)
+    if FormatoWeb == "pasta":
+        Instrucoes += "cp -r %s %s\n" % (filenameZip, NomeProjeto)
+    else:
+        if FormatoWeb == "tar":
+            Instrucoes += "mkdir %s && tar -xf %s -C %s\n" % (NomeProjeto, ZipFileName, NomeProjeto)
+        else:
+            Instrucoes += "unzip -d %s %s\n" % (NomeProjeto, ZipFileName)
+    Instrucoes += "chown -R www-data:www-data /var/www/html/otherapps/pointcloud/%s\n\n" % NomeProjeto
+    if FormatoWeb != "pasta":
+        Instrucoes += "rm %s\n" % ZipFileName
+    Instrucoes += "Endereco: https://seusite.com.br/pointcloud/%s\n" % NomeProjeto
+    arquivoTxt = open(filenameTxt,"w+"); arquivoTxt.write(Instrucoes); arquivoTxt.close()
+    return Instrucoes
+
+
+def FiltrarVoxelsNovos(camadas, chaves):
+    # Mascara dos pontos do bloco cujo voxel ainda nao apareceu (fica o primeiro ponto de cada voxel).
+    # Os voxels vistos ficam em camadas ordenadas de tamanhos geometricos: busca com searchsorted e fusao das camadas
+    # de tamanho parecido. Custo O(n log n) no total e 8 bytes por ponto mantido, sem estruturas do Python por ponto
+    unicas, primeiros = numpy.unique(chaves, return_index=True)
+    novas = numpy.ones(len(unicas), dtype=bool)
+    for vistas in camadas:
+        posicao = numpy.minimum(numpy.searchsorted(vistas, unicas), len(vistas) - 1)
+        novas &= vistas[posicao] != unicas
+    mascara = numpy.zeros(len(chaves), dtype=bool)
+    mascara[primeiros[novas]] = True
+    if novas.any():
+        camadas.append(unicas[novas])
+        while len(camadas) > 1 and len(camadas[-2]) <= 2 * len(camadas[-1]):
+            ultima = camadas.pop()
+            camadas[-1] = numpy.sort(numpy.concatenate([camadas[-1], ultima]))
+    return mascara
+
+
+def GravarFaixas(pasta, bloco, faixas):
+    # Acrescenta os registros do bloco ao arquivo da faixa de cada ponto (pasta/<faixa>.bin), mantendo a ordem de leitura
+    ordem = numpy.argsort(faixas, kind='stable')
+    valores, inicios = numpy.unique(faixas[ordem], return_index=True)
+    for faixa, inicio, fim in zip(valores, inicios, list(inicios[1:]) + [len(ordem)]):
+        with open(os.path.join(pasta, "%d.bin" % faixa), 'ab') as arquivo:
+            arquivo.write(bloco[ordem[inicio:fim]].tobytes())
+
+
+@MedirEtapa()
+def GerarProdutosNuvem(filenameLas, PastaDeExportacaoCaminhoCompleto, NomeProjeto, produtos, pontos_por_bloco, threads):
+    # Gera as versoes derivadas do .las (voxel, classes, tiles) numa unica leitura do arquivo. O .las e lido por memmap
+    # em blocos de pontos_por_bloco: as threads decodificam os blocos e calculam voxels e tiles (numpy libera o GIL),
+    # esta thread descarta os voxels repetidos e grava os pontos na ordem dos blocos. No maximo threads + 1 blocos em memoria,
+    # mais o registro dos voxels ja vistos de cada produto com voxel (ate 16 bytes por ponto mantido). Quando o registro pode
+    # passar de MemoriaVoxelsMB, os pontos do produto sao separados em faixas de voxels gravadas em disco, e cada faixa
+    # e filtrada depois com um registro proprio, dividida de novo enquanto tiver mais pontos que o limite
+    if not os.path.exists(filenameLas):
+        return None
+    las = LerCabecalhoLas(filenameLas)
+    with open(filenameLas, 'rb') as arquivo:
+        cabecalho = arquivo.read(las['offset_pontos'])
+    if cabecalho[104] & 0x80:
+        printNovaAtividade("OS PRODUTOS DERIVADOS DA NUVEM NAO FORAM GERADOS.\nO ARQUIVO %s ESTA COMPRIMIDO (USE FormatoNuvem = \"las\")" % filenameLas)
+        return None
+    # os produtos dependem somente do .las (impressao gravada na exportacao, ou tamanho e data) e das opcoes de cada um
+    try:
+        with open(filenameLas + ".impressao") as registro:
+            fonte = registro.read().strip()
+    except OSError:
+        fonte = [os.stat(filenameLas).st_size, os.stat(filenameLas).st_mtime_ns]
+    pendentes = []
+    for produto in produtos:
+        tile = produto.get('tile') or 0
+        destino = str(Path(PastaDeExportacaoCaminhoCompleto) / ("%s_%s%s" % (NomeProjeto, produto['nome'], "" if tile else ".las")))
+        impressao = hashlib.sha1(json.dumps([fonte, produto], sort_keys=True).encode()).hexdigest()
+        if ArtefatoAtualizado(destino, impressao):
+            printNovaAtividade("O PRODUTO %s DA NUVEM JA ESTA ATUALIZADO EM \n%s" % (produto['nome'].upper(), destino))
+            continue
+        pendentes.append(dict(produto, tile=tile, voxel=produto.get('voxel') or 0, classes=produto.get('classes'), destino=destino,
+                              impressao=impressao, temporario=CaminhoTemporario(destino), camadas=[], saidas=dict(), faixas=None))
+    if not pendentes:
+        return None
+    printNovaAtividade("GERANDO %d PRODUTOS DA NUVEM (%s) A PARTIR DE \n%s" % (len(pendentes), ", ".join(p['nome'] for p in pendentes), filenameLas))
+    inicio_geracao = time.time()
+    # a grade de voxels comeca no minimo do cabecalho; os tiles seguem a grade absoluta (multiplos do tamanho do tile)
+    maximo_x, minimo_x, maximo_y, minimo_y, maximo_z, minimo_z = struct.unpack_from('<6d', cabecalho, 179)
+    minimo, maximo = numpy.array([minimo_x, minimo_y, minimo_z]), numpy.array([maximo_x, maximo_y, maximo_z])
+    limite_voxels = MemoriaVoxelsMB * 1024.0 ** 2
+    for produto in pendentes:
+        if produto['voxel']:
+            produto['dimensoes'] = tuple(int(n) for n in numpy.floor((maximo - minimo) / produto['voxel']) + 1)
+            # pior caso do registro: um voxel por ponto, limitado ao numero de voxels da caixa do .las
+            memoria = 16.0 * min(las['pontos'], numpy.prod(produto['dimensoes'], dtype=float))
+            if memoria > limite_voxels:
+                faixas = int(math.ceil(memoria / limite_voxels))
+                produto['faixas'] = produto['temporario'] + ".faixas"
+                produto['largura_faixa'] = int(math.ceil(produto['dimensoes'][0] / float(faixas))) # em voxels, no eixo x
+                if os.path.isdir(produto['faixas']):
+                    shutil.rmtree(produto['faixas'])
+                os.makedirs(produto['faixas'])
+                print("PRODUTO %s: REGISTRO DE VOXELS DE ATE %.1f GB, FILTRADO EM %d FAIXAS EM DISCO" % (produto['nome'], memoria / 1024.0 ** 3, faixas))
+        if produto['tile']:
+            os.makedirs(produto['temporario'])
+    # formatos 6 a 10: classificacao no byte 16; formatos 0 a 5: 5 bits menores do byte 15
+    byte_classe, mascara_classe = (16, 0xff) if las['formato'] >= 6 else (15, 0x1f)
+    registros = numpy.memmap(filenameLas, dtype=numpy.uint8, mode='r', offset=las['offset_pontos'],
+                             shape=(las['pontos'], las['tamanho_registro'])) if las['pontos'] else None
+
+    def Coordenadas(bloco):
+        return bloco[:, :12].copy().view('<i4') * las['escala'] + las['offset']
+
+    def Voxels(produto, xyz):
+        # indices (x, y, z) do voxel de cada ponto e a chave unica do voxel
+        indices = numpy.clip(numpy.floor((xyz - minimo) / produto['voxel']).astype(numpy.int64), 0, numpy.array(produto['dimensoes']) - 1)
+        return indices, numpy.ravel_multi_index(tuple(indices.T), produto['dimensoes'])
+
+    def Tiles(produto, xyz):
+        return numpy.floor(xyz[:, :2] / produto['tile']).astype(numpy.int64) if produto['tile'] else None
+
+    def Preparar(inicio):
+        bloco = numpy.array(registros[inicio:inicio + pontos_por_bloco])
+        xyz = Coordenadas(bloco)
+        classes = bloco[:, byte_classe] & mascara_classe
+        calculos = []
+        for produto in pendentes:
+            selecao = numpy.isin(classes, produto['classes']) if produto['classes'] is not None else None
+            chaves = faixas = None
+            if produto['voxel']:
+                indices, chaves = Voxels(produto, xyz)
+                if produto['faixas']:
+                    faixas = indices[:, 0] // produto['largura_faixa']
+            calculos.append((selecao, chaves, faixas, Tiles(produto, xyz)))
+        return bloco, xyz, calculos
+
+    def Gravar(produto, caminho, bloco, xyz):
+        if caminho not in produto['saidas']:
+            produto['saidas'][caminho] = AbrirSaidaLas(caminho, cabecalho, las)
+        GravarPontosLas(produto['saidas'][caminho], bloco, xyz)
+
+    def Consumir(bloco, xyz, calculos):
+        for produto, (selecao, chaves, faixas, tiles) in zip(pendentes, calculos):
+            indices = numpy.arange(len(bloco)) if selecao is None else numpy.flatnonzero(selecao)
+            if faixas is not None:
+                # os voxels repetidos sao descartados depois, faixa por faixa
+                GravarFaixas(produto['faixas'], bloco[indices], faixas[indices])
+                continue
+            if chaves is not None:
+                indices = indices[FiltrarVoxelsNovos(produto['camadas'], chaves[indices])]
+            Distribuir(produto, bloco, xyz, tiles, indices)
+
+    def Distribuir(produto, bloco, xyz, tiles, indices):
+        # grava os pontos indices do bloco no arquivo do produto, ou no arquivo do tile de cada um
+        if len(indices) == 0:
+            return
+        if not produto['tile']:
+            Gravar(produto, produto['temporario'], bloco[indices], xyz[indices])
+        else:
+            # agrupa os pontos do bloco por tile, mantendo a ordem de leitura dentro de cada tile
+            grupos, inverso = numpy.unique(tiles[indices], axis=0, return_inverse=True)
+            inverso = inverso.reshape(-1)
+            ordem = numpy.argsort(inverso, kind='stable')
+            limites = numpy.searchsorted(inverso[ordem], numpy.arange(len(grupos) + 1))
+            for grupo, (coluna, linha) in enumerate(grupos):
+                selecionados = indices[ordem[limites[grupo]:limites[grupo + 1]]]
+                caminho = str(Path(produto['temporario']) / ("%s_%s_%d_%d.las" % (NomeProjeto, produto['nome'], coluna, linha)))
+                Gravar(produto, caminho, bloco[selecionados], xyz[selecionados])
+                PausarSaidaLas(produto['saidas'][caminho])
+
+    def FiltrarFaixa(produto, caminho, eixo):
+        # Descarta os voxels repetidos de uma faixa gravada em disco, com um registro de voxels so para ela. Uma faixa com
+        # mais pontos do que cabe em MemoriaVoxelsMB e dividida pela extensao dos seus voxels no eixo (0 = x, 1 = y), que alterna
+        pontos = os.path.getsize(caminho) // las['tamanho_registro']
+        faixa = numpy.memmap(caminho, dtype=numpy.uint8, mode='r', shape=(pontos, las['tamanho_registro'])) if pontos else None
+        partes = int(math.ceil(16.0 * pontos / limite_voxels))
+        if partes > 1:
+            extremos = [None, None]
+            for eixo_teste in (eixo, 1 - eixo):
+                menor, maior = None, None
+                for inicio in range(0, pontos, pontos_por_bloco):
+                    valores = Voxels(produto, Coordenadas(numpy.array(faixa[inicio:inicio + pontos_por_bloco])))[0][:, eixo_teste]
+                    menor = valores.min() if menor is None else min(menor, valores.min())
+                    maior = valores.max() if maior is None else max(maior, valores.max())
+                if maior > menor:
+                    eixo, extremos = eixo_teste, [menor, maior]
+                    break
+            if extremos[0] is not None:
+                # a faixa e dividida em subfaixas gravadas numa pasta ao lado, e o arquivo dela e apagado antes de filtra-las
+                pasta = caminho + ".d"
+                os.makedirs(pasta)
+                largura = max(1, int(math.ceil((extremos[1] - extremos[0] + 1) / float(partes))))
+                for inicio in range(0, pontos, pontos_por_bloco):
+                    bloco = numpy.array(faixa[inicio:inicio + pontos_por_bloco])
+                    GravarFaixas(pasta, bloco, (Voxels(produto, Coordenadas(bloco))[0][:, eixo] - extremos[0]) // largura)
+                del faixa
+                os.remove(caminho)
+                for nome in sorted(os.listdir(pasta)):
+                    FiltrarFaixa(produto, os.path.join(pasta, nome), 1 - eixo)
+                os.rmdir(pasta)
+                return
+            # todos os pontos na mesma coluna de voxels: o registro fica limitado ao numero de voxels da coluna
+        camadas = []
+        for inicio in range(0, pontos, pontos_por_bloco):
+            bloco = numpy.array(faixa[inicio:inicio + pontos_por_bloco])
+            xyz = Coordenadas(bloco)
+            Distribuir(produto, bloco, xyz, Tiles(produto, xyz), numpy.flatnonzero(FiltrarVoxelsNovos(camadas, Voxels(produto, xyz)[1])))
+        del faixa
+        os.remove(caminho)
+
+    threads = max(1, threads)
+    try:
+        fila = deque()
+        cancelamento = getattr(ContextoChunk, 'cancelamento', None)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for inicio in range(0, las['pontos'], pontos_por_bloco):
+                if cancelamento is not None and cancelamento.is_set():
+                    raise RuntimeError('GERACAO DOS PRODUTOS DA NUVEM CANCELADA')
+                fila.append(executor.submit(Preparar, inicio))
+                if len(fila) > threads:
+                    Consumir(*fila.popleft().result())
+            while fila:
+                Consumir(*fila.popleft().result())
+        for produto in pendentes:
+            if produto['faixas']:
+                for nome in sorted(os.listdir(produto['faixas']), key=lambda nome: int(nome.split(".")[0])):
+                    FiltrarFaixa(produto, os.path.join(produto['faixas'], nome), 1)
+    finally:
+        for produto in pendentes:
+            if produto['faixas']:
+                shutil.rmtree(produto['faixas'], ignore_errors=True)
+            if not produto['tile'] and not produto['saidas']:
+                Gravar(produto, produto['temporario'], numpy.zeros((0, las['tamanho_registro']), dtype=numpy.uint8), None) # .las sem pontos
+            for saida in produto['saidas'].values():
+                FecharSaidaLas(saida)
+    segundos = time.time() - inicio_geracao
+    resumo = "PRODUTOS DA NUVEM GERADOS EM %.1f s (%.0f PONTOS/s)" % (segundos, las['pontos'] / max(segundos, 1e-6))
+    for produto in pendentes:
+        total = sum(saida['total'] for saida in produto['saidas'].values())
+        PublicarArtefato(produto['temporario'], produto['destino'], produto['impressao'])
+        resumo += "\n%-8s %12d PONTOS (%5.1f%%)%s" % (produto['nome'], total, 100.0 * total / max(las['pontos'], 1),
+                                                     "  %d TILES" % len(produto['saidas']) if produto['tile'] else "")
+    printNovaAtividade(resumo)
+    return [produto['destino'] for produto in pendentes]
+
+
+def ExportarArtefatos(doc, chunk, **kwargs):
+    # As exportacoes do Metashape (las, tif) rodam uma apos a outra nesta thread. A aplicacao web depende
+    # somente do .las, entao comeca assim que ele fica pronto e roda em segundo plano durante a exportacao da ortofoto
     PastaDeExportacaoCaminhoCompleto = kwargs['PastaDeExportacaoCaminhoCompleto']
     ExportaArquivosMsg = "FIM DO PROCESSAMENTO! \nOS ITENS EXPORTADOS ESTAO NA PASTA \n%s" % \
             PastaDeExportacaoCaminhoCompleto
-    NomeProjeto = os.path.splitext(os.path.split(doc.path)[1])[0]
-
-    HouveExportacaoLas = False
-    filenameLas = str(Path(PastaDeExportacaoCaminhoCompleto).joinpath(NomeProjeto + '.las'))
-    if not Path(filenameLas).exists():
-        printNovaAtividade("EXPORTANDO NUVEM DE PONTOS EM \n%s" % filenameLas)
-        chunk.exportPoints(path=filenameLas, binary=True, save_colors=True, format=Metashape.PointsFormatLAS, crs=chunk.crs)
-        HouveExportacaoLas = True
-    else:
-        printNovaAtividade("A NUVEM DE PONTOS NAO FOI EXPORTADA.\nJA EXISTE UM ARQUIVO %s\nAPAGUE-O E RODE ESTE SCRIPT NOVAMENTE" % filenameLas)
-
-    HouveExportacaoTif = False
+    NomeProjeto = NomeDosArtefatos(doc, chunk)
+    filenameLas = str(Path(PastaDeExportacaoCaminhoCompleto).joinpath(NomeProjeto + ExtensoesNuvem[FormatoNuvem]))
     filenameTif = str(Path(PastaDeExportacaoCaminhoCompleto).joinpath(NomeProjeto + '.tif'))
-    if not Path(filenameTif).exists():
-        printNovaAtividade("EXPORTANDO ORTOFOTO EM \n%s" % filenameTif)
+    tempos = []
+    label = getattr(ContextoChunk, 'label', None)
+
+    def Cronometrar(artefato, funcao, *args):
+        ContextoChunk.label = label
+        inicio = time.time()
+        resultado = funcao(*args)
+        tempos.append((artefato, time.time() - inicio))
+        return resultado
+
+    manifesto = LerManifesto(doc, chunk)
+
+    def Etapas(*nomes):
+        # parametros e fim de cada etapa anterior ao artefato: mudam quando a etapa e refeita ou reconfigurada
+        return dict((nome, [manifesto.get(nome, {}).get('parametros'), manifesto.get(nome, {}).get('fim')]) for nome in nomes)
+
+    cancelamento = threading.Event()
+    processos = []
+
+    def EmSegundoPlano(*args):
+        # tarefa do executor: se a exportacao falhar, ela e avisada por cancelamento e os seus processos externos sao encerrados
+        ContextoChunk.processos, ContextoChunk.cancelamento = processos, cancelamento
+        return Cronometrar(*args)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    web = produtos = None
+    try:
+        HouveExportacaoLas = Cronometrar(FormatoNuvem.upper(), ExportarLas, chunk, filenameLas, Etapas("depthmaps", "densa", "solo"))
+        if GerarAplicacaoWebPotree:
+            web = executor.submit(EmSegundoPlano, "WEB", GerarAplicacaoWeb, filenameLas, PastaDeExportacaoCaminhoCompleto,
+                                  NomeProjeto, kwargs['PotreeExe'], kwargs.get('FormatoPacoteWeb', FormatoPacoteWeb))
+        if DesejaGerarProdutosNuvem:
+            produtos = executor.submit(EmSegundoPlano, "PRODUTOS", GerarProdutosNuvem, filenameLas, PastaDeExportacaoCaminhoCompleto,
+                                       NomeProjeto, ProdutosNuvem, PontosPorBloco, ThreadsProdutosNuvem)
+        HouveExportacaoTif = Cronometrar(FormatoOrtofoto.upper(), ExportarOrtofoto, chunk, filenameTif, Etapas("depthmaps", "densa", "mesh", "dsm", "ortofoto"))
+        InstrucoesWeb = web.result() if web else None
+        HouveProdutosNuvem = bool(produtos.result()) if produtos else False
+    except BaseException:
+        # o erro e relatado sem esperar o PotreeConverter: tarefas que nao comecaram sao canceladas e os processos externos encerrados
+        cancelamento.set()
+        for tarefa in (web, produtos):
+            if tarefa is not None:
+                tarefa.cancel()
+        for processo in list(processos):
+            if processo.poll() is None:
+                processo.terminate()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+    HouveExportacaoWeb = InstrucoesWeb is not None
+    if HouveExportacaoWeb:
+        ExportaArquivosMsg += InstrucoesWeb
+    resumo = "TEMPO DE EXPORTACAO DE CADA ARTEFATO"
+    for artefato, segundos in tempos:
+        resumo += "\n%-8s %s" % (artefato, datetime.timedelta(seconds=int(segundos)))
+    printNovaAtividade(resumo)
+    # Mensagem final
+    if HouveExportacaoLas or HouveExportacaoTif or HouveExportacaoWeb or HouveProdutosNuvem:
+        printNovaAtividade(ExportaArquivosMsg)
+
+
+@SerializarNoDocumento
+def LimitesDaRegiao(chunk):
+    # Limites (xmin, ymin, zmin, xmax, ymax, zmax) da region no sistema de coordenadas do chunk
+    region = chunk.region
+    T = chunk.transform.matrix
+    pontos = []
+    for sx in (-1, 1):
+        for sy in (-1, 1):
+            for sz in (-1, 1):
+                canto = region.center + region.rot * Metashape.Vector([sx * region.size.x / 2, sy * region.size.y / 2, sz * region.size.z / 2])
+                pontos.append(chunk.crs.project(T.mulp(canto)))
+    return (min(p.x for p in pontos), min(p.y for p in pontos), min(p.z for p in pontos),
+            max(p.x for p in pontos), max(p.y for p in pontos), max(p.z for p in pontos))
+
+
+def AjustarRegiao(chunk, limites):
+    # Ajusta a region do chunk para a caixa (xmin, ymin, zmin, xmax, ymax, zmax), alinhada ao sistema de coordenadas
+    xmin, ymin, zmin, xmax, ymax, zmax = limites
+    centro = chunk.crs.unproject(Metashape.Vector([(xmin + xmax) / 2, (ymin + ymax) / 2, (zmin + zmax) / 2]))
+    AjustarRegiaoLocal(chunk, centro, [xmax - xmin, ymax - ymin, zmax - zmin])
+
+
+def AjustarRegiaoLocal(chunk, centro, dimensoes):
+    # Region com centro geocentrico e dimensoes em metros, alinhada ao referencial local (leste, norte, vertical) do centro
+    T = chunk.transform.matrix
+    m = chunk.crs.localframe(centro) * T
+    escala = math.sqrt(m[0, 0] ** 2 + m[0, 1] ** 2 + m[0, 2] ** 2)
+    R = Metashape.Matrix([[m[0, 0], m[0, 1], m[0, 2]], [m[1, 0], m[1, 1], m[1, 2]], [m[2, 0], m[2, 1], m[2, 2]]]) * (1 / escala)
+    region = chunk.region
+    region.rot = R.t()
+    region.center = T.inv().mulp(centro)
+    region.size = Metashape.Vector(list(dimensoes)) / escala
+    chunk.region = region
+
+
+# Region automatica: grade de CelulasGradeRegiao x CelulasGradeRegiao sobre a area das fotos, e no maximo
+# AmostraTiePointsRegiao tie points lidos (os bindings leem um ponto por vez)
+CelulasGradeRegiao = 256
+AmostraTiePointsRegiao = 200000
+
+
+def MatrizNumpy(matriz, n=4):
+    return numpy.array([[matriz[i, j] for j in range(n)] for i in range(n)], dtype=float)
+
+
+def LerAOI(caminho, crs):
+    # Aneis dos poligonos de um GeoJSON (Polygon, MultiPolygon, Feature ou FeatureCollection) nas coordenadas do projeto.
+    # Coordenadas que parecem lon/lat num projeto com coordenadas projetadas sao convertidas
+    with open(caminho) as arquivo:
+        geojson = json.load(arquivo)
+    geometrias = [feicao['geometry'] for feicao in geojson.get('features', [])] if geojson.get('type') == 'FeatureCollection' \
+        else [geojson.get('geometry', geojson)]
+    aneis = []
+    for geometria in geometrias:
+        poligonos = [geometria['coordinates']] if geometria['type'] == 'Polygon' else \
+            geometria['coordinates'] if geometria['type'] == 'MultiPolygon' else []
+        aneis += [numpy.array(anel, dtype=float)[:, :2] for poligono in poligonos for anel in poligono]
+    if not aneis:
+        raise RuntimeError('O ARQUIVO %s NAO TEM POLIGONOS' % caminho)
+    todos = numpy.concatenate(aneis)
+    if not crs.wkt.startswith("GEOGCS") and (numpy.abs(todos[:, 0]) <= 180).all() and (numpy.abs(todos[:, 1]) <= 90).all():
+        transformar = Transformador(Metashape.CoordinateSystem("EPSG::4326"), crs)
+        aneis = [transformar(numpy.column_stack([anel, numpy.zeros(len(anel))]))[:, :2] for anel in aneis]
+    return aneis
+
+
+def DentroDosPoligonos(x, y, aneis):
+    # Regra par-impar: furos e poligonos separados sao tratados sem distincao entre aneis
+    dentro = numpy.zeros(x.shape, dtype=bool)
+    for anel in aneis:
+        x1, y1 = anel[:, 0], anel[:, 1]
+        x2, y2 = numpy.roll(x1, -1), numpy.roll(y1, -1)
+        for ax, ay, bx, by in zip(x1, y1, x2, y2):
+            if ay == by:
+                continue
+            cruza = ((ay > y) != (by > y)) & (x < ax + (y - ay) * (bx - ax) / (by - ay))
+            dentro ^= cruza
+    return dentro
+
+
+def PegadasDasCameras(cameras, L, solo):
+    # Cantos no terreno (plano horizontal na altura solo, no referencial local L) da imagem de cada camera alinhada.
+    # Raios quase horizontais (fotos obliquas) sao limitados a 5x a altura de voo. None para cameras sem calibracao
+    pegadas = []
+    for camera in cameras:
+        calibracao = camera.sensor.calibration if getattr(camera, 'sensor', None) is not None else None
+        if calibracao is None or not calibracao.f:
+            pegadas.append(None)
+            continue
+        Tc = L @ MatrizNumpy(camera.transform)
+        w, h = calibracao.width, calibracao.height
+        cantos = numpy.array([[0, 0], [w, 0], [w, h], [0, h]], dtype=float)
+        direcoes = numpy.column_stack([(cantos[:, 0] - w / 2 - calibracao.cx) / calibracao.f,
+                                       (cantos[:, 1] - h / 2 - calibracao.cy) / calibracao.f, numpy.ones(4)]) @ Tc[:3, :3].T
+        centro = Tc[:3, 3]
+        altura = max(centro[2] - solo, 1e-3)
+        horizontal = numpy.hypot(direcoes[:, 0], direcoes[:, 1])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            alcance = numpy.where(direcoes[:, 2] < 0, -altura / direcoes[:, 2] * horizontal, numpy.inf)
+            alcance = numpy.minimum(alcance, 5 * altura)
+            pegadas.append(centro[:2] + direcoes[:, :2] / numpy.maximum(horizontal, 1e-12)[:, None] * alcance[:, None])
+    return pegadas
+
+
+@SerializarNoDocumento
+@MedirEtapa('point_cloud')
+def AjustarRegiaoAutomatica(chunk):
+    # Region justa sobre a area util do voo: celulas do terreno cobertas por pelo menos SobreposicaoMinimaRegiao pegadas
+    # de fotos, dentro da distribuicao dos tie points vistos em pelo menos SobreposicaoMinimaRegiao fotos e, se houver,
+    # dentro da AOI. Tudo no referencial local (metros, leste-norte-vertical) do centro das cameras. Retorna True se ajustou
+    if chunk.crs is None or chunk.crs.wkt.startswith("LOCAL_CS"):
+        printNovaAtividade("COORDENADAS LOCAIS\nA REGION NAO FOI AJUSTADA AUTOMATICAMENTE")
+        return False
+    cameras = [camera for camera in chunk.cameras if camera.enabled and camera.transform is not None]
+    pontos = chunk.point_cloud.points if chunk.point_cloud is not None else []
+    if len(cameras) < 2 or len(pontos) == 0:
+        printNovaAtividade("POUCAS CAMERAS ALINHADAS OU SEM TIE POINTS\nA REGION NAO FOI AJUSTADA AUTOMATICAMENTE")
+        return False
+    T = MatrizNumpy(chunk.transform.matrix)
+    internos = numpy.array([MatrizNumpy(camera.transform)[:3, 3] for camera in cameras])
+    centro = Metashape.Vector((T @ numpy.append(internos.mean(axis=0), 1.0))[:3].tolist())
+    referencial = MatrizNumpy(chunk.crs.localframe(centro))
+    L = referencial @ T
+    # amostra dos tie points e numero de fotos que ve cada um
+    passo = max(1, len(pontos) // AmostraTiePointsRegiao)
+    indices = [indice for indice in range(0, len(pontos), passo) if pontos[indice].valid]
+    coordenadas = numpy.array([list(pontos[indice].coord) for indice in indices], dtype=float)
+    if coordenadas.shape[1] == 4:
+        coordenadas = coordenadas[:, :3] / coordenadas[:, 3:]
+    locais = (numpy.column_stack([coordenadas, numpy.ones(len(coordenadas))]) @ L.T)[:, :3]
+    fltr = Metashape.PointCloud.Filter()
+    fltr.init(chunk, Metashape.PointCloud.Filter.ImageCount)
+    fotos = numpy.asarray(fltr.values, dtype=float)[indices]
+    bons = locais[fotos >= SobreposicaoMinimaRegiao]
+    if len(bons) == 0:
+        bons = locais
+    solo = float(numpy.median(bons[:, 2]))
+    pegadas = PegadasDasCameras(cameras, L, solo)
+    # grade sobre a area das pegadas e dos tie points
+    extremos = numpy.concatenate([bons[:, :2]] + [pegada for pegada in pegadas if pegada is not None])
+    minimo, maximo = extremos.min(axis=0), extremos.max(axis=0)
+    celula = max((maximo - minimo).max() / CelulasGradeRegiao, 1e-3)
+    colunas, linhas = (numpy.ceil((maximo - minimo) / celula).astype(int) + 1).tolist()
+    xs = minimo[0] + (numpy.arange(colunas) + 0.5) * celula
+    ys = minimo[1] + (numpy.arange(linhas) + 0.5) * celula
+    gx, gy = numpy.meshgrid(xs, ys, indexing='ij')
+    mascara = numpy.ones((colunas, linhas), dtype=bool)
+    if any(pegada is not None for pegada in pegadas):
+        # sobreposicao: quantas pegadas (quadrilateros convexos) cobrem o centro de cada celula
+        cobertura = numpy.zeros((colunas, linhas), dtype=numpy.int32)
+        for pegada in pegadas:
+            if pegada is None:
+                continue
+            i0, j0 = numpy.clip(numpy.floor((pegada.min(axis=0) - minimo) / celula).astype(int), 0, [colunas - 1, linhas - 1])
+            i1, j1 = numpy.clip(numpy.ceil((pegada.max(axis=0) - minimo) / celula).astype(int) + 1, 1, [colunas, linhas])
+            px, py = gx[i0:i1, j0:j1], gy[i0:i1, j0:j1]
+            lados = [(pegada[k, 0] - px) * (pegada[(k + 1) % 4, 1] - py) - (pegada[k, 1] - py) * (pegada[(k + 1) % 4, 0] - px)
+                     for k in range(4)]
+            cobertura[i0:i1, j0:j1] += (numpy.all([lado >= 0 for lado in lados], axis=0) |
+                                        numpy.all([lado <= 0 for lado in lados], axis=0))
+        mascara &= cobertura >= SobreposicaoMinimaRegiao
+    # distribuicao dos tie points: descarta os 0,5% mais afastados de cada lado
+    baixo, alto = numpy.percentile(bons[:, :2], [0.5, 99.5], axis=0)
+    mascara &= (gx >= baixo[0] - celula) & (gx <= alto[0] + celula) & (gy >= baixo[1] - celula) & (gy <= alto[1] + celula)
+    if ArquivoAOI:
+        # vertices da AOI na altura do terreno, levados ao referencial local
+        altura_solo = chunk.crs.project(centro)[2] + solo
+        aneis = []
+        for anel in LerAOI(ArquivoAOI, chunk.crs):
+            geocentricas = numpy.array([list(chunk.crs.unproject(Metashape.Vector([x, y, altura_solo]))) for x, y in anel])
+            aneis.append((numpy.column_stack([geocentricas, numpy.ones(len(anel))]) @ referencial.T)[:, :2])
+        mascara &= DentroDosPoligonos(gx, gy, aneis)
+    if not mascara.any():
+        printNovaAtividade("NENHUMA AREA COM SOBREPOSICAO DE %d FOTOS%s\nA REGION NAO FOI AJUSTADA AUTOMATICAMENTE"
+                           % (SobreposicaoMinimaRegiao, " DENTRO DA AOI" if ArquivoAOI else ""))
+        return False
+    colunas_usadas, linhas_usadas = numpy.nonzero(mascara.any(axis=1))[0], numpy.nonzero(mascara.any(axis=0))[0]
+    xmin, xmax = minimo[0] + colunas_usadas[0] * celula - MargemRegiao, minimo[0] + (colunas_usadas[-1] + 1) * celula + MargemRegiao
+    ymin, ymax = minimo[1] + linhas_usadas[0] * celula - MargemRegiao, minimo[1] + (linhas_usadas[-1] + 1) * celula + MargemRegiao
+    dentro = bons[(bons[:, 0] >= xmin) & (bons[:, 0] <= xmax) & (bons[:, 1] >= ymin) & (bons[:, 1] <= ymax)]
+    zmin, zmax = numpy.percentile(dentro[:, 2] if len(dentro) else bons[:, 2], [0.5, 99.5])
+    zmin, zmax = zmin - MargemRegiao, zmax + MargemRegiao
+    # cameras cuja pegada (ou centro, sem calibracao) toca a nova region
+    vistas = [pegada if pegada is not None else (L @ MatrizNumpy(camera.transform))[None, :2, 3] for camera, pegada in zip(cameras, pegadas)]
+    cameras_dentro = sum(1 for vista in vistas if vista[:, 0].max() >= xmin and vista[:, 0].min() <= xmax
+                         and vista[:, 1].max() >= ymin and vista[:, 1].min() <= ymax)
+    area_antes = chunk.region.size[0] * chunk.region.size[1] * chunk.transform.scale ** 2
+    area = (xmax - xmin) * (ymax - ymin)
+    centro_regiao = numpy.linalg.inv(referencial) @ numpy.array([(xmin + xmax) / 2, (ymin + ymax) / 2, (zmin + zmax) / 2, 1.0])
+    AjustarRegiaoLocal(chunk, Metashape.Vector(centro_regiao[:3].tolist()), [float(xmax - xmin), float(ymax - ymin), float(zmax - zmin)])
+    # economia prevista pelos modelos do planejador: pontos e pixels proporcionais a area, depthmaps e ortofoto as cameras
+    etapas = [nome for nome, habilitada in [('depthmaps', True), ('densa', True), ('solo', DesejaClassificarGroundPoint),
+              ('mesh', DesejaCalcularSurface), ('dsm', True), ('dem_solo', DesejaCriarNovoDEMSomenteComGroundPoints),
+              ('ortofoto', True), ('exportacao', True)] if habilitada]
+    parametros = dict(DownscaleDepthMaps=DownscaleDepthMaps, MaxNeighbors=MaxNeighbors, DownscaleDem=DownscaleDem)
+    perfil = dict(PerfilDoChunk(chunk, etapas), cameras=len(cameras))
+    perfil['pontos_m'] = DimensoesDasEtapas(perfil, parametros)['pontos_m']
+    perfil_regiao = dict(perfil, cameras=cameras_dentro, pontos_m=perfil['pontos_m'] * min(1.0, area / area_antes) if area_antes else perfil['pontos_m'])
+    fatores, nucleos = LerModeloPlanejador(), os.cpu_count() or 1
+    antes, depois = [sum(tempo for tempo, memoria in EstimarEtapas(p, parametros, etapas, fatores, nucleos).values())
+                     for p in (perfil, perfil_regiao)]
+    printNovaAtividade("REGION AJUSTADA AUTOMATICAMENTE (SOBREPOSICAO MINIMA: %d FOTOS%s)\nAREA: %.1f ha -> %.1f ha (%.0f%%)  ALTURA: %.0f m"
+                       "\nCAMERAS QUE VEEM A REGION: %d DE %d\nTEMPO PREVISTO DO WORKFLOW: %s -> %s (ECONOMIA DE %s)"
+                       % (SobreposicaoMinimaRegiao, ", AOI: %s" % ArquivoAOI if ArquivoAOI else "", area_antes / 1e4, area / 1e4,
+                          100.0 * area / area_antes if area_antes else 100.0, zmax - zmin, cameras_dentro, len(cameras),
+                          datetime.timedelta(seconds=int(antes)), datetime.timedelta(seconds=int(depois)),
+                          datetime.timedelta(seconds=int(max(antes - depois, 0)))))
+    return True
+
+
+@SerializarNoDocumento
+def MetrosPorUnidade(chunk, limites):
+    # Metros por unidade do sistema de coordenadas do chunk nos eixos x e y, medidos a partir do centro dos limites:
+    # perto de 1 em coordenadas projetadas, cerca de 111 km por grau em coordenadas geograficas (lon/lat)
+    xmin, ymin, zmin, xmax, ymax, zmax = limites
+    centro = [(xmin + xmax) / 2, (ymin + ymax) / 2, zmin]
+    origem = numpy.array(list(chunk.crs.unproject(Metashape.Vector(centro))))
+    escalas = []
+    for eixo, extensao in ((0, xmax - xmin), (1, ymax - ymin)):
+        passo = extensao / 2 if extensao > 0 else 1e-6
+        ponto = list(centro)
+        ponto[eixo] += passo
+        escalas.append(float(numpy.linalg.norm(numpy.array(list(chunk.crs.unproject(Metashape.Vector(ponto)))) - origem)) / passo)
+    return escalas
+
+
+def DividirEmTiles(limites, tamanho, sobreposicao):
+    # Divide os limites em tiles de tamanho = (largura, altura), nas unidades do sistema de coordenadas dos limites.
+    # Cada tile tem o nucleo (sem sobreposicao = (x, y)), que e o que vai para o resultado final, e os limites de processamento
+    # (nucleo + sobreposicao)
+    xmin, ymin, zmin, xmax, ymax, zmax = limites
+    (largura, altura), (sx, sy) = tamanho, sobreposicao
+    tiles = []
+    for i in range(max(1, int(math.ceil((xmax - xmin) / largura)))):
+        for j in range(max(1, int(math.ceil((ymax - ymin) / altura)))):
+            nucleo = (xmin + i * largura, ymin + j * altura, min(xmin + (i + 1) * largura, xmax), min(ymin + (j + 1) * altura, ymax))
+            processamento = (max(nucleo[0] - sx, xmin), max(nucleo[1] - sy, ymin), zmin,
+                             min(nucleo[2] + sx, xmax), min(nucleo[3] + sy, ymax), zmax)
+            tiles.append(dict(nome="%d_%d" % (i, j), nucleo=nucleo, processamento=processamento))
+    return tiles
+
+
+@SerializarNoDocumento
+def CamerasDoTile(chunk, limites):
+    # Indices (na ordem do chunk) das cameras alinhadas cuja pegada no terreno toca os limites de processamento do tile.
+    # A pegada e calculada num plano na altura minima do tile, o que a aumenta: na duvida a camera entra. Sem calibracao, vale o centro
+    xmin, ymin, zmin, xmax, ymax, zmax = limites
+    cameras = [(indice, camera) for indice, camera in enumerate(chunk.cameras) if camera.enabled and camera.transform is not None]
+    if not cameras:
+        return []
+    # referencial local (metros, leste-norte-vertical) com origem no centro do tile, na altura minima
+    referencial = MatrizNumpy(chunk.crs.localframe(chunk.crs.unproject(Metashape.Vector([(xmin + xmax) / 2, (ymin + ymax) / 2, zmin]))))
+    L = referencial @ MatrizNumpy(chunk.transform.matrix)
+    cantos = numpy.array([list(chunk.crs.unproject(Metashape.Vector([x, y, zmin]))) + [1.0] for x in (xmin, xmax) for y in (ymin, ymax)])
+    cantos = (cantos @ referencial.T)[:, :2]
+    baixo, alto = cantos.min(axis=0), cantos.max(axis=0)
+    pegadas = PegadasDasCameras([camera for indice, camera in cameras], L, 0.0)
+    selecionadas = []
+    for (indice, camera), pegada in zip(cameras, pegadas):
+        vista = pegada if pegada is not None else (L @ MatrizNumpy(camera.transform))[None, :2, 3]
+        if vista[:, 0].max() >= baixo[0] and vista[:, 0].min() <= alto[0] and vista[:, 1].max() >= baixo[1] and vista[:, 1].min() <= alto[1]:
+            selecionadas.append(indice)
+    return selecionadas
+
+
+@MedirEtapa()
+def ProcessarTile(doc, chunk, tile, grade, **kwargs):
+    # Processa um tile num chunk temporario (copia somente do alinhamento) e exporta a nuvem e a ortofoto.
+    # Somente as cameras que veem o tile ficam habilitadas no chunk temporario: depth maps, nuvem densa e a
+    # verificacao dos depth maps usam so elas. A ortofoto e exportada somente no nucleo do tile, numa grade comum a todos os tiles
+    if Path(tile['las']).exists() and Path(tile['tif']).exists() and Path(tile['tif'] + ".json").exists():
+        print("%sTILE %s JA FOI PROCESSADO" % (PrefixoChunk(), tile['nome']))
+        with open(tile['tif'] + ".json") as arquivo:
+            tile['grade'] = tuple(json.load(arquivo))
+        return
+    selecionadas = set(CamerasDoTile(chunk, tile['processamento']))
+    if not selecionadas:
+        print("%sTILE %s NAO E VISTO POR NENHUMA CAMERA" % (PrefixoChunk(), tile['nome']))
+        tile['vazio'] = True
+        return
+    with TravaDocumento:
+        tile_chunk = chunk.copy(items=[]) # somente cameras e tie points, sem depth maps e nuvem densa
+        tile_chunk.label = chunk.label + "_tile_" + tile['nome']
+    concluido = False
+    try:
+        cameras = []
+        with TravaDocumento:
+            for indice, camera in enumerate(tile_chunk.cameras):
+                if indice in selecionadas:
+                    cameras.append(camera.key)
+                else:
+                    camera.enabled = False
+            InvalidarInventario(tile_chunk)
+            AjustarRegiao(tile_chunk, tile['processamento'])
+            total = len(tile_chunk.cameras)
+        printNovaAtividade("PROCESSANDO O TILE %s (%d DE %d CAMERAS)" % (tile['nome'], len(cameras), total))
+        ConstruirDepthMaps(tile_chunk, kwargs['DownscaleDepthMaps'], kwargs['FilterMode'], kwargs['MaxNeighbors'], cameras)
+        ConstruirNuvemDensa(tile_chunk, kwargs['MaxNeighbors'])
+        CalcularDSM(tile_chunk, ResolucaoDEM(tile_chunk, kwargs.get('DownscaleDem')))
+        BuildMosaic(tile_chunk, kwargs['BlendingMode'])
+        with TravaDocumento:
+            tile_chunk.exportPoints(path=tile['las'], binary=True, save_colors=True, format=FormatoDePontos("LAS"), crs=chunk.crs)
+            # o primeiro tile define a resolucao da ortofoto de todos
+            resolucao = grade.setdefault('resolucao', tile_chunk.orthomosaic.resolution)
+        # nucleo ajustado a grade de pixels, para que os tiles vizinhos se encaixem sem sobra nem falha
+        x0, y0 = grade['origem']
+        xmin, ymin, xmax, ymax = [origem + round((valor - origem) / resolucao) * resolucao
+                                  for valor, origem in zip(tile['nucleo'], (x0, y0, x0, y0))]
+        tile['grade'] = (xmin, ymin, xmax, ymax, resolucao)
         my_projection = Metashape.OrthoProjection()
-        my_projection.crs=chunk.crs
+        my_projection.crs = chunk.crs
         my_compression = Metashape.ImageCompression()
-        my_compression.tiff_compression = Metashape.ImageCompression.TiffCompressionJPEG
-        my_compression.jpeg_quality = 80
-        my_compression.tiff_overviews = True
-        chunk.exportRaster(path=filenameTif, image_format=Metashape.ImageFormat.ImageFormatTIFF, raster_transform=Metashape.RasterTransformType.RasterTransformNone, projection=my_projection, save_alpha=False, image_compression=my_compression, white_background=False, save_scheme=False, save_world=False, description="https://seusite.com.br")
-        HouveExportacaoTif = True
+        my_compression.tiff_compression = Metashape.ImageCompression.TiffCompressionLZW
+        with TravaDocumento:
+            tile_chunk.exportRaster(path=tile['tif'], image_format=Metashape.ImageFormat.ImageFormatTIFF, projection=my_projection,
+                                    region=Metashape.BBox(Metashape.Vector([xmin, ymin]), Metashape.Vector([xmax, ymax])),
+                                    resolution_x=resolucao, resolution_y=resolucao, save_alpha=False,
+                                    image_compression=my_compression, white_background=False)
+        with open(tile['tif'] + ".json", "w") as arquivo:
+            json.dump(tile['grade'], arquivo) # permite juntar os tiles numa proxima execucao sem reprocessa-los
+        concluido = True
+    finally:
+        # um tile que falhou nunca fica no projeto, para nao ser salvo junto com o restante
+        if not (concluido and ManterChunksDosTiles):
+            with TravaDocumento:
+                doc.remove([tile_chunk])
+            InvalidarInventario(tile_chunk)
+    if ManterChunksDosTiles:
+        SalvarDocumento(doc)
+
+
+def LerCabecalhoLas(caminho):
+    with open(caminho, 'rb') as arquivo:
+        cabecalho = arquivo.read(375)
+    if cabecalho[:4] != b'LASF':
+        raise RuntimeError('O ARQUIVO %s NAO E UM LAS' % caminho)
+    versao = (cabecalho[24], cabecalho[25])
+    las = dict(versao=versao,
+               tamanho_cabecalho=struct.unpack_from('<H', cabecalho, 94)[0],
+               offset_pontos=struct.unpack_from('<I', cabecalho, 96)[0],
+               formato=cabecalho[104] & 0x3f,
+               tamanho_registro=struct.unpack_from('<H', cabecalho, 105)[0],
+               pontos=struct.unpack_from('<I', cabecalho, 107)[0],
+               escala=numpy.array(struct.unpack_from('<3d', cabecalho, 131)),
+               offset=numpy.array(struct.unpack_from('<3d', cabecalho, 155)))
+    if versao >= (1, 4):
+        las['pontos'] = struct.unpack_from('<Q', cabecalho, 247)[0] or las['pontos']
+    return las
+
+
+def AbrirSaidaLas(caminho, cabecalho, base):
+    # Saida .las gravada em blocos. Cabecalho e VLRs sao copiados da origem; contagens e limites sao acertados no fim
+    saida = dict(caminho=caminho, arquivo=open(caminho, 'wb'), cabecalho=bytearray(cabecalho), base=base, total=0,
+                 retornos=numpy.zeros(15, dtype=numpy.int64), minimo=numpy.full(3, numpy.inf), maximo=numpy.full(3, -numpy.inf))
+    saida['arquivo'].write(saida['cabecalho'])
+    return saida
+
+
+def GravarPontosLas(saida, bloco, xyz):
+    # bloco: registros (uint8, um ponto por linha) e xyz ja convertidos para coordenadas
+    if len(bloco) == 0:
+        return
+    retorno = bloco[:, 14] & (0x0f if saida['base']['formato'] >= 6 else 0x07)
+    saida['retornos'] += numpy.bincount(retorno, minlength=16)[1:16]
+    saida['minimo'] = numpy.minimum(saida['minimo'], xyz.min(axis=0))
+    saida['maximo'] = numpy.maximum(saida['maximo'], xyz.max(axis=0))
+    saida['total'] += len(bloco)
+    if saida['arquivo'] is None:
+        saida['arquivo'] = open(saida['caminho'], 'ab')
+    saida['arquivo'].write(bloco.tobytes())
+
+
+def PausarSaidaLas(saida):
+    # Fecha o arquivo entre um bloco e outro (muitos tiles abertos esgotam o limite de arquivos do sistema).
+    # A proxima gravacao reabre o arquivo no fim
+    if saida['arquivo'] is not None:
+        saida['arquivo'].close()
+        saida['arquivo'] = None
+
+
+def FecharSaidaLas(saida):
+    # atualiza contagens e limites no cabecalho
+    base, cabecalho, total, retornos = saida['base'], saida['cabecalho'], saida['total'], saida['retornos']
+    minimo, maximo = saida['minimo'], saida['maximo']
+    if total == 0:
+        minimo = maximo = numpy.zeros(3)
+    struct.pack_into('<I', cabecalho, 107, total if total < 2 ** 32 and base['formato'] < 6 else 0)
+    struct.pack_into('<5I', cabecalho, 111, *[int(n) if total < 2 ** 32 and base['formato'] < 6 else 0 for n in retornos[:5]])
+    struct.pack_into('<6d', cabecalho, 179, maximo[0], minimo[0], maximo[1], minimo[1], maximo[2], minimo[2])
+    if base['versao'] >= (1, 4):
+        struct.pack_into('<8sI', cabecalho, 235, bytes(8), 0) # sem EVLRs
+        struct.pack_into('<Q', cabecalho, 247, total)
+        struct.pack_into('<15Q', cabecalho, 255, *[int(n) for n in retornos])
+    if saida['arquivo'] is None:
+        saida['arquivo'] = open(saida['caminho'], 'r+b')
+    saida['arquivo'].seek(0)
+    saida['arquivo'].write(cabecalho[:base['tamanho_cabecalho']])
+    saida['arquivo'].close()
+    return total
+
+
+def MesclarLas(tiles, destino, pontos_por_bloco=1000000):
+    # Junta os .las dos tiles num unico arquivo, mantendo de cada tile somente os pontos do seu nucleo.
+    # Os pontos sao lidos em blocos (memmap), com memoria limitada. Cabecalho e VLRs (CRS) vem do primeiro tile
+    base = LerCabecalhoLas(tiles[0]['las'])
+    with open(tiles[0]['las'], 'rb') as arquivo:
+        cabecalho = arquivo.read(base['offset_pontos'])
+    saida = AbrirSaidaLas(destino + ".parcial", cabecalho, base)
+    try:
+        for tile in tiles:
+            las = LerCabecalhoLas(tile['las'])
+            if (las['formato'], las['tamanho_registro']) != (base['formato'], base['tamanho_registro']):
+                raise RuntimeError('O TILE %s TEM FORMATO DE PONTO DIFERENTE DOS DEMAIS' % tile['nome'])
+            if las['pontos'] == 0:
+                continue
+            registros = numpy.memmap(tile['las'], dtype=numpy.uint8, mode='r', offset=las['offset_pontos'],
+                                     shape=(las['pontos'], las['tamanho_registro']))
+            xmin, ymin, xmax, ymax = tile['nucleo']
+            for inicio in range(0, las['pontos'], pontos_por_bloco):
+                bloco = numpy.array(registros[inicio:inicio + pontos_por_bloco])
+                xyz = bloco[:, :12].copy().view('<i4') * las['escala'] + las['offset']
+                # nucleos vizinhos compartilham a borda: o ponto fica no tile a esquerda/abaixo
+                dentro = (xyz[:, 0] >= xmin) & (xyz[:, 0] <= xmax) & (xyz[:, 1] >= ymin) & (xyz[:, 1] <= ymax)
+                if tile.get('borda_x'):
+                    dentro &= xyz[:, 0] < xmax
+                if tile.get('borda_y'):
+                    dentro &= xyz[:, 1] < ymax
+                bloco, xyz = bloco[dentro], xyz[dentro]
+                if len(bloco) == 0:
+                    continue
+                inteiros = numpy.round((xyz - base['offset']) / base['escala']).astype('<i4')
+                bloco[:, :12] = inteiros.view(numpy.uint8).reshape(-1, 12)
+                GravarPontosLas(saida, bloco, inteiros * base['escala'] + base['offset'])
+            del registros
+    finally:
+        total = FecharSaidaLas(saida)
+    os.replace(destino + ".parcial", destino)
+    return total
+
+
+def MesclarOrtofotos(tiles, destino, crs, vrt=None):
+    # Monta um mosaico virtual (.vrt) com as ortofotos dos tiles, que estao numa grade comum e nao se sobrepoem.
+    # Se o GDAL estiver disponivel no Python do Metashape, o mosaico e convertido num unico GeoTIFF. Retorna o arquivo gerado
+    xmin = min(tile['grade'][0] for tile in tiles)
+    ymax = max(tile['grade'][3] for tile in tiles)
+    xmax = max(tile['grade'][2] for tile in tiles)
+    ymin = min(tile['grade'][1] for tile in tiles)
+    resolucao = tiles[0]['grade'][4]
+    largura = int(round((xmax - xmin) / resolucao))
+    altura = int(round((ymax - ymin) / resolucao))
+    vrt = vrt or os.path.splitext(destino)[0] + ".vrt"
+    linhas = ['<VRTDataset rasterXSize="%d" rasterYSize="%d">' % (largura, altura),
+              '  <SRS>%s</SRS>' % html.escape(crs.wkt),
+              '  <GeoTransform>%.10f, %.10f, 0, %.10f, 0, %.10f</GeoTransform>' % (xmin, resolucao, ymax, -resolucao)]
+    for banda, cor in enumerate(["Red", "Green", "Blue"], 1):
+        linhas.append('  <VRTRasterBand dataType="Byte" band="%d">' % banda)
+        linhas.append('    <ColorInterp>%s</ColorInterp>' % cor)
+        for tile in tiles:
+            txmin, tymin, txmax, tymax, _ = tile['grade']
+            w, h = int(round((txmax - txmin) / resolucao)), int(round((tymax - tymin) / resolucao))
+            linhas += ['    <SimpleSource>',
+                       '      <SourceFilename relativeToVRT="1">%s</SourceFilename>' % os.path.relpath(tile['tif'], os.path.dirname(vrt)),
+                       '      <SourceBand>%d</SourceBand>' % banda,
+                       '      <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>' % (w, h),
+                       '      <DstRect xOff="%d" yOff="%d" xSize="%d" ySize="%d"/>' % (int(round((txmin - xmin) / resolucao)), int(round((ymax - tymax) / resolucao)), w, h),
+                       '    </SimpleSource>']
+        linhas.append('  </VRTRasterBand>')
+    linhas.append('</VRTDataset>')
+    with open(vrt, 'w') as arquivo:
+        arquivo.write("\n".join(linhas) + "\n")
+    try:
+        from osgeo import gdal
+    except ImportError:
+        print("GDAL NAO DISPONIVEL. O MOSAICO FICA NUM ARQUIVO VIRTUAL (.vrt)")
+        return vrt
+    gdal.Translate(destino, vrt, creationOptions=["TILED=YES", "COMPRESS=JPEG", "JPEG_QUALITY=80", "PHOTOMETRIC=YCBCR", "BIGTIFF=IF_SAFER"])
+    gdal.Open(destino, gdal.GA_Update).BuildOverviews("AVERAGE", [2, 4, 8, 16, 32])
+    return destino
+
+
+def ImpressaoDosTiles(tiles, chave, opcoes):
+    # Impressao de um arquivo juntado: nome, tamanho e data dos arquivos dos tiles e as opcoes da juncao
+    arquivos = [[os.path.basename(tile[chave]), os.stat(tile[chave]).st_size, os.stat(tile[chave]).st_mtime_ns] for tile in tiles]
+    return hashlib.sha1(json.dumps([arquivos, opcoes], default=str).encode()).hexdigest()
+
+
+def WorkflowEmTiles(doc, chunk, **kwargs):
+    # Alternativa ao StandardWorkflow para areas grandes: nuvem densa, DSM e ortofoto sao calculados por tile
+    # e os resultados sao juntados numa unica nuvem (FormatoNuvem) e num unico mosaico na pasta de exportacao
+    ignoradas = [nome for nome, ativa in [("DesejaClassificarGroundPoint", DesejaClassificarGroundPoint),
+                                          ("DesejaCalcularSurface", DesejaCalcularSurface),
+                                          ("DesejaCriarNovoDEMSomenteComGroundPoints", DesejaCriarNovoDEMSomenteComGroundPoints),
+                                          ("FormatoOrtofoto = \"%s\"" % FormatoOrtofoto, FormatoOrtofoto != "tif")] if ativa]
+    # o modo em tiles nao usa o manifesto de etapas nem a PoliticaDeSalvamento: os tiles sao retomados pelos arquivos exportados
+    if ignoradas:
+        printNovaAtividade("ATENCAO: O PROCESSAMENTO EM TILES IGNORA AS OPCOES ABAIXO\n%s\n"
+                           "SAO GERADAS SOMENTE A NUVEM E A ORTOFOTO .tif (SEM SOLO, MESH E DEM DE SOLO)" % "\n".join(ignoradas))
+    PastaDeExportacaoCaminhoCompleto = kwargs['PastaDeExportacaoCaminhoCompleto']
+    NomeProjeto = NomeDosArtefatos(doc, chunk)
+    pasta = Path(PastaDeExportacaoCaminhoCompleto) / (NomeProjeto + "_tiles")
+    pasta.mkdir(exist_ok=True)
+    if chunk.crs is None or chunk.crs.wkt.startswith("LOCAL_CS"):
+        raise RuntimeError('O PROCESSAMENTO EM TILES EXIGE UM SISTEMA DE COORDENADAS GEORREFERENCIADO (O CHUNK ESTA EM COORDENADAS LOCAIS)')
+    limites = LimitesDaRegiao(chunk)
+    # TamanhoTile e SobreposicaoTile estao em metros; os tiles sao retangulos no sistema de coordenadas do chunk (graus, se geografico)
+    metros = MetrosPorUnidade(chunk, limites)
+    tiles = DividirEmTiles(limites, [TamanhoTile / escala for escala in metros], [SobreposicaoTile / escala for escala in metros])
+    for tile in tiles:
+        tile['las'] = str(pasta / ("%s_%s%s" % (NomeProjeto, tile['nome'], ExtensoesNuvem["las"]))) # LAS: MesclarLas le os registros
+        tile['tif'] = str(pasta / ("%s_%s.tif" % (NomeProjeto, tile['nome'])))
+        tile['borda_x'] = tile['nucleo'][2] < limites[3]
+        tile['borda_y'] = tile['nucleo'][3] < limites[4]
+    printNovaAtividade("PROCESSAMENTO EM %d TILES DE %dm (SOBREPOSICAO %dm)\nAREA: %.0f x %.0f m" \
+            % (len(tiles), TamanhoTile, SobreposicaoTile, (limites[3] - limites[0]) * metros[0], (limites[4] - limites[1]) * metros[1]))
+    grade = dict(origem=(limites[0], limites[1]))
+    for tile in tiles:
+        # tiles exportados numa execucao anterior definem a resolucao dos que faltam
+        if Path(tile['tif'] + ".json").exists():
+            with open(tile['tif'] + ".json") as arquivo:
+                grade['resolucao'] = json.load(arquivo)[4]
+            break
+    PrepararDepthMaps(doc, chunk, kwargs['DownscaleDepthMaps'], kwargs['FilterMode'], kwargs['MaxNeighbors'])
+    label = getattr(ContextoChunk, 'label', None)
+
+    def Processar(tile):
+        ContextoChunk.label = label
+        ProcessarTile(doc, chunk, tile, grade, **kwargs)
+
+    if MaxTilesEmParalelo > 1 and not ParalelismoExperimental:
+        printNovaAtividade("MaxTilesEmParalelo = %d EXIGE ParalelismoExperimental = True (EXPERIMENTAL)\nOS TILES SERAO PROCESSADOS UM APOS O OUTRO" % MaxTilesEmParalelo)
+    if MaxTilesEmParalelo <= 1 or not ParalelismoExperimental:
+        for tile in tiles:
+            Processar(tile)
     else:
-        printNovaAtividade("A ORTOFOTO NAO FOI EXPORTADA.\nJA EXISTE UM ARQUIVO %s\nAPAGUE-O E RODE ESTE SCRIPT NOVAMENTE" % filenameTif)
-
-    HouveExportacaoWeb = False
-    ZipFileName = NomeProjeto + "_web.zip"
-    filenameZip = str(Path(PastaDeExportacaoCaminhoCompleto) / ZipFileName)
-    filenameTxt = filenameZip.replace('.zip', '_instrucoes_deploy.txt')
-    PotreeExe = kwargs['PotreeExe']
-    WwwFolder = str(Path(PastaDeExportacaoCaminhoCompleto) / "www")
-    PotreeCmd = PotreeExe + " " + filenameLas + " -o " + WwwFolder + " --generate-page index"
-    if not Path(filenameZip).exists():
-        if Path(PotreeExe).exists():
-            printNovaAtividade("GERANDO PAGINA WEB EM\n%s" % filenameZip)
-            check_output(PotreeCmd, shell=True).decode() # converte o arquivo .las em aplicacao web
-            zipf = zipfile.ZipFile(filenameZip, 'w', zipfile.ZIP_DEFLATED); zipdir(WwwFolder, zipf); zipf.close()
-            shutil.rmtree(WwwFolder) # apaga a pasta com a aplicacao web apos a compactacao
-            HouveExportacaoWeb = True
-            ExportaArquivosMsg += "\n\nInstrucoes para deploy da aplicacao web:\n\n"
-            ExportaArquivosMsg += "cd /var/www/html/otherapps/pointcloud\n"
-            ExportaArquivosMsg += "unzip -d %s %s\n" % (NomeProjeto, ZipFileName)
-            ExportaArquivosMsg += "chown -R www-data:www-data /var/www/html/otherapps/pointcloud/%s\n\n" % NomeProjeto
-            ExportaArquivosMsg += "rm %s\n" % ZipFileName
-            ExportaArquivosMsg += "Endereco: https://seusite.com.br/pointcloud/%s\n" % NomeProjeto
-            arquivoTxt = open(filenameTxt,"w+"); arquivoTxt.write(ExportaArquivosMsg); arquivoTxt.close()
+        with ThreadPoolExecutor(max_workers=MaxTilesEmParalelo) as executor:
+            list(executor.map(Processar, tiles))
+    tiles = [tile for tile in tiles if not tile.get('vazio')]
+    if not tiles:
+        raise RuntimeError('NENHUM TILE E VISTO PELAS CAMERAS. CONFIRA A REGION')
+
+    # os arquivos juntados so sao refeitos quando algum tile muda (impressao dos arquivos dos tiles)
+    def JuntarLas(destino):
+        inicio = time.time()
+        if FormatoNuvem == "las":
+            print("PONTOS: %d" % MesclarLas(tiles, destino))
         else:
-            printNovaAtividade("A APLICACAO WEB NAO FOI GERADA.\nO EXECUTAVEL %s, NAO FOI ENCONTRADO" % PotreeExe)
+            # os tiles sao juntados num .las temporario, que o PDAL converte em LAZ ou COPC
+            if shutil.which(PdalExe) is None:
+                raise RuntimeError('O PDAL (%s) NAO FOI ENCONTRADO. ELE E NECESSARIO PARA GERAR O %s DOS TILES' % (PdalExe, FormatoNuvem.upper()))
+            las = os.path.splitext(destino)[0] + ".mescla.las"
+            try:
+                print("PONTOS: %d" % MesclarLas(tiles, las))
+                ExecutarFerramentaExterna([PdalExe, "translate", las, destino, "--writer"] +
+                                          (["writers.copc"] if FormatoNuvem == "copc" else ["writers.las", "--writers.las.compression=laszip"]))
+            finally:
+                if os.path.exists(las):
+                    os.remove(las)
+        ValidarNuvem(destino, FormatoNuvem, time.time() - inicio)
+
+    filenameLas = str(Path(PastaDeExportacaoCaminhoCompleto) / (NomeProjeto + ExtensoesNuvem[FormatoNuvem]))
+    impressao = ImpressaoDosTiles(tiles, 'las', [[tile['nucleo'], tile['borda_x'], tile['borda_y']] for tile in tiles] + [FormatoNuvem])
+    if ArtefatoAtualizado(filenameLas, impressao):
+        printNovaAtividade("A NUVEM DE PONTOS DOS TILES JA ESTA ATUALIZADA EM \n%s" % filenameLas)
     else:
-        printNovaAtividade("A APLICACAO WEB NAO FOI GERADA.\nJA EXISTE UM ARQUIVO %s\nAPAGUE-O E RODE ESTE SCRIPT NOVAMENTE" % filenameZip)
-    # Mensagem final
-    if HouveExportacaoLas or HouveExportacaoTif or HouveExportacaoWeb:
-        printNovaAtividade(ExportaArquivosMsg)
+        printNovaAtividade("JUNTANDO AS NUVENS DE PONTOS DOS TILES EM \n%s" % filenameLas)
+        GravarArtefato(filenameLas, impressao, JuntarLas)
+    filenameTif = str(Path(PastaDeExportacaoCaminhoCompleto) / (NomeProjeto + '.tif'))
+    vrt = os.path.splitext(filenameTif)[0] + ".vrt"
+    try:
+        from osgeo import gdal
+        mosaico = filenameTif
+    except ImportError:
+        mosaico = vrt # sem GDAL o mosaico final e o proprio .vrt
+    impressao = ImpressaoDosTiles(tiles, 'tif', [[tile['grade'] for tile in tiles], chunk.crs.wkt])
+    if ArtefatoAtualizado(mosaico, impressao):
+        printNovaAtividade("A ORTOFOTO DOS TILES JA ESTA ATUALIZADA EM \n%s" % mosaico)
+    else:
+        printNovaAtividade("JUNTANDO AS ORTOFOTOS DOS TILES EM \n%s" % mosaico)
+        GravarArtefato(mosaico, impressao, lambda destino: MesclarOrtofotos(tiles, destino, chunk.crs, destino if mosaico == vrt else vrt))
+    InstrucoesWeb = GerarAplicacaoWeb(filenameLas, PastaDeExportacaoCaminhoCompleto, NomeProjeto, kwargs['PotreeExe'],
+                                      kwargs.get('FormatoPacoteWeb', FormatoPacoteWeb))
+    if DesejaGerarProdutosNuvem:
+        GerarProdutosNuvem(filenameLas, PastaDeExportacaoCaminhoCompleto, NomeProjeto, ProdutosNuvem, PontosPorBloco, ThreadsProdutosNuvem)
+    printNovaAtividade("FIM DO PROCESSAMENTO EM TILES! \nNUVEM DE PONTOS: %s\nORTOFOTO: %s%s" % (filenameLas, mosaico, InstrucoesWeb or ""))
+
+
+@SerializarNoDocumento
+def ResolucaoDEM(chunk, downscale_dem=None):
+    # Resolucao do DEM/DSM: resolucao da nuvem densa multiplicada por DownscaleDem (ou pelo escolhido pelo planejador)
+    return float(chunk.dense_cloud.meta['BuildDenseCloud/resolution']) * chunk.transform.scale * (downscale_dem or DownscaleDem)
 
 
 def GetResolution(chunk):
-    DEM_resolution = float(chunk.dense_cloud.meta['BuildDenseCloud/resolution']) * chunk.transform.scale
-    DEM_resolution *= DownscaleDem
+    DEM_resolution = ResolucaoDEM(chunk)
     Image_resolution = DEM_resolution / int(chunk.dense_cloud.meta['BuildDepthMaps/downscale'])
     print("RESOLUCAO DO DEM: %.8f - RESOLUCAO DA IMAGEM: %.8f" % (DEM_resolution, Image_resolution))
     return DEM_resolution, Image_resolution
 
 
-def ReduceError_RU(chunk, init_threshold=15):
-    printNovaAtividade("FAZ O REALINHAMENTO DAS CAMERAS ELIMINANDO INCERTEZA DE RECONSTRUCAO")
+# Parametros de otimizacao usados entre as rodadas de selecao gradual
+OtimizacaoBasica = dict(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=False, fit_b2=False,
+                        fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=False,
+                        fit_p1=True, fit_p2=True, fit_p3=False, fit_p4=False,
+                        adaptive_fitting=False, tiepoint_covariance=False)
+OtimizacaoCompleta = dict(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True,
+                          fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=True,
+                          fit_p1=True, fit_p2=True, fit_p3=True, fit_p4=True,
+                          adaptive_fitting=False, tiepoint_covariance=False)
+
+
+def CalcularThresholdSelecaoGradual(valores, init_threshold, passo, fracao, threshold_max=None):
+    # Le os valores do filtro uma unica vez e acha, por busca binaria na grade de thresholds do loop antigo,
+    # o menor threshold que seleciona menos que (fracao * total) pontos, sem chamar fltr.selectPoints e contar os
+    # pontos selecionados a cada passo. A grade e a mesma do loop antigo: passo somado repetidamente ao threshold
+    # (com o mesmo arredondamento) e, com threshold_max, o ultimo threshold e o primeiro que passa de threshold_max.
+    # Retorna (threshold, numero de passos economizados, numero de pontos que serao selecionados)
+    valores = numpy.sort(numpy.asarray(valores, dtype=numpy.float64))
+    total = len(valores)
+    limite = total * fracao
+    # acima do maior valor nenhum ponto e selecionado, o que limita a busca
+    k_max = max(0, int(math.ceil((valores[-1] - init_threshold) / passo)) + 1) if total else 0
+    if threshold_max is not None:
+        # o loop antigo somava passo enquanto o threshold fosse <= threshold_max
+        k_limite, threshold = 0, init_threshold
+        while threshold <= threshold_max:
+            threshold += passo
+            k_limite += 1
+        k_max = min(k_max, k_limite)
+    grade = numpy.add.accumulate(numpy.concatenate([[init_threshold], numpy.full(k_max, passo)]))
+
+    def selecionados(k):
+        # selectPoints seleciona os pontos com valor acima do threshold
+        return total - int(numpy.searchsorted(valores, grade[k], side='right'))
+
+    k_min = 0
+    while k_min < k_max:
+        k = (k_min + k_max) // 2
+        if selecionados(k) >= limite:
+            k_min = k + 1
+        else:
+            k_max = k
+    return float(grade[k_min]), k_min, selecionados(k_min)
+
+
+def SelecaoGradual(chunk, criterio, max_value, init_threshold, passo, fracao, otimizacao, threshold_max=None):
+    # Motor da selecao gradual usado pelos ReduceError_*. Remove os tie points acima do threshold e
+    # reotimiza as cameras enquanto o maior valor do filtro estiver acima de max_value.
     tie_points = chunk.point_cloud
     fltr = Metashape.PointCloud.Filter()
-    fltr.init(chunk, Metashape.PointCloud.Filter.ReconstructionUncertainty)
-    threshold = init_threshold
-    while fltr.max_value > 15:
+    fltr.init(chunk, criterio)
+    rodadas = 0
+    passos_economizados = 0
+    while fltr.max_value > max_value:
+        threshold, passos, nselected = CalcularThresholdSelecaoGradual(fltr.values, init_threshold, passo, fracao, threshold_max)
+        if nselected == 0:
+            print("NENHUM PONTO ACIMA DO THRESHOLD %f. ENCERRANDO A SELECAO GRADUAL" % threshold)
+            break
+        rodadas += 1
+        passos_economizados += passos
+        print("NOVO THRESHOLD: %f  PONTOS SELECIONADOS: %d" % (threshold, nselected))
         fltr.selectPoints(threshold)
-        nselected = len([p for p in tie_points.points if p.selected])
-        if nselected >= len(tie_points.points) / 2 and threshold <= 50:
-            fltr.resetSelection()
-            threshold += 1
-            print("NOVO THRESHOLD: %d" % threshold)
-            continue
         tie_points.removeSelectedPoints()
-        chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=False, fit_b2=False,
-                              fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=False,
-                              fit_p1=True, fit_p2=True, fit_p3=False, fit_p4=False,
-                              adaptive_fitting=False, tiepoint_covariance=False)
-        fltr.init(chunk, Metashape.PointCloud.Filter.ReconstructionUncertainty)
-        threshold = init_threshold
+        chunk.optimizeCameras(**otimizacao)
+        fltr.init(chunk, criterio)
+    print("SELECAO GRADUAL: %d RODADAS DE OTIMIZACAO, %d RODADAS DE FILTRO/CONTAGEM ECONOMIZADAS" % (rodadas, passos_economizados))
+    return rodadas, passos_economizados
+
+
+def ReduceError_RU(chunk, init_threshold=15):
+    printNovaAtividade("FAZ O REALINHAMENTO DAS CAMERAS ELIMINANDO INCERTEZA DE RECONSTRUCAO")
+    SelecaoGradual(chunk, Metashape.PointCloud.Filter.ReconstructionUncertainty, max_value=15,
+                   init_threshold=init_threshold, passo=1, fracao=1 / 2, otimizacao=OtimizacaoBasica, threshold_max=50)
 
 
 def ReduceError_PA(chunk, init_threshold=2.0):
     printNovaAtividade("FAZ O REALINHAMENTO DAS CAMERAS ELIMINANDO PRECISAO DE PROJECAO")
-    tie_points = chunk.point_cloud
-    fltr = Metashape.PointCloud.Filter()
-    fltr.init(chunk, Metashape.PointCloud.Filter.ProjectionAccuracy)
-    threshold = init_threshold
-    while fltr.max_value > 2.0:
-        fltr.selectPoints(threshold)
-        nselected = len([p for p in tie_points.points if p.selected])
-        if nselected >= len(tie_points.points) / 2 and threshold <= 3.0:
-            fltr.resetSelection()
-            threshold += 0.1
-            print("NOVO THRESHOLD: %f" % (threshold ** 2))
-            continue
-        tie_points.removeSelectedPoints()
-        chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=False, fit_b2=False,
-                              fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=False,
-                              fit_p1=True, fit_p2=True, fit_p3=False, fit_p4=False,
-                              adaptive_fitting=False, tiepoint_covariance=False)
-        fltr.init(chunk, Metashape.PointCloud.Filter.ProjectionAccuracy)
-        threshold = init_threshold
+    SelecaoGradual(chunk, Metashape.PointCloud.Filter.ProjectionAccuracy, max_value=2.0,
+                   init_threshold=init_threshold, passo=0.1, fracao=1 / 2, otimizacao=OtimizacaoBasica, threshold_max=3.0)
     # This is to tighten tie point accuracy value
     chunk.tiepoint_accuracy = 0.1
-    chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True,
-                          fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=True,
-                          fit_p1=True, fit_p2=True, fit_p3=True, fit_p4=True,
-                          adaptive_fitting=False, tiepoint_covariance=False)
+    chunk.optimizeCameras(**OtimizacaoCompleta)
 
 
 def ReduceError_RE(chunk, init_threshold=0.3):
     # This is used to reduce error based on repeojection error
     printNovaAtividade("FAZ O REALINHAMENTO DAS CAMERAS ELIMINANDO ERRO DE REPROJECAO")
-    tie_points = chunk.point_cloud
-    fltr = Metashape.PointCloud.Filter()
-    fltr.init(chunk, Metashape.PointCloud.Filter.ReprojectionError)
-    threshold = init_threshold
-    while fltr.max_value > 0.3:
-        fltr.selectPoints(threshold)
-        nselected = len([p for p in tie_points.points if p.selected])
-        if nselected >= len(tie_points.points) / 10:
-            fltr.resetSelection()
-            threshold += 0.01
-            print("NOVO THRESHOLD: %f" % (threshold ** 2))
-            continue
-        tie_points.removeSelectedPoints()
-        chunk.optimizeCameras(fit_f=True, fit_cx=True, fit_cy=True, fit_b1=True, fit_b2=True,
-                              fit_k1=True, fit_k2=True, fit_k3=True, fit_k4=True,
-                              fit_p1=True, fit_p2=True, fit_p3=True, fit_p4=True,
-                              adaptive_fitting=False, tiepoint_covariance=False)
-        fltr.init(chunk, Metashape.PointCloud.Filter.ReprojectionError)
-        threshold = init_threshold
+    SelecaoGradual(chunk, Metashape.PointCloud.Filter.ReprojectionError, max_value=0.3,
+                   init_threshold=init_threshold, passo=0.01, fracao=1 / 10, otimizacao=OtimizacaoCompleta)
 
 
-def HasDisabledPhotos(chunk):
-    result = False
+# Inventario das cameras de cada chunk, montado numa unica passada e compartilhado pelas verificacoes
+# (fotos desabilitadas, depth maps, qualidade). Toda funcao que altera as cameras deve invalida-lo.
+InventariosChunks = dict()
+
+
+def ConstruirInventario(chunk):
+    inventario = dict(cameras=dict(), # key -> camera, na ordem do chunk
+                      habilitadas=set(),
+                      desabilitadas=set(),
+                      com_depth_map=set(),
+                      com_referencia=set(),
+                      qualidade=dict()) # key -> nota de cada banda. Somente cameras com todas as bandas avaliadas
+    if chunk.depth_maps is not None:
+        inventario['com_depth_map'] = set(camera.key for camera in chunk.depth_maps.keys())
     for camera in chunk.cameras:
-        if camera.enabled is False:
-            result = True
-            break
-    return result
+        key = camera.key
+        inventario['cameras'][key] = camera
+        if camera.enabled:
+            inventario['habilitadas'].add(key)
+        else:
+            inventario['desabilitadas'].add(key)
+        if camera.reference.location:
+            inventario['com_referencia'].add(key)
+        notas = [band.meta['Image/Quality'] for band in camera.planes]
+        if notas and None not in notas:
+            inventario['qualidade'][key] = [float(nota) for nota in notas]
+    return inventario
+
+
+def InventarioDoChunk(chunk):
+    with TravaDocumento:
+        if chunk.key not in InventariosChunks:
+            InventariosChunks[chunk.key] = ConstruirInventario(chunk)
+        return InventariosChunks[chunk.key]
+
+
+def InvalidarInventario(chunk):
+    with TravaDocumento:
+        InventariosChunks.pop(chunk.key, None)
+
+
+def CamerasDoInventario(inventario, keys):
+    # Cameras das keys informadas, na ordem do chunk
+    return [camera for key, camera in inventario['cameras'].items() if key in keys]
+
+
+def HasDisabledPhotos(chunk):
+    return len(InventarioDoChunk(chunk)['desabilitadas']) > 0
 
 
 # As vezes o programa nao calcula do depthmap de uma ou outra imagem. isso gera o erro "null image" ao calcular a nuvem de pontos.
 # Ate duas imagens com esse problema, elas sao desabilitadas e o script prossegue, mais que isso, o programa gera um erro.
 def VerificarSeTodasAsFotosPossuemDepthMap(chunk):
-    imagensSemDepthMap = list()
-    for camera in chunk.cameras:
-        if camera.enabled is True:
-            if camera not in chunk.depth_maps.keys():
-                imagensSemDepthMap.append(camera)
+    inventario = InventarioDoChunk(chunk)
+    imagensSemDepthMap = CamerasDoInventario(inventario, inventario['habilitadas'] - inventario['com_depth_map'])
     if len(imagensSemDepthMap) > 0:
         if len(imagensSemDepthMap) <= 2:
             for camera in imagensSemDepthMap:
                 camera.enabled = False # desabilita a camera
                 print("A CAMERA [" + camera.label + " ] FOI DESABILITADA POR NAO TER DEPTHMAP")
+            InvalidarInventario(chunk)
         else:
             cameraList = ""
             for camera in imagensSemDepthMap:
@@ -441,99 +2328,824 @@ def VerificarSeTodasAsFotosPossuemDepthMap(chunk):
         # raise RuntimeError('A foto [%s] NAO POSSUI DEPTH MAP. DESABILITE-A E VOLTE A RODAR ESTE SCRIPT' % camera.label)
 
 
-def RemoveDisabledPhotos(chunk):
+# Log das fotos movidas pela triagem, gravado dentro de cada pasta FotosDescartadas
+ArquivoLogTriagem = "triagem.json"
+
+
+@SerializarNoDocumento
+@MedirEtapa()
+def RemoveDisabledPhotos(chunk, threads=None):
     printNovaAtividade("REMOVE AS CAMERAS DESABILITADAS DO PROJETO E MOVE AS FOTOS PARA A PASTA \"FotosDescartadas\"")
-    # print (datetime.datetime.now())
-    # chunk = doc.chunk
+    threads = threads or ThreadsTriagem
     counter = 0
     counter_fail = 0
-    counter_not_moved = 0
     counter_errors = 0
-    counter_cameras = 0
-    lenght = len(chunk.cameras)
+    inventario = InventarioDoChunk(chunk)
+    lenght = len(inventario['cameras'])
     message = 'STARTING TO EVALUATE ' + str(lenght) + ' PHOTOS...'
     print (message)
-    for camera in chunk.cameras:
-        if camera.enabled is True:
-            counter_not_moved = counter_not_moved + 1
-            continue # skipping enabled cameras
+    counter_not_moved = len(inventario['habilitadas']) # skipping enabled cameras
+    # 1. Planeja todas as movimentacoes, agrupadas pela pasta de destino
+    planos = dict()
+    for camera in CamerasDoInventario(inventario, inventario['desabilitadas']):
         photo_path = Path(camera.photo.path)
-        photo_name = str(camera.label)
-        destination_dir = photo_path.parent / 'FotosDescartadas'
-        destination = destination_dir / photo_path.name
+        planos.setdefault(photo_path.parent / 'FotosDescartadas', []).append((camera, photo_path))
+    # 2. Cria cada pasta de destino uma unica vez
+    movimentacoes = []
+    for destination_dir, cameras in planos.items():
         if not destination_dir.exists():
             try:
                 destination_dir.mkdir()
                 print ("SUCCESSFULLY CREATED THE DIRECTORY %s " % destination_dir)
             except OSError:
                 print ('ERROR CREATING %s' % destination_dir)
-                counter_errors = counter_errors + 1
+                counter_errors = counter_errors + len(cameras)
                 continue # we can't create directory - thus we can't move photo - thus we shouldn't delete it
+        movimentacoes += [(camera, photo_path, destination_dir / photo_path.name) for camera, photo_path in cameras]
+
+    # 3. Move as fotos em paralelo
+    def Mover(movimentacao):
+        camera, photo_path, destination = movimentacao
         try:
-            if photo_path.is_file():
-                print ('MOVING %s ...' % photo_name)
-                shutil.move(str(photo_path), str(destination))
-                counter = counter + 1
-                counter_cameras = counter_cameras + 1
-            else:
-                print ('PHOTO %s DOES NOT EXIST!' % photo_name)
-                counter_cameras = counter_cameras + 1
-                counter_fail = counter_fail + 1
-            chunk.remove(camera)
+            if not photo_path.is_file():
+                return 'inexistente'
+            shutil.move(str(photo_path), str(destination)) # rename no mesmo sistema de arquivos, senao copia e apaga
+            return 'movida'
         except OSError:
+            return 'erro'
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        resultados = list(executor.map(Mover, movimentacoes))
+
+    # 4. Remove as cameras do chunk de uma so vez e grava o log que permite desfazer a triagem
+    cameras_removidas = []
+    log = dict()
+    for (camera, photo_path, destination), resultado in zip(movimentacoes, resultados):
+        if resultado == 'erro':
             counter_errors = counter_errors + 1
-            print ('Error %s!' % photo_name)
-    message_end = 'SUCCESS, ' + str(counter) + ' PHOTOS MOVED, ' + str(counter_not_moved) + ' PHOTOS NOT MOVED.\nNUMBER OF FILES UNABLE TO MOVE: ' + str(counter_fail) + '\nNUMBER OF CAMERAS REMOVED: ' + str(counter_cameras) + '\nNUMBER OF UNKNOWN ERRORRS: '+ str(counter_errors)
+            print ('Error %s!' % camera.label)
+            continue
+        if resultado == 'movida':
+            counter = counter + 1
+        else:
+            print ('PHOTO %s DOES NOT EXIST!' % camera.label)
+            counter_fail = counter_fail + 1
+        cameras_removidas.append(camera)
+        log.setdefault(destination.parent, []).append(dict(camera=camera.label, origem=str(photo_path),
+                                                           destino=str(destination), status=resultado, data=Agora()))
+    if cameras_removidas:
+        chunk.remove(cameras_removidas)
+        InvalidarInventario(chunk)
+    for destination_dir, registros in log.items():
+        RegistrarTriagem(destination_dir / ArquivoLogTriagem, registros)
+    message_end = 'SUCCESS, ' + str(counter) + ' PHOTOS MOVED, ' + str(counter_not_moved) + ' PHOTOS NOT MOVED.\nNUMBER OF FILES UNABLE TO MOVE: ' + str(counter_fail) + '\nNUMBER OF CAMERAS REMOVED: ' + str(len(cameras_removidas)) + '\nNUMBER OF UNKNOWN ERRORRS: '+ str(counter_errors)
     print (message_end)
 
 
+def RegistrarTriagem(caminho, registros):
+    # Acrescenta os registros ao log, preservando os de triagens anteriores
+    anteriores = []
+    if caminho.exists():
+        with open(str(caminho)) as arquivo:
+            anteriores = json.load(arquivo)
+    GravarLogTriagem(caminho, anteriores + registros)
+
+
+def GravarLogTriagem(caminho, registros):
+    # Arquivo temporario + os.replace: um log cortado no meio da gravacao impediria o DesfazerTriagem
+    with open(str(caminho) + ".tmp", "w") as arquivo:
+        json.dump(registros, arquivo, indent=2)
+    os.replace(str(caminho) + ".tmp", str(caminho))
+
+
+def DesfazerTriagem(caminho):
+    # Devolve as fotos movidas para as pastas de origem, a partir do log da triagem.
+    # As fotos devolvidas precisam ser adicionadas novamente ao chunk (Workflow > Add Photos)
+    caminho = Path(caminho)
+    with open(str(caminho)) as arquivo:
+        registros = json.load(arquivo)
+    restantes = []
+    for registro in registros:
+        if registro['status'] == 'movida' and Path(registro['destino']).is_file():
+            try:
+                shutil.move(registro['destino'], registro['origem'])
+                print ('RESTORED %s' % registro['origem'])
+                continue
+            except OSError:
+                print ('ERROR RESTORING %s' % registro['origem'])
+        restantes.append(registro)
+    GravarLogTriagem(caminho, restantes)
+
+
+@SerializarNoDocumento
 def RemoveLowPoint(chunk):
     chunk.dense_cloud.removePoints(Metashape.PointClass.LowPoint)
 
 
+# Transformadores de coordenadas ja criados: (wkt de origem, wkt de destino) -> funcao(array Nx3) -> array Nx3
+TransformadoresCrs = dict()
+
+# WGS 84 e SIRGAS 2000 geograficos. A diferenca entre eles e centimetrica e a EPSG usa transformacao nula
+GeograficasGRS80 = ("EPSG::4326", "EPSG::4674")
+
+
+def ZonaUtm(authority):
+    # (zona, sul) dos UTM SIRGAS 2000 e WGS 84. None para os demais sistemas
+    if not authority or not authority.startswith("EPSG::"):
+        return None
+    codigo = int(authority[6:])
+    for inicio, fim, deslocamento, sul in ((31965, 31976, 31954, False), (31977, 31985, 31960, True),
+                                           (32601, 32660, 32600, False), (32701, 32760, 32700, True)):
+        if inicio <= codigo <= fim:
+            return codigo - deslocamento, sul
+    return None
+
+
+def CrsUtmAutomatico(lon, lat):
+    # SIRGAS 2000 / UTM da zona do ponto. Fora das zonas definidas para o SIRGAS 2000, WGS 84 / UTM
+    zona = int((lon + 180) // 6) % 60 + 1
+    if lat < 0:
+        codigo = 31960 + zona if 17 <= zona <= 25 else 32700 + zona
+    else:
+        codigo = 31954 + zona if 11 <= zona <= 22 else 32600 + zona
+    return Metashape.CoordinateSystem("EPSG::%d" % codigo)
+
+
+def GeograficasParaUtm(lon, lat, zona, sul):
+    # Transversa de Mercator no elipsoide GRS80 pela serie de Kruger (erro sub-milimetrico dentro da zona), vetorizada
+    a, f, k0 = 6378137.0, 1 / 298.257222101, 0.9996
+    n = f / (2 - f)
+    e = math.sqrt(f * (2 - f))
+    A = a / (1 + n) * (1 + n ** 2 / 4 + n ** 4 / 64)
+    alfa = (n / 2 - 2 * n ** 2 / 3 + 5 * n ** 3 / 16, 13 * n ** 2 / 48 - 3 * n ** 3 / 5, 61 * n ** 3 / 240)
+    phi = numpy.radians(lat)
+    lam = numpy.radians(numpy.asarray(lon) - (zona * 6 - 183))
+    t = numpy.sinh(numpy.arctanh(numpy.sin(phi)) - e * numpy.arctanh(e * numpy.sin(phi)))
+    xi = numpy.arctan2(t, numpy.cos(lam))
+    eta = numpy.arctanh(numpy.sin(lam) / numpy.sqrt(1 + t ** 2))
+    x = eta + sum(alfa[j] * numpy.cos(2 * (j + 1) * xi) * numpy.sinh(2 * (j + 1) * eta) for j in range(3))
+    y = xi + sum(alfa[j] * numpy.sin(2 * (j + 1) * xi) * numpy.cosh(2 * (j + 1) * eta) for j in range(3))
+    return 500000 + k0 * A * x, k0 * A * y + (10000000 if sul else 0)
+
+
+def CriarTransformador(origem, destino):
+    try:
+        import pyproj
+        transformer = pyproj.Transformer.from_crs(pyproj.CRS.from_wkt(origem.wkt), pyproj.CRS.from_wkt(destino.wkt), always_xy=True)
+        return lambda xyz: numpy.column_stack(transformer.transform(xyz[:, 0], xyz[:, 1], xyz[:, 2]))
+    except Exception:
+        pass # sem pyproj, ou WKT que o pyproj nao reconhece
+    zona = ZonaUtm(destino.authority)
+    if origem.authority in GeograficasGRS80 and zona:
+        return lambda xyz: numpy.column_stack(GeograficasParaUtm(xyz[:, 0], xyz[:, 1], *zona) + (xyz[:, 2],))
+    # demais casos: um ponto por vez pelo proprio Metashape
+    return lambda xyz: numpy.array([list(Metashape.CoordinateSystem.transform(Metashape.Vector(ponto), origem, destino)) for ponto in xyz.tolist()])
+
+
+def Transformador(origem, destino):
+    chave = (origem.wkt, destino.wkt)
+    with TravaDocumento:
+        if chave not in TransformadoresCrs:
+            TransformadoresCrs[chave] = CriarTransformador(origem, destino)
+        return TransformadoresCrs[chave]
+
+
+@SerializarNoDocumento
+@MedirEtapa()
 def Sirgas2000(chunk):
-    if str(chunk.crs).find("SIRGAS 2000")>0 or str(chunk.crs).find("Local Coordinates")>0:
-        printNovaAtividade("O SISTEMA DE REFERENCIA JA E SIRGAS 2000 ou COORDENADAS LOCAIS\nNAO HA NECESSIDADE DE CONVERTER AS COORDENADAS DO PROJETO")
+    # Reprojeta as referencias das cameras e marcadores para CrsDestino numa unica operacao com NumPy.
+    # O sistema aplicado fica gravado no meta do chunk: nas proximas execucoes basta comparar esse registro
+    if chunk.crs is None or chunk.crs.wkt.startswith("LOCAL_CS"):
+        printNovaAtividade("COORDENADAS LOCAIS\nNAO HA NECESSIDADE DE CONVERTER AS COORDENADAS DO PROJETO")
+        return
+    if chunk.meta['Workflow/crs'] == chunk.crs.authority and CrsDestino in ("auto", chunk.crs.authority):
+        print("%sSISTEMA DE COORDENADAS: %s" % (PrefixoChunk(), chunk.crs.name))
+        return
+    if CrsDestino == "auto" and "SIRGAS 2000" in chunk.crs.name:
+        # como antes: um SIRGAS 2000 existente (geografico ou de outra zona UTM) e mantido. Projetos sem o registro
+        # no meta podem ja ter nuvem densa e DEM calculados nesse sistema
+        printNovaAtividade("O SISTEMA DE REFERENCIA JA E SIRGAS 2000 (%s)\nNAO HA NECESSIDADE DE CONVERTER AS COORDENADAS DO PROJETO" % chunk.crs.name)
+        chunk.meta['Workflow/crs'] = chunk.crs.authority
+        return
+    itens = [item for item in list(chunk.cameras) + list(chunk.markers) if item.reference.location]
+    origem = numpy.array([list(item.reference.location) for item in itens], dtype=float).reshape(-1, 3)
+    if CrsDestino != "auto":
+        destino = Metashape.CoordinateSystem(CrsDestino)
+    elif not itens:
+        printNovaAtividade("SEM COORDENADAS NAS CAMERAS PARA ESCOLHER A ZONA UTM\nO SISTEMA DE COORDENADAS DO PROJETO NAO FOI ALTERADO")
+        return
     else:
-        printNovaAtividade("CONVERTENDO SISTEMAS DE COORDENADAS DO PROJETO PARA SIRGAS 2000")
-        out_crs = Metashape.CoordinateSystem("EPSG::31983") #sirgas2000
-        for camera in chunk.cameras:
-            if camera.reference.location:
-                camera.reference.location = Metashape.CoordinateSystem.transform(camera.reference.location, chunk.crs, out_crs)
-        for marker in chunk.markers:
-            if marker.reference.location:
-                marker.reference.location = Metashape.CoordinateSystem.transform(marker.reference.location, chunk.crs, out_crs)
-        chunk.crs = out_crs
+        centro = Metashape.Vector(origem.mean(axis=0).tolist())
+        if not chunk.crs.wkt.startswith("GEOGCS"):
+            centro = Metashape.CoordinateSystem.transform(centro, chunk.crs, Metashape.CoordinateSystem("EPSG::4326"))
+        destino = CrsUtmAutomatico(centro[0], centro[1])
+    if destino.wkt != chunk.crs.wkt:
+        printNovaAtividade("CONVERTENDO %d REFERENCIAS DO PROJETO DE %s PARA %s" % (len(itens), chunk.crs.name, destino.name))
+        if itens:
+            convertidas = Transformador(chunk.crs, destino)(origem).tolist()
+            for item, xyz in zip(itens, convertidas):
+                item.reference.location = Metashape.Vector(xyz)
+        chunk.crs = destino
         chunk.updateTransform()
+        InvalidarInventario(chunk)
+    chunk.meta['Workflow/crs'] = destino.authority
+
+
+# Planejador de parametros. Cada etapa tem um modelo simples de tempo (segundos de 1 nucleo) e de pico de memoria (GB)
+# em funcao do tamanho do chunk e dos parametros. Os modelos sao corrigidos por fatores aprendidos em cada maquina,
+# comparando a estimativa com o que foi medido pelo MedirEtapa
+VistasPorPonto = 12 # fotos que enxergam cada ponto do terreno (sobreposicao tipica de um voo fotogrametrico)
+
+ModeloEtapas = dict(
+    alinhamento=dict(funcoes=['AlignPhoto'],
+                     tempo=lambda d: 1.6 * d['cameras'] * (d['mp_alinhamento'] + d['Key_Limit'] / 1e4),
+                     memoria=lambda d: 1 + 0.1 * d['mp_alinhamento'] + 2e-8 * d['cameras'] * d['Tie_Limit']),
+    depthmaps=dict(funcoes=['ConstruirDepthMaps'],
+                   tempo=lambda d: 0.8 * d['cameras'] * d['mp_depthmaps'] * d['vizinhos'],
+                   memoria=lambda d: 1 + 0.02 * d['mp_depthmaps'] * d['vizinhos']),
+    densa=dict(funcoes=['ConstruirNuvemDensa'],
+               tempo=lambda d: 12 * d['cameras'] * d['mp_depthmaps'],
+               memoria=lambda d: 2 + 0.03 * d['pontos_m']),
+    solo=dict(funcoes=['ClassificarPontosDeSolo'],
+              tempo=lambda d: 96 * d['pontos_m'],
+              memoria=lambda d: 1 + 0.02 * d['pontos_m']),
+    mesh=dict(funcoes=['BuildModel'],
+              tempo=lambda d: 190 * d['pontos_m'],
+              memoria=lambda d: 2 + 0.05 * d['pontos_m']),
+    dsm=dict(funcoes=['CalcularDSM'],
+             tempo=lambda d: 64 * d['pontos_m'],
+             memoria=lambda d: 1 + 0.01 * d['pixels_dem_m']),
+    dem_solo=dict(funcoes=['CalcularDEM', 'ExportarDEM'],
+                  tempo=lambda d: 64 * d['pontos_m'],
+                  memoria=lambda d: 1 + 0.01 * d['pixels_dem_m']),
+    ortofoto=dict(funcoes=['BuildMosaic'],
+                  tempo=lambda d: 3 * d['cameras'] * d['mp'],
+                  memoria=lambda d: 2 + 0.1 * d['mp']),
+    exportacao=dict(funcoes=['ExportarLas', 'ExportarOrtofoto', 'GerarAplicacaoWeb', 'GerarProdutosNuvem'],
+                    tempo=lambda d: 32 * d['pontos_m'],
+                    memoria=lambda d: 1.0),
+)
+
+# Parametros que o planejador pode reduzir em cada fase, na ordem do rodizio, com o valor mais leve aceito
+ReducoesPlanejador = dict(
+    alinhamento=[('Key_Limit', 10000), ('DownscaleAlignment', 8), ('Tie_Limit', 1000)],
+    workflow=[('MaxNeighbors', 8), ('DownscaleDepthMaps', 16), ('DownscaleDem', 8)],
+)
+
+
+def MemoriaDisponivelGB():
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024.0 ** 3
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024.0 ** 3
+    except (AttributeError, ValueError, OSError):
+        return None
+
 
+def LerModeloPlanejador():
+    # Fatores de correcao desta maquina: {etapa: {"tempo": fator, "memoria": fator, "execucoes": n}}
+    if not Path(ArquivoModeloPlanejador).exists():
+        return {}
+    try:
+        with open(ArquivoModeloPlanejador) as arquivo:
+            return json.load(arquivo).get(platform.node(), {})
+    except ValueError:
+        return {}
 
-def zipdir(path, ziph):
-    # ziph is zipfile handle https://stackoverflow.com/questions/1855095/how-to-create-a-zip-archive-of-a-directory-in-python
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            ziph.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), path))
 
+def GravarModeloPlanejador(fatores):
+    with TravaDocumento:
+        modelo = {}
+        if Path(ArquivoModeloPlanejador).exists():
+            try:
+                with open(ArquivoModeloPlanejador) as arquivo:
+                    modelo = json.load(arquivo)
+            except ValueError:
+                pass
+        modelo[platform.node()] = fatores
+        with open(ArquivoModeloPlanejador + ".tmp", "w") as arquivo:
+            json.dump(modelo, arquivo, indent=2)
+        os.replace(ArquivoModeloPlanejador + ".tmp", ArquivoModeloPlanejador)
+
+
+def EtapasPendentes(doc, chunk, **kwargs):
+    # Etapas do StandardWorkflow que a proxima execucao vai rodar (inclusive as refeitas porque uma dependencia sera refeita)
+    manifesto = LerManifesto(doc, chunk)
+    pendentes = []
+    for etapa in EtapasDoWorkflow(doc, chunk, **kwargs):
+        if etapa['habilitada'] and (any(dep in pendentes for dep in etapa['depende'])
+                                    or not EtapaConcluida(etapa, manifesto.get(etapa['nome'], {}))):
+            pendentes.append(etapa['nome'])
+    return pendentes
+
+
+def PerfilDoChunk(chunk, pendentes):
+    # Tamanho do chunk usado pelos modelos: cameras, megapixels das fotos e, se a nuvem densa ja existe e nao sera
+    # refeita, os pontos e a area da region (para os pixels do DEM pela resolucao do GetResolution)
+    inventario = InventarioDoChunk(chunk)
+    cameras = CamerasDoInventario(inventario, inventario['habilitadas'])
+    pixels = [camera.sensor.width * camera.sensor.height for camera in cameras
+              if getattr(camera, 'sensor', None) is not None and camera.sensor.width]
+    perfil = dict(cameras=len(cameras), mp=numpy.mean(pixels) / 1e6 if pixels else 20.0) # sem sensor: 20 MP
+    if chunk.dense_cloud is not None and 'densa' not in pendentes:
+        perfil['pontos_m'] = chunk.dense_cloud.point_count / 1e6
+        if chunk.crs is not None:
+            xmin, ymin, zmin, xmax, ymax, zmax = LimitesDaRegiao(chunk)
+            perfil['area'] = (xmax - xmin) * (ymax - ymin)
+            perfil['resolucao_densa'] = ResolucaoDEM(chunk, 1)
+    return perfil
+
+
+def DimensoesDasEtapas(perfil, parametros):
+    d = dict(perfil, **parametros)
+    if 'DownscaleAlignment' in parametros:
+        ds = parametros['DownscaleAlignment']
+        d['mp_alinhamento'] = perfil['mp'] * 4 if ds == 0 else perfil['mp'] / ds ** 2 # Highest=0 amplia as fotos 2x
+    if 'DownscaleDepthMaps' in parametros:
+        d['mp_depthmaps'] = perfil['mp'] / parametros['DownscaleDepthMaps'] ** 2
+        d['vizinhos'] = min(parametros['MaxNeighbors'], max(perfil['cameras'] - 1, 1))
+        if 'pontos_m' not in perfil:
+            d['pontos_m'] = perfil['cameras'] * d['mp_depthmaps'] / VistasPorPonto
+        if 'area' in perfil:
+            d['pixels_dem_m'] = perfil['area'] / (perfil['resolucao_densa'] * parametros['DownscaleDem']) ** 2 / 1e6
+        else:
+            d['pixels_dem_m'] = d['pontos_m'] / parametros['DownscaleDem'] ** 2
+    return d
+
+
+def EstimarEtapas(perfil, parametros, etapas, fatores, nucleos):
+    # {etapa: (tempo em segundos, pico de memoria em GB)}
+    d = DimensoesDasEtapas(perfil, parametros)
+    estimativas = dict()
+    for nome in etapas:
+        fator = fatores.get(nome, {})
+        estimativas[nome] = (fator.get('tempo', 1.0) * ModeloEtapas[nome]['tempo'](d) / nucleos,
+                             fator.get('memoria', 1.0) * ModeloEtapas[nome]['memoria'](d))
+    return estimativas
+
+
+def CandidatosDeParametros(parametros, reducoes):
+    # Dos valores do usuario ate os mais leves, reduzindo um parametro de cada vez (rodizio)
+    atual = dict(parametros)
+    yield dict(atual)
+    reduziu = True
+    while reduziu:
+        reduziu = False
+        for nome, limite in reducoes:
+            if nome.startswith('Downscale'):
+                novo = min(max(1, atual[nome] * 2), limite) if atual[nome] < limite else atual[nome]
+            else:
+                novo = max(atual[nome] // 2, limite) if atual[nome] > limite else atual[nome]
+            if novo != atual[nome]:
+                atual[nome] = novo
+                reduziu = True
+                yield dict(atual)
+
+
+def PlanejarParametros(chunk, fase, parametros, etapas):
+    # Escolhe os parametros mais fieis aos do usuario que cabem no OrcamentoHoras e no limite de memoria.
+    # Altera parametros no lugar e retorna o plano, que o AvaliarPlano compara com o que foi medido
+    etapas = [nome for nome in etapas if nome in ModeloEtapas]
+    nucleos = os.cpu_count() or 1
+    disponivel = MemoriaDisponivelGB()
+    limite = LimiteMemoriaGB or (0.8 * disponivel / max(1, MaxChunksEmParalelo if ParalelismoExperimental else 1) if disponivel else None)
+    fatores = LerModeloPlanejador()
+    perfil = PerfilDoChunk(chunk, etapas)
+    nomes = [nome for nome, minimo in ReducoesPlanejador[fase]]
+    for candidato in CandidatosDeParametros(dict((nome, parametros[nome]) for nome in nomes), ReducoesPlanejador[fase]):
+        estimativas = EstimarEtapas(perfil, candidato, etapas, fatores, nucleos)
+        cabe_no_tempo = not OrcamentoHoras or sum(tempo for tempo, memoria in estimativas.values()) <= OrcamentoHoras * 3600
+        cabe_na_memoria = not limite or all(memoria <= limite for tempo, memoria in estimativas.values())
+        if cabe_no_tempo and cabe_na_memoria:
+            break
+    msg = "PLANEJAMENTO (%s) - %d NUCLEOS, %s DE RAM DISPONIVEL\nCAMERAS: %d  FOTOS: %.1f MP" \
+          % (fase.upper(), nucleos, "%.1f GB" % disponivel if disponivel else "?", perfil['cameras'], perfil['mp'])
+    msg += "\nORCAMENTO: %s  LIMITE DE MEMORIA: %s" % ("%.1f h" % OrcamentoHoras if OrcamentoHoras else "SEM LIMITE",
+                                                       "%.1f GB" % limite if limite else "SEM LIMITE")
+    for nome in nomes:
+        msg += "\n%-20s %8s" % (nome, candidato[nome])
+        if candidato[nome] != parametros[nome]:
+            msg += "   (CONFIGURADO: %s)" % parametros[nome]
+    msg += "\n\n%-14s %12s %12s" % ("ETAPA", "TEMPO", "MEMORIA")
+    for nome, (tempo, memoria) in estimativas.items():
+        msg += "\n%-14s %12s %9.1f GB" % (nome, datetime.timedelta(seconds=int(tempo)), memoria)
+    msg += "\n%-14s %12s" % ("TOTAL", datetime.timedelta(seconds=int(sum(tempo for tempo, memoria in estimativas.values()))))
+    if not (cabe_no_tempo and cabe_na_memoria):
+        msg += "\nATENCAO: NEM OS PARAMETROS MAIS LEVES CABEM NO ORCAMENTO/LIMITE DE MEMORIA. USANDO OS MAIS LEVES"
+    printNovaAtividade(msg)
+    parametros.update(candidato)
+    return dict(fase=fase, chunk=chunk.label, estimativas=estimativas, inicio=len(RelatorioDesempenho))
+
+
+def AvaliarPlano(plano):
+    # Compara a estimativa com o medido nesta execucao e corrige os fatores do modelo desta maquina.
+    # A memoria medida e o pico amostrado durante as chamadas de cada etapa
+    funcoes = dict((funcao, nome) for nome, modelo in ModeloEtapas.items() for funcao in modelo['funcoes'])
+    medidas = dict()
+    for registro in RelatorioDesempenho[plano['inicio']:]:
+        pico = registro.get('pico_rss_mb') or 0
+        nome = funcoes.get(registro['etapa'])
+        if nome in plano['estimativas'] and registro['chunk'] == plano['chunk'] and registro['status'] == 'ok':
+            medida = medidas.setdefault(nome, dict(tempo=0.0, memoria=None))
+            medida['tempo'] += registro['tempo_s']
+            if pico:
+                medida['memoria'] = max(medida['memoria'] or 0, pico / 1024.0)
+    if not medidas:
+        return
+    fatores = LerModeloPlanejador()
+    msg = "ESTIMATIVA x MEDIDO (%s)\n%-14s %12s %12s %7s %12s %12s" % (plano['fase'].upper(), "ETAPA", "ESTIMADO", "MEDIDO", "RAZAO", "MEM. EST.", "MEM. MEDIDA")
+    for nome, medida in medidas.items():
+        tempo, memoria = plano['estimativas'][nome]
+        fator = fatores.setdefault(nome, dict(tempo=1.0, memoria=1.0, execucoes=0))
+        # media geometrica entre o fator antigo e o que acertaria esta execucao: uma execucao atipica nao domina o modelo
+        if tempo > 0 and medida['tempo'] > 0:
+            fator['tempo'] = min(max(fator['tempo'] * math.sqrt(medida['tempo'] / tempo), 0.01), 100.0)
+        if memoria > 0 and medida['memoria']:
+            fator['memoria'] = min(max(fator['memoria'] * math.sqrt(medida['memoria'] / memoria), 0.01), 100.0)
+        fator['execucoes'] += 1
+        msg += "\n%-14s %12s %12s %7.2f %9.1f GB %s" % (nome, datetime.timedelta(seconds=int(tempo)), datetime.timedelta(seconds=int(medida['tempo'])),
+                                                     medida['tempo'] / tempo if tempo > 0 else 0, memoria,
+                                                     "%9.1f GB" % medida['memoria'] if medida['memoria'] else "%12s" % "-")
+    GravarModeloPlanejador(fatores)
+    printNovaAtividade(msg + "\nMODELO ATUALIZADO EM %s" % ArquivoModeloPlanejador)
+
+
+def ProcessarChunk(doc, chunk):
+    # Executa a proxima fase do chunk. Retorna (label, etapa, tempo decorrido em segundos, status)
+    ContextoChunk.label = chunk.label
+    etapa = "SIRGAS2000"
+    inicio = time.time()
+    try:
+        Sirgas2000(chunk)
+        if HasDisabledPhotos(chunk):
+            # 1a execucao. Apenas remove as fotos desabilitadas.
+            etapa = "TRIAGEM"
+            RemoveDisabledPhotos(chunk)
+            printNovaAtividade("CAMERAS DESABILITADAS FORAM MOVIDAS PARA A PASTA \n1. RODE ESSE SCRIPT NOVAMENTE PARA ALINHAR A NUVEM DE PONTOS")
+        elif chunk.point_cloud is None:
+            # 2a execucao. Alinha as fotos
+            etapa = "ALINHAMENTO"
+            parametros = dict(DownscaleAlignment=DownscaleAlignment, Key_Limit=Key_Limit, Tie_Limit=Tie_Limit)
+            plano = PlanejarParametros(chunk, "alinhamento", parametros, ["alinhamento"]) if PlanejadorAutomatico else None
+            AlignPhoto(chunk, parametros['DownscaleAlignment'], parametros['Key_Limit'], parametros['Tie_Limit'], QualityFilter, QualityCriteria)
+            if plano:
+                AvaliarPlano(plano)
+            # ReduceError_RU(chunk); ReduceError_PA(chunk); ReduceError_RE(chunk)
+            RegiaoAjustada = False
+            if RegiaoAutomatica:
+                try:
+                    RegiaoAjustada = AjustarRegiaoAutomatica(chunk)
+                except Exception:
+                    # o alinhamento ja terminou: sem a region automatica, o operador ajusta a region como antes
+                    traceback.print_exc()
+            printNovaAtividade("FIM DA CRIACAO DOS TIE POINTS.\n1. %s\n2. ASSOCIE OS GCPs E REALINHE AS CAMERAS\n3. SALVE O PROJETO\nEM SEGUIDA RODE ESTE SCRIPT NOVAMENTE PARA GERAR NUVEM DE PONTOS, ORTOFOTO, ETC" \
+                    % ("CONFIRA A REGION, AJUSTADA AUTOMATICAMENTE" if RegiaoAjustada else "AJUSTE A REGION PARA O TAMANHO DESEJADO"))
+        else:
+            # 3a execucao. Executa o workflow (Nuvem densa, DEM, Ortofotos, etc)
+            etapa = "WORKFLOW"
+            DefinirPastaDeExportacao(doc)
+            kwargs = dict(PotreeExe=PotreeExe, PastaDeExportacaoCaminhoCompleto=PastaDeExportacaoCaminhoCompleto, DownscaleDepthMaps=DownscaleDepthMaps, FilterMode=FilterMode, Max_Angle=Max_Angle, Cell_Size=Cell_Size, Max_Distance=Max_Distance, BlendingMode=BlendingMode, MaxNeighbors=MaxNeighbors, DownscaleDem=DownscaleDem)
+            plano = PlanejarParametros(chunk, "workflow", kwargs, EtapasPendentes(doc, chunk, **kwargs)) if PlanejadorAutomatico else None
+            StandardWorkflow(doc, chunk, **kwargs)
+            if plano:
+                AvaliarPlano(plano)
+        status = "OK"
+    except Exception:
+        traceback.print_exc()
+        printNovaAtividade("ERRO NA ETAPA %s" % etapa)
+        status = "ERRO"
+    finally:
+        ContextoChunk.label = None
+    return chunk.label, etapa, time.time() - inicio, status
+
+
+def AvancarChunk(doc, chunk):
+    # Modo lote: executa as fases do chunk em sequencia, salvando apos cada uma, ate o fim ou ate um passo manual
+    anterior = None
+    while True:
+        label, etapa, decorrido, status = ProcessarChunk(doc, chunk)
+        if status == "OK":
+            SalvarDocumento(doc)
+        if status != "OK" or etapa in ("WORKFLOW", anterior) or (etapa == "ALINHAMENTO" and not LoteIgnorarPassosManuais):
+            return label, etapa, decorrido, status
+        anterior = etapa
+
+
+def ProcessarChunks(doc, chunks, max_paralelo=1, lote=False):
+    # Cada chunk e um job independente. Com max_paralelo=1 os chunks sao processados em sequencia, como antes.
+    # Em paralelo (experimental) as chamadas ao Metashape continuam serializadas pela TravaDocumento.
+    # Com lote=True cada chunk avanca por todas as fases que nao dependem de um operador
+    processar = AvancarChunk if lote else ProcessarChunk
+    chunks = [chunk for chunk in chunks if chunk.enabled]
+    if max_paralelo > 1 and not ParalelismoExperimental:
+        printNovaAtividade("MaxChunksEmParalelo = %d EXIGE ParalelismoExperimental = True (EXPERIMENTAL)\nOS CHUNKS SERAO PROCESSADOS UM APOS O OUTRO" % max_paralelo)
+        max_paralelo = 1
+    if max_paralelo <= 1 or len(chunks) <= 1:
+        resultados = [processar(doc, chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=max_paralelo) as executor:
+            resultados = list(executor.map(lambda chunk: processar(doc, chunk), chunks))
+    resumo = "RESUMO DO PROCESSAMENTO DOS CHUNKS\n%-30s %-12s %10s %s" % ("CHUNK", "ETAPA", "TEMPO", "STATUS")
+    for label, etapa, decorrido, status in resultados:
+        resumo += "\n%-30s %-12s %10s %s" % (label, etapa, datetime.timedelta(seconds=int(decorrido)), status)
+    # relatorio de desempenho na pasta de exportacao, ou ao lado do projeto se ela ainda nao foi definida
+    pasta = PastaDeExportacaoCaminhoCompleto or os.path.dirname(doc.path)
+    relatorio = GravarRelatorioDesempenho(pasta, os.path.splitext(os.path.basename(doc.path))[0])
+    if relatorio:
+        resumo += "\n\nRELATORIO DE DESEMPENHO: %s" % relatorio
+    printNovaAtividade(resumo)
+    return resultados
+
+
+# Codigos de saida do worker do lote (--projeto)
+SaidaConcluido = 0
+SaidaErro = 1
+SaidaAguardandoOperador = 3
+
+
+def ProcessarProjeto(caminho):
+    # Worker do lote: abre o projeto sem interface e avanca cada chunk o maximo possivel. Retorna o codigo de saida
+    projeto = Metashape.Document()
+    projeto.open(caminho)
+    resultados = ProcessarChunks(projeto, projeto.chunks, MaxChunksEmParalelo, lote=True)
+    if any(status != "OK" for label, etapa, decorrido, status in resultados):
+        return SaidaErro
+    if all(etapa == "WORKFLOW" for label, etapa, decorrido, status in resultados):
+        return SaidaConcluido
+    return SaidaAguardandoOperador
+
+
+def ProjetosDoLote(entradas):
+    # .psx informados diretamente ou encontrados (recursivamente) nas pastas informadas
+    projetos = []
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            projetos += sorted(str(caminho) for caminho in Path(entrada).rglob("*.psx"))
+        else:
+            projetos.append(entrada)
+    return [os.path.abspath(projeto) for projeto in projetos]
+
+
+def LerFilaLote(caminho):
+    if not Path(caminho).exists():
+        return {}
+    with open(caminho) as arquivo:
+        return json.load(arquivo)
+
+
+def GravarFilaLote(caminho, fila):
+    with open(caminho + ".tmp", "w") as arquivo:
+        json.dump(fila, arquivo, indent=2)
+    os.replace(caminho + ".tmp", caminho)
+
+
+def ExecutarLote(projetos, caminho_fila, max_paralelo, memoria_gb, reprocessar=False):
+    # Escalonador do lote. Cada projeto roda num processo separado (globais, pasta de exportacao e relatorio proprios),
+    # preso a um conjunto exclusivo de nucleos, e so e iniciado quando a sua reserva de memoria cabe no orcamento.
+    # A fila e gravada a cada mudanca: projetos 'executando' numa execucao interrompida voltam para a fila
+    fila = LerFilaLote(caminho_fila)
+    for projeto in projetos:
+        registro = fila.setdefault(projeto, dict(status='pendente', tentativas=0))
+        if registro['status'] == 'executando' or (reprocessar and registro['status'] in ('erro', 'aguardando_operador')):
+            registro['status'] = 'pendente'
+    GravarFilaLote(caminho_fila, fila)
+    nucleos_livres = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    nucleos_por_projeto = max(1, len(nucleos_livres) // max_paralelo) if nucleos_livres else 0
+    reserva = LoteMemoriaPorProjetoGB or (memoria_gb / max_paralelo if memoria_gb else 0)
+    pendentes = deque(projeto for projeto in projetos if fila[projeto]['status'] == 'pendente')
+    printNovaAtividade("LOTE: %d PROJETOS (%d PENDENTES), ATE %d AO MESMO TEMPO\nNUCLEOS POR PROJETO: %s  MEMORIA POR PROJETO: %s\nFILA: %s"
+                       % (len(projetos), len(pendentes), max_paralelo, nucleos_por_projeto or "TODOS",
+                          "%.1f GB" % reserva if reserva else "SEM LIMITE", caminho_fila))
+    executando = dict() # projeto -> (processo, nucleos, log)
+    try:
+        while pendentes or executando:
+            while pendentes and len(executando) < max_paralelo:
+                # com algum projeto rodando, so inicia outro se a reserva de memoria cabe no orcamento e na RAM livre
+                disponivel = MemoriaDisponivelGB()
+                if executando and reserva and ((len(executando) + 1) * reserva > memoria_gb or (disponivel is not None and disponivel < reserva)):
+                    break
+                if len(nucleos_livres) < nucleos_por_projeto:
+                    break
+                projeto = pendentes.popleft()
+                nucleos = [nucleos_livres.pop() for indice in range(nucleos_por_projeto)]
+                comando = ComandoWorkerLote + [os.path.abspath(__file__), "--projeto", projeto]
+                if reserva:
+                    comando += ["--memoria", str(reserva)]
+                log = open(os.path.splitext(projeto)[0] + "_lote.log", "a")
+                processo = Popen(comando, stdout=log, stderr=STDOUT, universal_newlines=True,
+                                 preexec_fn=(lambda nucleos=nucleos: os.sched_setaffinity(0, nucleos)) if nucleos else None)
+                executando[projeto] = (processo, nucleos, log)
+                fila[projeto].update(status='executando', inicio=Agora(), fim=None, tentativas=fila[projeto]['tentativas'] + 1, log=log.name)
+                GravarFilaLote(caminho_fila, fila)
+                printNovaAtividade("INICIANDO %s (PID %d)" % (projeto, processo.pid))
+            time.sleep(5)
+            for projeto, (processo, nucleos, log) in list(executando.items()):
+                codigo = processo.poll()
+                if codigo is None:
+                    continue
+                del executando[projeto]
+                log.close()
+                nucleos_livres += nucleos
+                status = {SaidaConcluido: 'concluido', SaidaAguardandoOperador: 'aguardando_operador'}.get(codigo, 'erro')
+                fila[projeto].update(status=status, fim=Agora(), codigo=codigo)
+                GravarFilaLote(caminho_fila, fila)
+                printNovaAtividade("%s: %s" % (status.upper(), projeto))
+    finally:
+        # interrompido (Ctrl+C): os workers sao encerrados e voltam para a fila na proxima execucao
+        for projeto, (processo, nucleos, log) in executando.items():
+            processo.terminate()
+            processo.wait()
+            log.close()
+            fila[projeto]['status'] = 'pendente'
+        GravarFilaLote(caminho_fila, fila)
+    resumo = "RESUMO DO LOTE\n%-60s %s" % ("PROJETO", "STATUS")
+    for projeto in projetos:
+        resumo += "\n%-60s %s" % (projeto, fila[projeto]['status'].upper())
+    printNovaAtividade(resumo)
+    return fila
+
+
+# Arquivos maiores que isso nao sao comprimidos em memoria pelas threads, e sim gravados em streaming
+LimiteCompressaoEmMemoria = 64 * 1024 * 1024
+# Entradas do zip a partir deste tamanho ja tem o cabecalho local em Zip64: o tamanho comprimido so e conhecido no fim
+# e o deflate pode passar um pouco do tamanho original
+LimiteSemZip64 = 0xF0000000
+
+
+def ComprimirArquivo(caminho):
+    # Deflate puro (sem cabecalho zlib), o formato usado dentro do zip. O zlib libera o GIL, entao as threads rodam em paralelo
+    with open(caminho, 'rb') as arquivo:
+        dados = arquivo.read()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return zlib.crc32(dados), len(dados), compressor.compress(dados) + compressor.flush()
+
+
+def AbrirZip(caminho):
+    # Zip gravado pelo proprio script: o zipfile nao aceita entradas ja comprimidas pelas threads.
+    # Entradas com cabecalho local e diretorio central no fim (FecharZip), com Zip64 quando os limites do zip sao passados
+    return dict(arquivo=open(caminho, 'wb'), entradas=[])
+
+
+def CabecalhoLocalZip(entrada):
+    if entrada['zip64']:
+        extra = struct.pack('<HHQQ', 1, 16, entrada['tamanho'], entrada['comprimido'])
+        tamanhos = (0xFFFFFFFF, 0xFFFFFFFF)
+    else:
+        extra = b''
+        tamanhos = (entrada['comprimido'], entrada['tamanho'])
+    return struct.pack('<4s5H3I2H', b'PK\x03\x04', 45 if entrada['zip64'] else 20, 0x800, entrada['metodo'], entrada['hora'],
+                       entrada['data'], entrada['crc'], tamanhos[0], tamanhos[1], len(entrada['nome']), len(extra)) + entrada['nome'] + extra
+
+
+def IniciarEntradaZip(zipf, caminho, nome, metodo, crc=0, tamanho=0, comprimido=0, zip64=False):
+    # Grava o cabecalho local de uma entrada (metodo 0 = armazenado, 8 = deflate) com a data e as permissoes do arquivo de origem
+    status = os.stat(caminho)
+    data = max(time.localtime(status.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+    entrada = dict(nome=nome.replace(os.sep, '/').encode('utf-8'), metodo=metodo, crc=crc, tamanho=tamanho, comprimido=comprimido,
+                   zip64=zip64, offset=zipf['arquivo'].tell(), atributos=(status.st_mode & 0xFFFF) << 16,
+                   hora=(data[3] << 11) | (data[4] << 5) | (data[5] // 2), data=((data[0] - 1980) << 9) | (data[1] << 5) | data[2])
+    zipf['arquivo'].write(CabecalhoLocalZip(entrada))
+    zipf['entradas'].append(entrada)
+    return entrada
+
+
+def GravarEntradaComprimida(zipf, caminho, nome, crc, tamanho, comprimido):
+    # Grava no zip um arquivo ja comprimido por ComprimirArquivo
+    IniciarEntradaZip(zipf, caminho, nome, 8, crc, tamanho, len(comprimido), len(comprimido) >= LimiteSemZip64)
+    zipf['arquivo'].write(comprimido)
+
+
+def GravarArquivoEmStreaming(zipf, caminho, nome, comprimir):
+    # Arquivos grandes ou ja compactados, lidos em partes nesta thread. CRC e tamanhos sao acertados no cabecalho local no fim
+    arquivo = zipf['arquivo']
+    entrada = IniciarEntradaZip(zipf, caminho, nome, 8 if comprimir else 0, zip64=os.path.getsize(caminho) >= LimiteSemZip64)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if comprimir else None
+    with open(caminho, 'rb') as origem:
+        for parte in iter(lambda: origem.read(1024 * 1024), b''):
+            entrada['crc'] = zlib.crc32(parte, entrada['crc'])
+            entrada['tamanho'] += len(parte)
+            if compressor is not None:
+                parte = compressor.compress(parte)
+            arquivo.write(parte)
+            entrada['comprimido'] += len(parte)
+    if compressor is not None:
+        parte = compressor.flush()
+        arquivo.write(parte)
+        entrada['comprimido'] += len(parte)
+    if not entrada['zip64'] and max(entrada['tamanho'], entrada['comprimido']) >= 0xFFFFFFFF:
+        raise RuntimeError('O ARQUIVO %s CRESCEU DURANTE A COMPACTACAO E PASSOU DO LIMITE DO ZIP' % caminho)
+    fim = arquivo.tell()
+    arquivo.seek(entrada['offset'])
+    arquivo.write(CabecalhoLocalZip(entrada))
+    arquivo.seek(fim)
+
+
+def FecharZip(zipf):
+    # Diretorio central e fim do zip. Zip64 (registro e localizador) quando ha mais de 65535 entradas ou o zip passa de 4 GB
+    arquivo = zipf['arquivo']
+    inicio = arquivo.tell()
+    criador = (0 if os.name == 'nt' else 3) << 8 # sistema de origem dos atributos, como no zipfile
+    for entrada in zipf['entradas']:
+        campos = [entrada['comprimido'], entrada['tamanho'], entrada['offset']]
+        extra = b''
+        if entrada['zip64'] or max(campos) >= 0xFFFFFFFF:
+            extra = struct.pack('<HHQQQ', 1, 24, entrada['tamanho'], entrada['comprimido'], entrada['offset'])
+            campos = [0xFFFFFFFF] * 3
+        versao = 45 if extra else 20
+        arquivo.write(struct.pack('<4s6H3I5H2I', b'PK\x01\x02', criador | versao, versao, 0x800, entrada['metodo'], entrada['hora'],
+                                  entrada['data'], entrada['crc'], campos[0], campos[1], len(entrada['nome']), len(extra), 0, 0, 0,
+                                  entrada['atributos'], campos[2]) + entrada['nome'] + extra)
+    fim = arquivo.tell()
+    total, tamanho = len(zipf['entradas']), fim - inicio
+    if total >= 0xFFFF or fim >= 0xFFFFFFFF:
+        arquivo.write(struct.pack('<4sQ2H2I4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, total, total, tamanho, inicio))
+        arquivo.write(struct.pack('<4sIQI', b'PK\x06\x07', 0, fim, 1))
+    arquivo.write(struct.pack('<4s4H2IH', b'PK\x05\x06', 0, 0, min(total, 0xFFFF), min(total, 0xFFFF),
+                              min(tamanho, 0xFFFFFFFF), min(inicio, 0xFFFFFFFF), 0))
+    arquivo.close()
+
+
+def EmpacotarPastaWeb(pasta, destino, formato="zip", threads=1, apagar=True):
+    # Empacota a pasta gerada pelo PotreeConverter em destino (.zip ou .tar).
+    # Arquivos com extensao em ExtensoesSemCompressao sao armazenados sem recompressao, os pequenos sao
+    # comprimidos pelas threads e os grandes gravados em streaming. Com apagar=True cada arquivo e removido
+    # assim que entra no pacote, para nao dobrar o espaco em disco. Retorna (bytes empacotados, segundos)
+    inicio = time.time()
+    arquivos = [os.path.join(root, file) for root, dirs, files in os.walk(pasta) for file in files]
+    total = 0
+    parcial = destino + ".parcial" # so recebe o nome final quando estiver completo
+
+    def Concluir(caminho):
+        if apagar:
+            os.remove(caminho)
+
+    if formato == "tar":
+        with tarfile.open(parcial, "w") as tarf:
+            for caminho in arquivos:
+                total += os.path.getsize(caminho)
+                tarf.add(caminho, os.path.relpath(caminho, pasta))
+                Concluir(caminho)
+    else:
+        zipf = AbrirZip(parcial)
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+                pendentes = deque()
+
+                def GravarPendente():
+                    caminho, future = pendentes.popleft()
+                    GravarEntradaComprimida(zipf, caminho, os.path.relpath(caminho, pasta), *future.result())
+                    Concluir(caminho)
+
+                for caminho in arquivos:
+                    tamanho = os.path.getsize(caminho)
+                    total += tamanho
+                    if os.path.splitext(caminho)[1].lower() in ExtensoesSemCompressao:
+                        GravarArquivoEmStreaming(zipf, caminho, os.path.relpath(caminho, pasta), False)
+                        Concluir(caminho)
+                    elif tamanho > LimiteCompressaoEmMemoria:
+                        GravarArquivoEmStreaming(zipf, caminho, os.path.relpath(caminho, pasta), True)
+                        Concluir(caminho)
+                    else:
+                        pendentes.append((caminho, executor.submit(ComprimirArquivo, caminho)))
+                        # limita o numero de arquivos comprimidos aguardando gravacao na memoria
+                        while len(pendentes) > 2 * threads:
+                            GravarPendente()
+                while pendentes:
+                    GravarPendente()
+            FecharZip(zipf)
+        finally:
+            zipf['arquivo'].close()
+    os.replace(parcial, destino)
+    if apagar:
+        shutil.rmtree(pasta)
+    return total, time.time() - inicio
 
 
 # The following process will only be executed when running script
 if __name__ == '__main__':
-    # Initialising listing chunks
-    chunk_list = doc.chunks
-    # Loop for all enabled chunks
-    for chunk in chunk_list:
-        if chunk.enabled:
-            Sirgas2000(chunk)
-            if HasDisabledPhotos(chunk):
-                # 1a execucao. Apenas remove as fotos desabilitadas.
-                RemoveDisabledPhotos(chunk)
-                printNovaAtividade("CAMERAS DESABILITADAS FORAM MOVIDAS PARA A PASTA \n1. RODE ESSE SCRIPT NOVAMENTE PARA ALINHAR A NUVEM DE PONTOS")
-            elif chunk.point_cloud is None:
-                # 2a execucao. Alinha as fotos
-                AlignPhoto(chunk, DownscaleAlignment, Key_Limit, Tie_Limit, QualityFilter, QualityCriteria)
-                # ReduceError_RU(chunk); ReduceError_PA(chunk); ReduceError_RE(chunk)
-                printNovaAtividade("FIM DA CRIACAO DOS TIE POINTS.\n1. AJUSTE A REGION PARA O TAMANHO DESEJADO\n2. ASSOCIE OS GCPs E REALINHE AS CAMERAS\n3. SALVE O PROJETO\nEM SEGUIDA RODE ESTE SCRIPT NOVAMENTE PARA GERAR NUVEM DE PONTOS, ORTOFOTO, ETC")
-            else:
-                # 3a execucao. Executa o workflow (Nuvem densa, DEM, Ortofotos, etc)
-                DefinirPastaDeExportacao()
-                StandardWorkflow(doc, chunk, PotreeExe=PotreeExe, PastaDeExportacaoCaminhoCompleto=PastaDeExportacaoCaminhoCompleto, DownscaleDepthMaps=DownscaleDepthMaps, FilterMode=FilterMode, Max_Angle=Max_Angle, Cell_Size=Cell_Size, Max_Distance=Max_Distance, BlendingMode=BlendingMode, MaxNeighbors=MaxNeighbors)
-
+    parser = argparse.ArgumentParser(description="Workflow do Metashape. Sem argumentos, processa o projeto aberto no Metashape")
+    parser.add_argument("--lote", nargs="+", metavar="PSX_OU_PASTA", help="processa uma fila de projetos .psx sem interface")
+    parser.add_argument("--projeto", help=argparse.SUPPRESS) # worker do lote
+    parser.add_argument("--paralelo", type=int, default=LoteMaxProjetos, help="projetos processados ao mesmo tempo")
+    parser.add_argument("--memoria", type=float, default=0, help="memoria (GB) do lote inteiro, ou de um worker. 0 = 80%% da RAM disponivel")
+    parser.add_argument("--fila", default=ArquivoFilaLote, help="arquivo com o estado da fila")
+    parser.add_argument("--reprocessar", action="store_true", help="recoloca na fila os projetos com erro ou aguardando o operador")
+    parser.add_argument("--desfazer-triagem", nargs="+", metavar="REGISTRO",
+                        help="devolve as fotos movidas pela triagem, a partir do %s de cada pasta FotosDescartadas" % ArquivoLogTriagem)
+    args = parser.parse_known_args()[0] # o Metashape pode acrescentar argumentos proprios
+    if args.desfazer_triagem:
+        for registro in args.desfazer_triagem:
+            DesfazerTriagem(registro)
+    elif args.projeto:
+        LimiteMemoriaGB = args.memoria or LimiteMemoriaGB
+        sys.exit(ProcessarProjeto(args.projeto))
+    elif args.lote:
+        disponivel = MemoriaDisponivelGB()
+        ExecutarLote(ProjetosDoLote(args.lote), os.path.abspath(args.fila), max(1, args.paralelo),
+                     args.memoria or (0.8 * disponivel if disponivel else 0), args.reprocessar)
+    else:
+        # Processa todos os chunks habilitados
+        ProcessarChunks(doc, doc.chunks, MaxChunksEmParalelo)